@@ -0,0 +1,36 @@
+from http.server import BaseHTTPRequestHandler
+import json
+import os
+import logging
+from lib.jobs import drain_jobs
+from lib.callback_handler import retry_stuck_submissions
+
+logging.basicConfig(level=logging.INFO)
+
+class handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        """Доработка зависших задач и отправок в Битрикс24 (Vercel Cron вызывает GET)"""
+        self._drain()
+    
+    def do_POST(self):
+        self._drain()
+    
+    def _drain(self):
+        secret = os.getenv('CRON_SECRET')
+        if secret and self.headers.get('Authorization') != f"Bearer {secret}":
+            self._send_response(401, {"error": "unauthorized"})
+            return
+        
+        try:
+            processed = drain_jobs()
+            resubmitted = retry_stuck_submissions()
+            self._send_response(200, {"status": "ok", "processed": processed, "resubmitted": resubmitted})
+        except Exception as e:
+            logging.error(f"❌ Error draining jobs: {e}")
+            self._send_response(500, {"error": str(e)})
+    
+    def _send_response(self, code, data):
+        self.send_response(code)
+        self.send_header('Content-type', 'application/json')
+        self.end_headers()
+        self.wfile.write(json.dumps(data).encode())
@@ -0,0 +1,34 @@
+from http.server import BaseHTTPRequestHandler
+import json
+import os
+import logging
+from lib.reaper import reap_sessions
+
+logging.basicConfig(level=logging.INFO)
+
+class handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        """Очистка устаревших сессий (Vercel Cron вызывает GET)"""
+        self._reap()
+    
+    def do_POST(self):
+        self._reap()
+    
+    def _reap(self):
+        secret = os.getenv('CRON_SECRET')
+        if secret and self.headers.get('Authorization') != f"Bearer {secret}":
+            self._send_response(401, {"error": "unauthorized"})
+            return
+        
+        try:
+            reaped = reap_sessions()
+            self._send_response(200, {"status": "ok", **reaped})
+        except Exception as e:
+            logging.error(f"❌ Error reaping sessions: {e}")
+            self._send_response(500, {"error": str(e)})
+    
+    def _send_response(self, code, data):
+        self.send_response(code)
+        self.send_header('Content-type', 'application/json')
+        self.end_headers()
+        self.wfile.write(json.dumps(data).encode())
@@ -1,18 +1,28 @@
+import time
+_import_started_at = time.monotonic()
+
 from http.server import BaseHTTPRequestHandler
 import json
 import os
 import logging
 import uuid
-import threading
-from lib.telegram import TelegramService
-from lib.ocr import OCRService
-from lib.deepseek import DeepSeekService
-from lib.callback_handler import handle_callback_query
+from urllib.parse import urlsplit, parse_qs
+from lib.tracing import tracer
+from lib.lazy import timed_import
+from lib.telegram import telegram_service, ProgressMessage
 from lib.supabase_client import supabase_client
-from utils.formatters import parse_extracted_data, format_data_for_display
+from lib.dedup import update_deduplicator
+from lib.workers import photo_executor, archive_executor, callback_executor
+
+# Модули обработки кнопок, фото и метрик импортируются при первом
+# использовании (timed_import), чтобы GET и текстовые сообщения
+# не платили за OCR, Pillow, httpx и т.п. на холодном старте
+tracer.record('import.api.webhook', time.monotonic() - _import_started_at)
 
 logging.basicConfig(level=logging.INFO)
 
+ASYNC_PIPELINE = os.getenv('ASYNC_PIPELINE', 'false').lower() == 'true'
+
 class handler(BaseHTTPRequestHandler):
     def do_GET(self):
         """Health check и главная страница"""
@@ -29,11 +39,19 @@ class handler(BaseHTTPRequestHandler):
             self.wfile.write(json.dumps(response).encode())
             return
         
+        # Метрики в памяти инстанса, поэтому отдаются той же функцией,
+        # что обрабатывает апдейты
+        if urlsplit(self.path).path == '/metrics':
+            self._send_metrics()
+            return
+        
         self.send_response(404)
         self.end_headers()
     
     def do_POST(self):
         """Обработка всех POST запросов"""
+        started_at = time.monotonic()
+        claimed_update_id = None
         try:
             content_length = int(self.headers['Content-Length'])
             post_data = self.rfile.read(content_length)
@@ -41,9 +59,16 @@ class handler(BaseHTTPRequestHandler):
             
             logging.info(f"📨 Received update: {update.keys()}")
             
+            # Telegram повторяет доставку при медленном ответе или ошибке
+            if update_deduplicator.is_duplicate(update.get('update_id')):
+                logging.info(f"⏭️ Duplicate update skipped: {update.get('update_id')}")
+                self._send_response(200, {"status": "duplicate"})
+                return
+            claimed_update_id = update.get('update_id')
+            
             # Обработка callback от кнопок
             if 'callback_query' in update:
-                handle_callback_query(update['callback_query'])
+                timed_import('lib.callback_handler').dispatch_callback_query(update['callback_query'])
                 self._send_response(200, {"status": "callback_processed"})
                 return
             
@@ -59,16 +84,30 @@ class handler(BaseHTTPRequestHandler):
                     return
                 
                 # Фото документов
+                if 'photo' in message and message.get('media_group_id'):
+                    # Страницы альбома обрабатываются вместе, одной сессией
+                    timed_import('lib.album').album_collector.add(
+                        chat_id, message['media_group_id'], message.get('message_id', 0), message['photo']
+                    )
+                    self._send_response(200, {"status": "album_buffered"})
+                    return
+                
                 if 'photo' in message:
-                    self._handle_photo_async(chat_id, message['photo'])
-                    self._send_response(200, {"status": "photo_processing"})
+                    if self._handle_photo_async(chat_id, message['photo']):
+                        self._send_response(200, {"status": "photo_processing"})
+                    else:
+                        self._send_response(200, {"status": "busy"})
                     return
             
             self._send_response(200, {"status": "ok"})
             
         except Exception as e:
             logging.error(f"❌ Error in webhook: {e}")
+            # Telegram повторит доставку после 500 - она не должна стать дубликатом
+            update_deduplicator.release(claimed_update_id)
             self._send_response(500, {"error": str(e)})
+        finally:
+            tracer.record('webhook.update', time.monotonic() - started_at)
     
     def _send_response(self, code, data):
         """Утилита для отправки ответов"""
@@ -77,109 +116,115 @@ class handler(BaseHTTPRequestHandler):
         self.end_headers()
         self.wfile.write(json.dumps(data).encode())
     
+    def _send_metrics(self):
+        """Перцентили спанов и состояние очередей/кэшей; ?session=<id> - трейс сессии"""
+        token = os.getenv('METRICS_TOKEN')
+        if token and self.headers.get('Authorization') != f"Bearer {token}":
+            self._send_response(401, {"error": "unauthorized"})
+            return
+        
+        session_id = parse_qs(urlsplit(self.path).query).get('session', [None])[0]
+        if session_id:
+            self._send_response(200, {"session": session_id, "spans": tracer.session_trace(session_id)})
+            return
+        
+        # Импорт тут, а не в начале модуля: метрики не должны тянуть
+        # тяжелые модули в обычную обработку апдейтов
+        from lib.cache import ocr_cache, analysis_cache
+        from lib.audit_log import audit_log
+        from lib.bitrix import bitrix_queue
+        from lib.ocr import get_backends
+        from lib.rate_limiter import telegram_limiter
+        
+        # Спаны import.* и init.* - стоимость холодного старта по модулям
+        self._send_response(200, {
+            "spans": tracer.stats(),
+            "executors": {
+                executor.name: executor.stats()
+                for executor in (photo_executor, archive_executor, callback_executor)
+            },
+            "caches": {
+                "ocr": ocr_cache.stats(),
+                "analysis": analysis_cache.stats()
+            },
+            "ocr_backends": {
+                backend.name: backend.breaker.state
+                for backend in get_backends(os.getenv('OCR_SPACE_API_KEY'))
+            },
+            "audit_log": audit_log.stats(),
+            "bitrix_queue": {"pending": bitrix_queue.pending()},
+            "telegram_limiter": telegram_limiter.stats(),
+            "duplicates": update_deduplicator.duplicates
+        })
+    
     def _handle_text_message(self, chat_id, text):
         """Обработка текстовых сообщений для редактирования"""
         try:
             # Ищем активную сессию с ожиданием редактирования
-            sessions = supabase_client.supabase.table('sessions')\
-                .select('*')\
-                .eq('chat_id', chat_id)\
-                .eq('status', 'awaiting_edit')\
-                .execute()
+            session = supabase_client.get_awaiting_edit_session(chat_id)
             
-            if sessions.data:
-                session = sessions.data[0]
+            if session:
                 field_to_edit = session.get('field_to_edit')
                 
                 if field_to_edit:
-                    # Обновляем данные в сессии
-                    parsed_data = session['parsed_data']
-                    parsed_data[field_to_edit] = text
+                    # Правка применяется к актуальной строке: если кэш устарел,
+                    # update_session вызовет ее еще раз для свежих parsed_data
+                    def apply_edit(current):
+                        parsed_data = dict(current['parsed_data'])
+                        parsed_data[current.get('field_to_edit') or field_to_edit] = text
+                        return {
+                            'parsed_data': parsed_data,
+                            'status': 'editing',
+                            'field_to_edit': None
+                        }
                     
-                    supabase_client.update_session(session['id'], {
-                        'parsed_data': parsed_data,
-                        'status': 'editing',
-                        'field_to_edit': None
-                    })
+                    updated = supabase_client.update_session(session['id'], apply_edit)
+                    if not updated:
+                        telegram_service.send_message(chat_id, "❌ Не удалось сохранить значение, попробуйте еще раз")
+                        return
                     
                     # Показываем обновленные данные
-                    telegram = TelegramService()
-                    telegram.send_edit_view(chat_id, session['id'], parsed_data)
+                    telegram_service.send_edit_view(chat_id, session['id'], updated['parsed_data'])
                     
         except Exception as e:
             logging.error(f"❌ Error handling text message: {e}")
     
     def _handle_photo_async(self, chat_id, photos):
-        """Асинхронная обработка фото"""
-        thread = threading.Thread(
-            target=self._process_photo, 
-            args=(chat_id, photos)
+        """Асинхронная обработка фото в ограниченном пуле потоков"""
+        if photo_executor.submit(self._process_photo, chat_id, photos):
+            return True
+        
+        telegram_service.send_message(
+            chat_id, "⏳ Сейчас много фото в обработке. Отправьте фото еще раз через минуту."
         )
-        thread.start()
+        return False
     
     def _process_photo(self, chat_id, photos):
         """Обработка фото документа"""
+        # Все статусы обработки - правки одного сообщения
+        status = ProgressMessage(telegram_service, chat_id)
         try:
-            telegram = TelegramService()
-            ocr = OCRService()
-            deepseek = DeepSeekService()
+            if ASYNC_PIPELINE:
+                timed_import('lib.async_pipeline').run_photo_pipeline(chat_id, photos)
+                return
             
-            telegram.send_message(chat_id, "📥 Загружаю фото...")
+            jobs = timed_import('lib.jobs')
+            status.update("📥 Загружаю фото...")
             
             # Создаем сессию в Supabase
             session = supabase_client.create_session(chat_id)
             if not session:
-                telegram.send_message(chat_id, "❌ Ошибка создания сессии")
-                return
-            
-            session_id = session['id']
-            
-            # Берем фото среднего качества
-            photo = photos[-2] if len(photos) >= 2 else photos[-1]
-            file_id = photo['file_id']
-            
-            # Скачиваем и сохраняем в Supabase Storage
-            file_url = telegram.download_and_store_file(file_id, session_id)
-            if not file_url:
-                telegram.send_message(chat_id, "❌ Ошибка загрузки файла")
+                status.finish("❌ Ошибка создания сессии")
                 return
             
-            telegram.send_message(chat_id, "🔍 Распознаю текст...")
-            
-            # Извлекаем текст через OCR
-            extracted_text = ocr.extract_text_from_url(file_url, session_id)
-            if not extracted_text:
-                telegram.send_message(
-                    chat_id, 
-                    "❌ Не удалось распознать текст. Попробуйте другое фото."
-                )
-                return
-            
-            telegram.send_message(chat_id, "🤖 Анализирую документ...")
-            
-            # Анализируем через DeepSeek
-            analysis_result = deepseek.analyze_text(extracted_text)
-            
-            # Парсим и сохраняем результат
-            parsed_data = parse_extracted_data(analysis_result)
-            
-            supabase_client.update_session(session_id, {
-                'extracted_data': analysis_result,
-                'parsed_data': parsed_data,
-                'status': 'pending_verification'
-            })
-            
-            # Показываем результаты
-            formatted_data = format_data_for_display(parsed_data)
-            telegram.send_message(
-                chat_id,
-                f"{formatted_data}\n\n<b>Проверьте данные:</b>",
-                telegram.create_verification_buttons(session_id)
-            )
+            # Берем самое маленькое фото, достаточное для OCR
+            photo, fallback_photo = timed_import('lib.preprocess').image_preprocessor.select_photo(photos)
             
-            logging.info(f"✅ Photo processed for chat {chat_id}, session {session_id}")
+            # Задача сохраняется в photo_jobs, чтобы прерванную обработку
+            # можно было продолжить с последнего завершенного этапа
+            job = jobs.photo_jobs.enqueue(session['id'], chat_id, photo, fallback_photo)
+            jobs.PhotoJobRunner().run(job, status)
             
         except Exception as e:
             logging.error(f"❌ Error processing photo: {e}")
-            telegram = TelegramService()
-            telegram.send_message(chat_id, "❌ Произошла ошибка при обработке фото")
+            status.finish("❌ Произошла ошибка при обработке фото")
@@ -0,0 +1,89 @@
+"""Микробенчмарк декодирования callback_data и выбора обработчика:
+таблица CALLBACK_HANDLERS против прежней цепочки startswith.
+
+    python -m bench.callback_bench --repeat 200000
+
+Обработчики подменяются пустыми функциями - замеряется только маршрутизация.
+"""
+import os
+import sys
+import time
+import uuid
+import logging
+import argparse
+from functools import partial
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+from lib.callback_data import ACTIONS, encode_callback
+from lib.callback_handler import CALLBACK_HANDLERS, route_callback
+from utils.fields import FIELD_NAMES
+
+
+def noop(*args):
+    pass
+
+
+def legacy_route(chat_id, callback_data, username):
+    """Прежний разбор из handle_callback_query"""
+    if callback_data.startswith('verify_ok_'):
+        noop(chat_id, callback_data.replace('verify_ok_', ''), username)
+    elif callback_data.startswith('verify_edit_'):
+        noop(chat_id, callback_data.replace('verify_edit_', ''))
+    elif callback_data.startswith('edit_field_'):
+        parts = callback_data.split('_')
+        noop(chat_id, parts[2], '_'.join(parts[3:]))
+    elif callback_data.startswith('edit_done_'):
+        noop(chat_id, callback_data.replace('edit_done_', ''))
+    elif callback_data.startswith('edit_ok_'):
+        noop(chat_id, callback_data.replace('edit_ok_', ''), username)
+
+
+def samples() -> list:
+    """(действие, поле) для всех кнопок бота"""
+    return [(action, None) for action in ACTIONS if action != 'edit_field'] + \
+        [('edit_field', field) for field in FIELD_NAMES]
+
+
+def measure(route, payloads: list, repeat: int, rounds: int = 5) -> float:
+    """Лучшее из rounds время одного вызова, мкс"""
+    best = None
+    for _ in range(rounds):
+        started_at = time.perf_counter()
+        for _ in range(repeat):
+            for data in payloads:
+                route(1, data, 'bench')
+        elapsed = time.perf_counter() - started_at
+        best = elapsed if best is None else min(best, elapsed)
+    return best / (repeat * len(payloads)) * 1e6
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=5000, help='прогонов набора кнопок')
+    args = parser.parse_args(argv)
+    logging.disable(logging.WARNING)
+
+    session_id = str(uuid.uuid4())
+    buttons = samples()
+    encoded = [encode_callback(action, session_id, field) for action, field in buttons]
+    legacy = [f"{action}_{session_id}" + (f"_{field}" if field else '') for action, field in buttons]
+
+    handlers = {action: (noop, params) for action, (_, params) in CALLBACK_HANDLERS.items()}
+    report = {
+        'table': measure(partial(route_callback, handlers=handlers), encoded, args.repeat),
+        'table_legacy_data': measure(partial(route_callback, handlers=handlers), legacy, args.repeat),
+        'startswith': measure(legacy_route, legacy, args.repeat)
+    }
+
+    print(f"callback_data: {max(len(data.encode()) for data in encoded)} байт "
+          f"(было до {max(len(data.encode()) for data in legacy)})")
+    for name, us in report.items():
+        print(f"{name:<18} {us:.2f} us")
+    return report
+
+
+if __name__ == '__main__':
+    main()
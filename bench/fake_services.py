@@ -0,0 +1,480 @@
+"""Локальные заглушки Telegram Bot API, OCR.space, DeepSeek, Supabase и Битрикс24.
+
+Каждый сервис - отдельный ThreadingHTTPServer на 127.0.0.1 со своей
+задержкой, разбросом и долей ошибок, чтобы бенчмарк мог менять профиль
+любой зависимости независимо от остальных.
+"""
+import json
+import time
+import uuid
+import random
+import threading
+import itertools
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qsl
+
+DEFAULT_OCR_TEXT = """МАРШРУТНАЯ КАРТА
+Участок: 12 механический
+Корпус редуктора РЦ-{n}
+ТМГ.1000.2234.{n}
+Зав. № 0457-{n}
+Операция 005 Заготовительная
+Операция 010 Токарная
+Операция 015 Фрезерная
+"""
+
+DEFAULT_LLM_ANSWER = """Участок: 12 механический
+Изделие: Корпус редуктора
+Номер чертежа: ТМГ.1000.2234
+Номер изделия: 0457"""
+
+
+def _now() -> str:
+    return datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+
+
+class FakeService:
+    """Базовый фейковый сервис: задержка, ошибки и счетчики запросов"""
+
+    name = 'fake'
+
+    def __init__(self, latency: float = 0.0, jitter: float = 0.2, error_rate: float = 0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.requests = {}
+        self.errors = 0
+        self._lock = threading.Lock()
+        self.server = None
+        self.url = None
+
+    def start(self):
+        service = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                service._serve(self, 'GET')
+
+            def do_POST(self):
+                service._serve(self, 'POST')
+
+            def do_PATCH(self):
+                service._serve(self, 'PATCH')
+
+            def do_DELETE(self):
+                service._serve(self, 'DELETE')
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        threading.Thread(target=self.server.serve_forever, name=f"fake-{self.name}", daemon=True).start()
+        return self
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+
+    def _serve(self, request, method: str):
+        parts = urlsplit(request.path)
+        length = int(request.headers.get('Content-Length') or 0)
+        body = request.rfile.read(length) if length else b''
+
+        endpoint = self.endpoint(method, parts.path)
+        with self._lock:
+            self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+
+        if self.latency:
+            time.sleep(max(0.0, self.latency * random.uniform(1 - self.jitter, 1 + self.jitter)))
+
+        if self.error_rate and random.random() < self.error_rate:
+            with self._lock:
+                self.errors += 1
+            status, content_type, payload = 500, 'application/json', {'error': 'fake failure'}
+        else:
+            status, content_type, payload = self.handle(
+                method, parts.path, dict(parse_qsl(parts.query)), request.headers, body
+            )
+
+        if isinstance(payload, (dict, list)):
+            payload = json.dumps(payload, ensure_ascii=False).encode()
+        elif isinstance(payload, str):
+            payload = payload.encode()
+
+        request.send_response(status)
+        request.send_header('Content-Type', content_type)
+        request.send_header('Content-Length', str(len(payload)))
+        request.end_headers()
+        request.wfile.write(payload)
+
+    def endpoint(self, method: str, path: str) -> str:
+        return f"{method} {path}"
+
+    def handle(self, method, path, query, headers, body):
+        raise NotImplementedError
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'requests': dict(self.requests), 'errors': self.errors}
+
+
+class FakeTelegram(FakeService):
+    """Bot API: getFile, скачивание файла, sendMessage/editMessageText/answerCallbackQuery.
+
+    Все исходящие сообщения сохраняются по chat_id - по ним бенчмарк
+    определяет, когда апдейт обработан.
+    """
+
+    name = 'telegram'
+
+    def __init__(self, image: bytes, rate_limit_rate: float = 0.0, retry_after: int = 1, **kwargs):
+        super().__init__(**kwargs)
+        self.image = image
+        # Доля sendMessage/editMessageText, на которые отвечаем 429
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        self.rate_limited = 0
+        self.messages = {}
+        self._message_ids = itertools.count(1000)
+
+    def endpoint(self, method, path):
+        if path.startswith('/file/'):
+            return 'file'
+        return path.rsplit('/', 1)[-1]
+
+    def handle(self, method, path, query, headers, body):
+        if path.startswith('/file/'):
+            return 200, 'image/jpeg', self.image
+
+        api_method = path.rsplit('/', 1)[-1]
+        params = _parse_body(headers, body)
+
+        if api_method == 'getFile':
+            file_id = params.get('file_id', 'file')
+            return 200, 'application/json', {
+                'ok': True,
+                'result': {'file_id': file_id, 'file_path': f"photos/{file_id}.jpg"}
+            }
+
+        if api_method in ('sendMessage', 'editMessageText'):
+            if self.rate_limit_rate and random.random() < self.rate_limit_rate:
+                with self._lock:
+                    self.rate_limited += 1
+                return 429, 'application/json', {
+                    'ok': False,
+                    'error_code': 429,
+                    'description': f"Too Many Requests: retry after {self.retry_after}",
+                    'parameters': {'retry_after': self.retry_after}
+                }
+            message_id = params.get('message_id') or next(self._message_ids)
+            chat_id = int(params.get('chat_id', 0))
+            with self._lock:
+                self.messages.setdefault(chat_id, []).append(
+                    (time.monotonic(), api_method, params.get('text', ''), params.get('reply_markup'))
+                )
+            return 200, 'application/json', {'ok': True, 'result': {'message_id': message_id}}
+
+        if api_method == 'answerCallbackQuery':
+            return 200, 'application/json', {'ok': True, 'result': True}
+
+        return 404, 'application/json', {'ok': False, 'description': f"Unknown method {api_method}"}
+
+    def chat_messages(self, chat_id: int) -> list:
+        with self._lock:
+            return list(self.messages.get(chat_id, []))
+
+    def stats(self) -> dict:
+        stats = super().stats()
+        stats['rate_limited'] = self.rate_limited
+        return stats
+
+
+class FakeOCRSpace(FakeService):
+    """OCR.space /parse/image; {n} в тексте заменяется номером запроса,
+    чтобы кэш анализа не срабатывал на одинаковом тексте"""
+
+    name = 'ocr'
+
+    def __init__(self, text: str = DEFAULT_OCR_TEXT, **kwargs):
+        super().__init__(**kwargs)
+        self.text = text
+        self._counter = itertools.count(1)
+
+    def handle(self, method, path, query, headers, body):
+        text = self.text.replace('{n}', str(next(self._counter)))
+        return 200, 'application/json', {
+            'IsErroredOnProcessing': False,
+            'ParsedResults': [{'ParsedText': text}]
+        }
+
+
+class FakeDeepSeek(FakeService):
+    """chat/completions, обычный ответ и SSE при stream=true"""
+
+    name = 'deepseek'
+
+    def __init__(self, answer: str = DEFAULT_LLM_ANSWER, **kwargs):
+        super().__init__(**kwargs)
+        self.answer = answer
+
+    def handle(self, method, path, query, headers, body):
+        payload = json.loads(body or b'{}')
+        if not payload.get('stream'):
+            return 200, 'application/json', {
+                'choices': [{'message': {'role': 'assistant', 'content': self.answer}}]
+            }
+
+        events = []
+        for line in self.answer.splitlines(keepends=True):
+            chunk = {'choices': [{'delta': {'content': line}}]}
+            events.append(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n")
+        events.append("data: [DONE]\n\n")
+        return 200, 'text/event-stream', ''.join(events)
+
+
+class UnsupportedFilter(ValueError):
+    pass
+
+
+class FakeSupabase(FakeService):
+    """PostgREST (/rest/v1/<таблица>) и Storage (/storage/v1/object/...) в памяти.
+
+    Поддерживаются фильтры eq/neq/in/lt/lte/gt/gte/is, их отрицание через not.,
+    order и limit - то, что использует lib/. На or/and и другие операторы
+    заглушка отвечает 400, а не пропускает фильтр молча. Значение 'now()'
+    заменяется текущим временем.
+    """
+
+    name = 'supabase'
+
+    PRIMARY_KEYS = {
+        'sessions': 'id',
+        'photo_jobs': 'id',
+        'processed_updates': 'update_id',
+    }
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.tables = {}
+        self.files = {}
+
+    def endpoint(self, method, path):
+        if path.startswith('/storage/'):
+            return f"{method} storage"
+        return f"{method} {path.rsplit('/', 1)[-1]}"
+
+    def seed(self, table: str, row: dict) -> dict:
+        row = self._fill_defaults(table, dict(row))
+        with self._lock:
+            self.tables.setdefault(table, []).append(row)
+        return row
+
+    def handle(self, method, path, query, headers, body):
+        if path.startswith('/storage/'):
+            return self._storage(method, path, body)
+
+        table = path.rsplit('/', 1)[-1]
+        with self._lock:
+            rows = self.tables.setdefault(table, [])
+
+            if method == 'POST':
+                payload = json.loads(body or b'[]')
+                items = payload if isinstance(payload, list) else [payload]
+                upsert = 'merge-duplicates' in (headers.get('Prefer') or '')
+                inserted = []
+                for item in items:
+                    item = self._fill_defaults(table, item)
+                    key = self.PRIMARY_KEYS.get(table)
+                    existing = next((row for row in rows if key and row.get(key) == item.get(key)), None)
+                    if existing is not None:
+                        if not upsert:
+                            return 409, 'application/json', {
+                                'code': '23505',
+                                'message': 'duplicate key value violates unique constraint'
+                            }
+                        existing.update(item)
+                        inserted.append(existing)
+                        continue
+                    rows.append(item)
+                    inserted.append(item)
+                return 201, 'application/json', inserted
+
+            try:
+                matched = [row for row in rows if self._matches(row, query)]
+            except UnsupportedFilter as e:
+                return 400, 'application/json', {'code': 'PGRST100', 'message': f"unsupported filter: {e}"}
+
+            if method == 'GET':
+                return 200, 'application/json', self._order_and_limit(matched, query)
+
+            if method == 'PATCH':
+                updates = self._resolve(json.loads(body or b'{}'))
+                for row in matched:
+                    row.update(updates)
+                return 200, 'application/json', matched
+
+            if method == 'DELETE':
+                self.tables[table] = [row for row in rows if row not in matched]
+                return 200, 'application/json', matched
+
+        return 405, 'application/json', {'message': 'method not allowed'}
+
+    def _storage(self, method, path, body):
+        if '/public/' in path and method == 'GET':
+            content = self.files.get(path.split('/public/', 1)[1])
+            if content is None:
+                return 404, 'application/json', {'error': 'not found'}
+            return 200, 'image/jpeg', content
+
+        if '/object/list/' in path:
+            bucket = path.split('/object/list/', 1)[1]
+            prefix = f"{bucket}/{json.loads(body or b'{}').get('prefix', '')}".rstrip('/') + '/'
+            with self._lock:
+                names = [key[len(prefix):] for key in self.files if key.startswith(prefix)]
+            return 200, 'application/json', [{'name': name} for name in names if '/' not in name]
+
+        if method == 'DELETE':
+            bucket = path.split('/object/', 1)[1].strip('/')
+            removed = []
+            with self._lock:
+                for name in json.loads(body or b'{}').get('prefixes', []):
+                    if self.files.pop(f"{bucket}/{name}", None) is not None:
+                        removed.append({'name': name})
+            return 200, 'application/json', removed
+
+        key = path.split('/object/', 1)[-1]
+        with self._lock:
+            self.files[key] = body
+        return 200, 'application/json', {'Key': key}
+
+    def _fill_defaults(self, table: str, row: dict) -> dict:
+        row = self._resolve(row)
+        if self.PRIMARY_KEYS.get(table) == 'id':
+            row.setdefault('id', str(uuid.uuid4()))
+        row.setdefault('created_at', _now())
+        row.setdefault('updated_at', row['created_at'])
+        return row
+
+    @staticmethod
+    def _resolve(row: dict) -> dict:
+        return {key: _now() if value == 'now()' else value for key, value in row.items()}
+
+    @classmethod
+    def _matches(cls, row: dict, query: dict) -> bool:
+        for column, condition in query.items():
+            if column in ('select', 'order', 'limit', 'offset', 'on_conflict', 'columns'):
+                continue
+            if column in ('or', 'and'):
+                raise UnsupportedFilter(f"{column}={condition}")
+
+            negate = condition.startswith('not.')
+            operator, _, value = condition[4 if negate else 0:].partition('.')
+            result = cls._compare(row.get(column), operator, value, condition)
+            # Как в SQL: сравнение с NULL не истинно ни само, ни под NOT
+            if result is None or result == negate:
+                return False
+        return True
+
+    @staticmethod
+    def _compare(current, operator: str, value: str, condition: str):
+        """True/False или None, если current - NULL, а оператор не is"""
+        if operator == 'is':
+            if value not in ('null', 'true', 'false'):
+                raise UnsupportedFilter(condition)
+            return current is None if value == 'null' else current is (value == 'true')
+        if operator not in ('eq', 'neq', 'in', 'lt', 'lte', 'gt', 'gte'):
+            raise UnsupportedFilter(condition)
+        if current is None:
+            return None
+
+        current = str(current)
+        if operator == 'eq':
+            return current == value
+        if operator == 'neq':
+            return current != value
+        if operator == 'in':
+            return current in [item.strip('"') for item in value.strip('()').split(',')]
+        if operator == 'lt':
+            return current < value
+        if operator == 'lte':
+            return current <= value
+        if operator == 'gt':
+            return current > value
+        return current >= value
+
+    @staticmethod
+    def _order_and_limit(rows: list, query: dict) -> list:
+        if query.get('order'):
+            column, _, direction = query['order'].partition('.')
+            rows = sorted(rows, key=lambda row: str(row.get(column) or ''), reverse=direction.startswith('desc'))
+        if query.get('limit'):
+            rows = rows[:int(query['limit'])]
+        return rows
+
+
+class FakeBitrix(FakeService):
+    """crm.item.add и batch"""
+
+    name = 'bitrix'
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._ids = itertools.count(1)
+
+    def endpoint(self, method, path):
+        return path.rsplit('/', 1)[-1]
+
+    def handle(self, method, path, query, headers, body):
+        if path.endswith('/batch.json'):
+            commands = json.loads(body or b'{}').get('cmd', {})
+            return 200, 'application/json', {
+                'result': {
+                    'result': {key: {'item': {'id': next(self._ids)}} for key in commands},
+                    'result_error': []
+                }
+            }
+        return 200, 'application/json', {'result': {'item': {'id': next(self._ids)}}}
+
+
+def _parse_body(headers, body: bytes) -> dict:
+    if not body:
+        return {}
+    if 'json' in (headers.get('Content-Type') or ''):
+        return json.loads(body)
+    return dict(parse_qsl(body.decode('utf-8')))
+
+
+def start_fake_services(profiles: dict, image: bytes, ocr_text: str = DEFAULT_OCR_TEXT,
+                        llm_answer: str = DEFAULT_LLM_ANSWER) -> dict:
+    """profiles: {имя сервиса: {'latency': ..., 'jitter': ..., 'error_rate': ...}}"""
+    services = {
+        'telegram': FakeTelegram(image, **profiles.get('telegram', {})),
+        'ocr': FakeOCRSpace(ocr_text, **profiles.get('ocr', {})),
+        'deepseek': FakeDeepSeek(llm_answer, **profiles.get('deepseek', {})),
+        'supabase': FakeSupabase(**profiles.get('supabase', {})),
+        'bitrix': FakeBitrix(**profiles.get('bitrix', {})),
+    }
+    for service in services.values():
+        service.start()
+    return services
+
+
+def service_env(services: dict) -> dict:
+    """Переменные окружения, направляющие lib/ на заглушки"""
+    return {
+        'TELEGRAM_BOT_TOKEN': 'bench-token',
+        'TELEGRAM_API_BASE': services['telegram'].url,
+        'OCR_SPACE_API_KEY': 'bench-key',
+        'OCR_SPACE_API_URL': f"{services['ocr'].url}/parse/image",
+        'DEEPSEEK_API_KEY': 'bench-key',
+        'DEEPSEEK_API_URL': f"{services['deepseek'].url}/v1/chat/completions",
+        'SUPABASE_URL': services['supabase'].url,
+        'SUPABASE_SERVICE_KEY': 'bench.service.key',
+        'BITRIX24_WEBHOOK_URL': f"{services['bitrix'].url}/rest/1/bench/crm.item.add.json",
+    }
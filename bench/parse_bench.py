@@ -0,0 +1,94 @@
+"""Бенчмарк разбора ответов DeepSeek на корпусе bench/llm_answers.json:
+сколько полей разобрано верно и сколько стоит один разбор, в сравнении
+с прежним разбором по startswith.
+
+    python -m bench.parse_bench --repeat 2000 --corpus my_answers.json
+"""
+import os
+import sys
+import json
+import time
+import argparse
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+from utils.fields import FIELD_NAMES, empty_data
+from utils.formatters import parse_extracted_data, parse_extracted_fields
+
+
+def legacy_parse(text):
+    """Прежний parse_extracted_data: startswith/replace по каждому полю"""
+    data = empty_data()
+    for line in text.split('\n'):
+        line = line.strip()
+        for field in FIELD_NAMES:
+            if line.startswith(f'{field}:'):
+                data[field] = line.replace(f'{field}:', '').strip()
+                break
+    return data
+
+
+def evaluate(parse, corpus: list, repeat: int) -> dict:
+    misses = 0
+    for sample in corpus:
+        parsed = parse(sample['answer'])
+        misses += sum(parsed[field] != sample['expected'][field] for field in FIELD_NAMES)
+
+    started_at = time.perf_counter()
+    for _ in range(repeat):
+        for sample in corpus:
+            parse(sample['answer'])
+    elapsed = time.perf_counter() - started_at
+
+    total = len(corpus) * len(FIELD_NAMES)
+    return {
+        'fields': total,
+        'correct': total - misses,
+        'misses': misses,
+        'us_per_parse': round(elapsed / (repeat * len(corpus)) * 1e6, 2)
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--corpus', default=os.path.join(os.path.dirname(__file__), 'llm_answers.json'))
+    parser.add_argument('--repeat', type=int, default=1000, help='прогонов корпуса для замера времени')
+    parser.add_argument('--verbose', action='store_true', help='показать поля, разобранные неверно')
+    args = parser.parse_args(argv)
+
+    with open(args.corpus, encoding='utf-8') as f:
+        corpus = json.load(f)
+
+    report = {
+        'legacy': evaluate(legacy_parse, corpus, args.repeat),
+        'compiled': evaluate(parse_extracted_data, corpus, args.repeat)
+    }
+
+    print(f"{'parser':<10} {'correct':>12} {'misses':>7} {'us/parse':>9}")
+    for name, row in report.items():
+        print(f"{name:<10} {row['correct']:>5}/{row['fields']:<6} {row['misses']:>7} {row['us_per_parse']:>9}")
+
+    confidences = [
+        parsed['confidence']
+        for sample in corpus
+        for parsed in parse_extracted_fields(sample['answer']).values()
+        if parsed['confidence'] > 0
+    ]
+    if confidences:
+        print(f"\nуверенность найденных полей: min {min(confidences)}, "
+              f"средняя {sum(confidences) / len(confidences):.2f}")
+
+    if args.verbose:
+        for number, sample in enumerate(corpus):
+            parsed = parse_extracted_data(sample['answer'])
+            for field in FIELD_NAMES:
+                if parsed[field] != sample['expected'][field]:
+                    print(f"#{number} {field}: {parsed[field]!r} != {sample['expected'][field]!r}")
+
+    return report
+
+
+if __name__ == '__main__':
+    main()
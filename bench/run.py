@@ -0,0 +1,390 @@
+"""Офлайн-бенчмарк webhook: апдейты из updates.json проигрываются в
+api/webhook.handler с заданной частотой, внешние сервисы - заглушки из
+fake_services.py.
+
+    python -m bench.run --count 200 --rate 20 --latency ocr=1.5,deepseek=0.8 --error-rate ocr=0.05
+
+Апдейт считается обработанным, когда в его чат ушло сообщение с одной из
+строк expect шаблона; сообщение, начинающееся с "❌", - ошибка.
+
+Прогон завершается с кодом 1, если какой-то тип апдейтов не обработан ни
+разу или доля ошибок и таймаутов больше --max-error-rate.
+"""
+import io
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import logging
+import resource
+import threading
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+import requests
+from bench.fake_services import start_fake_services, service_env, DEFAULT_OCR_TEXT, DEFAULT_LLM_ANSWER
+from lib.callback_data import encode_callback
+
+SERVICES = ('telegram', 'ocr', 'deepseek', 'supabase', 'bitrix')
+
+DEFAULT_LATENCY = 'telegram=0.05,ocr=1.2,deepseek=0.8,supabase=0.03,bitrix=0.2'
+
+DEFAULT_PARSED_DATA = {
+    'Участок': '12 механический',
+    'Изделие': 'Корпус редуктора',
+    'Номер чертежа': 'ТМГ.1000.2234',
+    'Номер изделия': '0457'
+}
+
+
+def parse_service_map(value: str) -> dict:
+    """'ocr=1.5,deepseek=0.8' -> {'ocr': 1.5, 'deepseek': 0.8}"""
+    result = {}
+    for item in filter(None, (part.strip() for part in (value or '').split(','))):
+        name, raw = item.split('=', 1)
+        if name not in SERVICES:
+            raise SystemExit(f"Unknown service: {name} (expected one of {', '.join(SERVICES)})")
+        result[name] = float(raw)
+    return result
+
+
+def build_image() -> bytes:
+    """JPEG с полосами-строками; без Pillow - произвольные байты"""
+    try:
+        from PIL import Image, ImageDraw
+    except ImportError:
+        return b'\xff\xd8\xff\xe0' + os.urandom(60000) + b'\xff\xd9'
+
+    image = Image.new('L', (1280, 960), 255)
+    draw = ImageDraw.Draw(image)
+    for top in range(40, 940, 36):
+        draw.rectangle((60, top, 60 + random.randint(400, 1100), top + 14), fill=0)
+    output = io.BytesIO()
+    image.save(output, format='JPEG', quality=85)
+    return output.getvalue()
+
+
+def fill(value, values: dict):
+    """Подставляет {chat_id}, {n} и т.п.; строка из одной подстановки целого становится числом"""
+    if isinstance(value, dict):
+        return {key: fill(item, values) for key, item in value.items()}
+    if isinstance(value, list):
+        return [fill(item, values) for item in value]
+    if isinstance(value, str):
+        for key, replacement in values.items():
+            if value == f"{{{key}}}" and isinstance(replacement, int):
+                return replacement
+            value = value.replace(f"{{{key}}}", str(replacement))
+    return value
+
+
+def percentiles(samples: list) -> dict:
+    if not samples:
+        return {'count': 0, 'p50': None, 'p95': None, 'p99': None, 'max': None}
+    samples = sorted(samples)
+    pick = lambda p: round(samples[min(int(len(samples) * p), len(samples) - 1)], 3)
+    return {'count': len(samples), 'p50': pick(0.50), 'p95': pick(0.95), 'p99': pick(0.99), 'max': round(samples[-1], 3)}
+
+
+class ResourceSampler:
+    """Раз в interval секунд снимает число потоков и RSS процесса"""
+
+    def __init__(self, interval: float = 0.1):
+        self.interval = interval
+        self.threads_start = threading.active_count()
+        self.threads_peak = self.threads_start
+        self.rss_start = self.rss()
+        self.rss_peak = self.rss_start
+        self._stop = threading.Event()
+
+    @staticmethod
+    def rss() -> int:
+        """Текущий RSS в байтах (Linux), иначе пиковый из getrusage"""
+        try:
+            with open('/proc/self/statm') as statm:
+                return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+        except (OSError, ValueError):
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    def start(self):
+        threading.Thread(target=self._run, name='bench-sampler', daemon=True).start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.threads_peak = max(self.threads_peak, threading.active_count())
+            self.rss_peak = max(self.rss_peak, self.rss())
+
+
+def build_plan(templates: list, count: int, seed: int) -> list:
+    """count элементов из шаблонов с учетом weight, у каждого свой chat_id"""
+    rng = random.Random(seed)
+    weights = [template.get('weight', 1) for template in templates]
+    return [
+        {'template': template, 'n': n, 'chat_id': 900000 + n}
+        for n, template in enumerate(rng.choices(templates, weights=weights, k=count), start=1)
+    ]
+
+
+def seed_sessions(plan: list, supabase):
+    for item in plan:
+        session = item['template'].get('session')
+        if session is None:
+            continue
+        row = supabase.seed('sessions', {
+            'chat_id': item['chat_id'],
+            'extracted_data': None,
+            'parsed_data': dict(DEFAULT_PARSED_DATA),
+            **session
+        })
+        item['session_id'] = row['id']
+        callback = item['template'].get('callback')
+        if callback:
+            item['callback_data'] = encode_callback(callback[0], row['id'], *callback[1:])
+
+
+def replay(plan: list, webhook_url: str, rate: float, clients: int) -> list:
+    """Отправляет апдейты с частотой rate в секунду, возвращает время ответов webhook"""
+    update_ids = itertools.count(1)
+    sends = []
+    for item in plan:
+        for update in item['template']['updates']:
+            sends.append((item, fill(update, {
+                'update_id': next(update_ids),
+                'chat_id': item['chat_id'],
+                'n': item['n'],
+                'session_id': item.get('session_id', ''),
+                'callback_data': item.get('callback_data', '')
+            })))
+
+    acks = []
+    acks_lock = threading.Lock()
+
+    def post(item, update):
+        started_at = time.monotonic()
+        item.setdefault('sent_at', started_at)
+        try:
+            response = requests.post(webhook_url, json=update, timeout=60)
+            status = response.status_code
+        except requests.RequestException as e:
+            logging.error(f"❌ Webhook request failed: {e}")
+            status = None
+        with acks_lock:
+            acks.append((time.monotonic() - started_at, status))
+
+    started_at = time.monotonic()
+    with ThreadPoolExecutor(max_workers=clients, thread_name_prefix='bench-client') as pool:
+        for index, (item, update) in enumerate(sends):
+            delay = started_at + index / rate - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            pool.submit(post, item, update)
+    return acks
+
+
+def wait_for_results(plan: list, telegram, timeout: float):
+    deadline = time.monotonic() + timeout
+    pending = list(plan)
+    while pending and time.monotonic() < deadline:
+        still_pending = []
+        for item in pending:
+            expect = item['template']['expect']
+            for sent_at, _, text, _ in telegram.chat_messages(item['chat_id']):
+                if sent_at < item.get('sent_at', 0):
+                    continue
+                if any(marker in text for marker in expect):
+                    item['result'], item['latency'] = 'ok', sent_at - item['sent_at']
+                    break
+                if text.startswith('❌'):
+                    item['result'], item['latency'] = 'error', sent_at - item['sent_at']
+                    break
+            else:
+                still_pending.append(item)
+        pending = still_pending
+        if pending:
+            time.sleep(0.05)
+
+    for item in pending:
+        item['result'] = 'timeout'
+
+
+def build_report(plan, acks, services, sampler, tracer, duration) -> dict:
+    completed = [item for item in plan if item['result'] == 'ok']
+    finished_at = max((item['sent_at'] + item['latency'] for item in completed), default=None)
+    first_sent = min(item['sent_at'] for item in plan)
+    elapsed = (finished_at - first_sent) if finished_at else None
+
+    kinds = {}
+    for item in plan:
+        kinds.setdefault(item['template']['kind'], []).append(item)
+
+    return {
+        'updates': len(acks),
+        'items': len(plan),
+        'completed': len(completed),
+        'errors': sum(item['result'] == 'error' for item in plan),
+        'timeouts': sum(item['result'] == 'timeout' for item in plan),
+        'send_duration': round(duration, 3),
+        'throughput': round(len(completed) / elapsed, 3) if elapsed else 0.0,
+        'webhook_ack': percentiles([ack for ack, _ in acks]),
+        'webhook_errors': sum(status != 200 for _, status in acks),
+        'by_kind': {
+            kind: {'items': len(items), 'completed': sum(item['result'] == 'ok' for item in items)}
+            for kind, items in sorted(kinds.items())
+        },
+        'end_to_end': {
+            kind: percentiles([item['latency'] for item in items if item['result'] == 'ok'])
+            for kind, items in sorted(kinds.items())
+        },
+        'stages': tracer.stats(),
+        'services': {name: service.stats() for name, service in services.items()},
+        'threads': {'start': sampler.threads_start, 'peak': sampler.threads_peak},
+        'rss_mb': {
+            'start': round(sampler.rss_start / 2 ** 20, 1),
+            'peak': round(sampler.rss_peak / 2 ** 20, 1)
+        }
+    }
+
+
+def check_report(report: dict, max_error_rate: float) -> list:
+    """Причины считать прогон проваленным; пустой список - прогон прошел"""
+    problems = [
+        f"no {kind} items completed ({stats['items']} sent)"
+        for kind, stats in report['by_kind'].items() if not stats['completed']
+    ]
+    failed = report['errors'] + report['timeouts']
+    if report['items'] and failed / report['items'] > max_error_rate:
+        problems.append(f"{failed} of {report['items']} items failed (max error rate {max_error_rate})")
+    return problems
+
+
+def print_report(report: dict):
+    def row(name, stats):
+        values = ' '.join(
+            f"{stats[key]:>8.3f}" if stats[key] is not None else f"{'-':>8}"
+            for key in ('p50', 'p95', 'p99', 'max')
+        )
+        return f"  {name:<40} {stats['count']:>6} {values}"
+
+    header = f"  {'':<40} {'count':>6} {'p50':>8} {'p95':>8} {'p99':>8} {'max':>8}"
+
+    print(f"\nUpdates sent: {report['updates']} in {report['send_duration']}s "
+          f"({report['items']} items: {report['completed']} ok, "
+          f"{report['errors']} errors, {report['timeouts']} timeouts)")
+    print(f"Throughput: {report['throughput']} completed/s")
+    print(f"Threads: start {report['threads']['start']}, peak {report['threads']['peak']}")
+    print(f"RSS: start {report['rss_mb']['start']} MB, peak {report['rss_mb']['peak']} MB")
+
+    print(f"\nWebhook ack (s), non-200: {report['webhook_errors']}")
+    print(header)
+    print(row('webhook', report['webhook_ack']))
+
+    print("\nEnd-to-end by update kind (s)")
+    print(header)
+    for kind, stats in report['end_to_end'].items():
+        print(row(kind, stats))
+
+    print("\nStages (s)")
+    print(header)
+    for name, stats in report['stages'].items():
+        print(row(name, stats))
+
+    print("\nFake services")
+    for name, stats in report['services'].items():
+        requests_total = sum(stats['requests'].values())
+        limited = f", {stats['rate_limited']} injected 429" if 'rate_limited' in stats else ''
+        print(f"  {name:<10} {requests_total:>6} requests, {stats['errors']} injected errors{limited}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--updates', default=os.path.join(os.path.dirname(__file__), 'updates.json'))
+    parser.add_argument('--count', type=int, default=50, help='число элементов плана (альбом - один элемент)')
+    parser.add_argument('--rate', type=float, default=5, help='апдейтов в секунду')
+    parser.add_argument('--clients', type=int, default=16, help='параллельных HTTP-клиентов')
+    parser.add_argument('--latency', default=DEFAULT_LATENCY, help='задержка сервисов, сек: ocr=1.2,...')
+    parser.add_argument('--jitter', type=float, default=0.2, help='разброс задержки, доля')
+    parser.add_argument('--error-rate', default='', help='доля ответов 500: ocr=0.05,...')
+    parser.add_argument('--telegram-429', type=float, default=0.0, help='доля ответов 429 на сообщения Telegram')
+    parser.add_argument('--ocr-text', help='файл с текстом OCR ({n} - номер запроса)')
+    parser.add_argument('--llm-answer', help='файл с ответом DeepSeek')
+    parser.add_argument('--env', action='append', default=[], help='NAME=value для настроек бота')
+    parser.add_argument('--timeout', type=float, default=120, help='ожидание обработки, сек')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', help='сохранить отчет в файл')
+    parser.add_argument('--max-error-rate', type=float, default=0.5,
+                        help='доля ошибок и таймаутов, выше которой прогон провален')
+    parser.add_argument('--log-level', default='WARNING')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=args.log_level)
+    random.seed(args.seed)
+
+    latency = parse_service_map(args.latency)
+    errors = parse_service_map(args.error_rate)
+    profiles = {
+        name: {'latency': latency.get(name, 0.0), 'jitter': args.jitter, 'error_rate': errors.get(name, 0.0)}
+        for name in SERVICES
+    }
+    profiles['telegram']['rate_limit_rate'] = args.telegram_429
+
+    ocr_text = open(args.ocr_text, encoding='utf-8').read() if args.ocr_text else DEFAULT_OCR_TEXT
+    llm_answer = open(args.llm_answer, encoding='utf-8').read() if args.llm_answer else DEFAULT_LLM_ANSWER
+    services = start_fake_services(profiles, build_image(), ocr_text, llm_answer)
+
+    # Настройки читаются при импорте модулей бота, поэтому окружение - до импорта
+    os.environ.update(service_env(services))
+    for item in args.env:
+        name, value = item.split('=', 1)
+        os.environ[name] = value
+
+    from api.webhook import handler
+    from lib.tracing import tracer
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='bench-webhook', daemon=True).start()
+    webhook_url = f"http://127.0.0.1:{server.server_address[1]}/webhook"
+
+    with open(args.updates, encoding='utf-8') as file:
+        templates = json.load(file)
+    plan = build_plan(templates, args.count, args.seed)
+    seed_sessions(plan, services['supabase'])
+
+    sampler = ResourceSampler().start()
+    send_started_at = time.monotonic()
+    acks = replay(plan, webhook_url, args.rate, args.clients)
+    send_duration = time.monotonic() - send_started_at
+    wait_for_results(plan, services['telegram'], args.timeout)
+    sampler.stop()
+
+    report = build_report(plan, acks, services, sampler, tracer, send_duration)
+    print_report(report)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as file:
+            json.dump(report, file, ensure_ascii=False, indent=2)
+
+    server.shutdown()
+    for service in services.values():
+        service.stop()
+
+    problems = check_report(report, args.max_error_rate)
+    for problem in problems:
+        print(f"\nFAILED: {problem}", file=sys.stderr)
+    if problems:
+        sys.exit(1)
+    return report
+
+
+if __name__ == '__main__':
+    main()
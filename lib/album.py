@@ -0,0 +1,165 @@
+import os
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from lib.telegram import telegram_service, ProgressMessage
+from lib.ocr import ocr_service
+from lib.deepseek import deepseek_service
+from lib.supabase_client import supabase_client
+from lib.extractor import extract_with_fallback
+from lib.preprocess import image_preprocessor
+from lib.workers import photo_executor, archive_executor
+from lib.audit_log import audit_log
+from lib.tracing import tracer, current_session
+from utils.formatters import format_data_for_display
+
+
+class AlbumCollector:
+    """Собирает фото одного media_group_id и обрабатывает их одной сессией.
+
+    Каждое фото альбома приходит отдельным апдейтом; группа обрабатывается,
+    когда ALBUM_WINDOW секунд не приходило новых страниц. Буфер живет в
+    памяти инстанса, поэтому страницы, попавшие на разные инстансы,
+    обрабатываются раздельно.
+
+    Ограничения по сравнению с одиночным фото: у альбома нет задачи в
+    photo_jobs (замерзший инстанс оставит сессию с пустыми полями до
+    /sessions/reap, /jobs/drain её не доделает) и нет кэша OCR - ключи
+    кэша описывают один документ, а не набор страниц.
+    """
+
+    def __init__(self):
+        self.window = float(os.getenv('ALBUM_WINDOW', '1.5'))
+        self.ocr_concurrency = int(os.getenv('ALBUM_OCR_CONCURRENCY', '4'))
+        self._albums = {}
+        self._lock = threading.Lock()
+
+    def add(self, chat_id, media_group_id: str, message_id: int, photos: list):
+        with self._lock:
+            album = self._albums.get(media_group_id)
+            if album is None:
+                album = {'chat_id': chat_id, 'pages': [], 'timer': None}
+                self._albums[media_group_id] = album
+            else:
+                album['timer'].cancel()
+
+            album['pages'].append((message_id, photos))
+            timer = threading.Timer(self.window, self._flush, args=(media_group_id,))
+            timer.daemon = True
+            album['timer'] = timer
+            timer.start()
+
+    def _flush(self, media_group_id: str):
+        with self._lock:
+            album = self._albums.pop(media_group_id, None)
+        if not album:
+            return
+
+        pages = [photos for _, photos in sorted(album['pages'], key=lambda page: page[0])]
+        logging.info(f"📚 Album {media_group_id}: {len(pages)} pages")
+
+        if not photo_executor.submit(self.process, album['chat_id'], pages):
+            telegram_service.send_message(
+                album['chat_id'], "⏳ Сейчас много фото в обработке. Отправьте альбом еще раз через минуту."
+            )
+
+    def process(self, chat_id, pages: list):
+        with tracer.span('album.total'):
+            self._process(chat_id, pages)
+
+    def _process(self, chat_id, pages: list):
+        """Одна сессия, параллельный OCR страниц и один анализ на весь альбом"""
+        telegram = telegram_service
+        status = ProgressMessage(telegram, chat_id)
+        try:
+            ocr = ocr_service
+            deepseek = deepseek_service
+
+            status.update(f"📥 Загружаю альбом ({len(pages)} стр.)...")
+
+            session = supabase_client.create_session(chat_id)
+            if not session:
+                status.finish("❌ Ошибка создания сессии")
+                return
+
+            session_id = session['id']
+            current_session.set(session_id)
+
+            def recognize_page(index, photos):
+                photo, fallback_photo = image_preprocessor.select_photo(photos)
+                file_content, file_path = telegram.download_file(photo['file_id'])
+                if not file_content:
+                    return None
+
+                name = f"page{index + 1}"
+                if not archive_executor.submit(telegram.store_file, file_content, file_path, session_id, name):
+                    telegram.store_file(file_content, file_path, session_id, name)
+                file_url = supabase_client.get_file_url(telegram.storage_path(file_path, session_id, name))
+
+                # Поля карты - в шапке первой страницы, остальные не обрезаем
+                text = ocr.extract_text_from_bytes(
+                    image_preprocessor.process(file_content, crop=index == 0),
+                    file_path.split('/')[-1],
+                    session_id,
+                    file_url
+                )
+                if image_preprocessor.is_low_confidence(text) and fallback_photo['file_id'] != photo['file_id']:
+                    text = recognize_full_size(fallback_photo, text, file_url)
+                return text
+
+            def recognize_full_size(fallback_photo, text, file_url):
+                """Повтор OCR страницы по самому большому фото без обрезки, как в PhotoJobRunner"""
+                logging.info("🔁 Low OCR confidence on album page, retrying with full-size photo")
+                file_content, file_path = telegram.download_file(fallback_photo['file_id'])
+                if not file_content:
+                    return text
+                retry_text = ocr.extract_text_from_bytes(
+                    image_preprocessor.process(file_content, crop=False),
+                    file_path.split('/')[-1],
+                    session_id,
+                    file_url
+                )
+                if retry_text and len(retry_text) > len(text or ''):
+                    return retry_text
+                return text
+
+            status.update("🔍 Распознаю текст...")
+
+            workers = max(1, min(len(pages), self.ocr_concurrency))
+            with tracer.span('album.ocr'), \
+                    ThreadPoolExecutor(max_workers=workers, thread_name_prefix='album-ocr') as pool:
+                texts = list(pool.map(recognize_page, range(len(pages)), pages))
+
+            extracted_text = "\n\n".join(
+                f"--- Страница {index + 1} ---\n{text}" for index, text in enumerate(texts) if text
+            )
+            if not extracted_text:
+                status.finish("❌ Не удалось распознать текст. Попробуйте другое фото.")
+                return
+
+            status.update("🤖 Анализирую документ...")
+
+            with tracer.span('album.analyze'):
+                _, parsed_data, _ = extract_with_fallback(extracted_text, deepseek)
+
+            supabase_client.update_session(session_id, {
+                'parsed_data': parsed_data,
+                'status': 'pending_verification'
+            })
+
+            formatted_data = format_data_for_display(parsed_data)
+            status.finish(
+                f"{formatted_data}\n\n<b>Проверьте данные:</b>",
+                telegram.create_verification_buttons(session_id)
+            )
+
+            logging.info(f"✅ Album processed for chat {chat_id}, session {session_id}")
+
+        except Exception as e:
+            logging.error(f"❌ Error processing album: {e}")
+            status.finish("❌ Произошла ошибка при обработке фото")
+        finally:
+            audit_log.flush()
+
+
+album_collector = AlbumCollector()
@@ -0,0 +1,193 @@
+import os
+import time
+import asyncio
+import logging
+from lib.async_services import (
+    create_async_client,
+    AsyncTelegramService,
+    AsyncOCRService,
+    AsyncDeepSeekService,
+    AsyncSupabaseService,
+)
+from lib.cache import ocr_cache
+from lib.telegram import telegram_service, ProgressMessage
+from lib.extractor import FieldExtractor, plan_extraction, merge_llm_result, llm_failed
+from lib.jobs import photo_jobs
+from lib.audit_log import audit_log
+from lib.tracing import tracer, current_session
+from lib.preprocess import image_preprocessor
+from utils.formatters import parse_extracted_data, format_data_for_display
+from utils.fields import NOT_FOUND
+
+# OCR.space получает ссылку на файл прямо с серверов Telegram и не ждет
+# загрузки в Supabase Storage. Ссылка содержит токен бота, поэтому режим
+# включается явно.
+OCR_FROM_TELEGRAM_URL = os.getenv('ASYNC_OCR_FROM_TELEGRAM_URL', 'false').lower() == 'true'
+
+
+async def _archive(supabase: AsyncSupabaseService, file_content: bytes, storage_path: str):
+    """Загрузка файла в Supabase Storage, возвращает публичный URL"""
+    if not await supabase.upload_file(file_content, storage_path):
+        logging.error("❌ Failed to upload file to Supabase")
+        return None
+    file_url = await supabase.get_file_url(storage_path)
+    logging.info(f"✅ File stored in Supabase: {file_url}")
+    return file_url
+
+
+async def process_photo(chat_id, photos) -> bool:
+    """Асинхронная обработка фото: статусы отправляются без ожидания,
+    OCR может идти параллельно с архивированием файла"""
+    async with create_async_client() as client:
+        telegram = AsyncTelegramService(client)
+        ocr = AsyncOCRService()
+        deepseek = AsyncDeepSeekService(client)
+        supabase = AsyncSupabaseService()
+        background = []
+        # Все статусы и результат - правки одного сообщения, как в PhotoJobRunner
+        status = ProgressMessage(telegram_service, chat_id)
+
+        def notify(text):
+            background.append(asyncio.create_task(asyncio.to_thread(status.update, text)))
+
+        async def fail(text, job=None):
+            if job:
+                await asyncio.to_thread(photo_jobs.fail, job['id'], text)
+            await asyncio.gather(*background, return_exceptions=True)
+            await asyncio.to_thread(status.finish, text)
+            return False
+
+        notify("📥 Загружаю фото...")
+
+        # Создаем сессию в Supabase
+        session = await supabase.create_session(chat_id)
+        if not session:
+            return await fail("❌ Ошибка создания сессии")
+
+        session_id = session['id']
+        # Контекст задачи asyncio.run свой, сбрасывать привязку не нужно
+        current_session.set(session_id)
+
+        # Берем самое маленькое фото, достаточное для OCR
+        photo, fallback_photo = image_preprocessor.select_photo(photos)
+        file_unique_id = photo.get('file_unique_id')
+        content_hash = None
+        job = await asyncio.to_thread(photo_jobs.enqueue, session_id, chat_id, photo, fallback_photo)
+
+        # Повторно присланный документ берем из кэша
+        cached = ocr_cache.get(file_unique_id=file_unique_id)
+
+        if not cached:
+            telegram_file_url, file_path = await telegram.get_file_url(photo['file_id'])
+            file_content = await telegram.download(telegram_file_url) if telegram_file_url else None
+            if not file_content:
+                return await fail("❌ Ошибка загрузки файла", job)
+
+            content_hash = ocr_cache.hash_content(file_content)
+            cached = ocr_cache.get(content_hash=content_hash)
+
+        if cached:
+            extracted_text = cached['extracted_text']
+            analysis_result = cached['analysis_result']
+            parsed_data = parse_extracted_data(analysis_result)
+            await asyncio.to_thread(photo_jobs.save, job['id'], {
+                'stage': 'analyzed', 'analysis_result': analysis_result, 'parsed_data': parsed_data
+            })
+        else:
+            storage_path = telegram.storage_path(file_path, session_id)
+            ocr_content = await asyncio.to_thread(image_preprocessor.process, file_content)
+            # Документ сессии - всегда оригинал, OCR получает подготовленную копию
+            archive = asyncio.create_task(_archive(supabase, file_content, storage_path))
+
+            notify("🔍 Распознаю текст...")
+
+            if ocr.direct_upload:
+                file_url = await supabase.get_file_url(storage_path)
+                extracted_text = await ocr.extract_text_from_bytes(
+                    ocr_content, file_path.split('/')[-1], session_id, file_url
+                )
+            elif OCR_FROM_TELEGRAM_URL:
+                file_url = await supabase.get_file_url(storage_path)
+                extracted_text = await ocr.extract_text_from_url(
+                    telegram_file_url, session_id, log_url=file_url
+                )
+            else:
+                if ocr_content is file_content:
+                    ocr_url = await archive
+                else:
+                    ocr_url = await _archive(supabase, ocr_content, telegram.storage_path('ocr.jpg', session_id, 'ocr'))
+                if not ocr_url:
+                    return await fail("❌ Ошибка загрузки файла", job)
+                file_url = await supabase.get_file_url(storage_path)
+                # Этапы сохраняются как в PhotoJobRunner: /jobs/drain продолжит с последнего
+                await asyncio.to_thread(photo_jobs.save, job['id'], {
+                    'stage': 'downloaded', 'file_url': file_url, 'ocr_url': ocr_url, 'content_hash': content_hash
+                })
+                extracted_text = await ocr.extract_text_from_url(ocr_url, session_id, log_url=file_url)
+
+            if not extracted_text:
+                return await fail("❌ Не удалось распознать текст. Попробуйте другое фото.", job)
+
+            await asyncio.to_thread(photo_jobs.save, job['id'], {
+                'stage': 'ocr_done', 'file_url': file_url, 'content_hash': content_hash, 'extracted_text': extracted_text
+            })
+
+            notify("🤖 Анализирую документ...")
+
+            # Извлекаем поля локально, DeepSeek - только для неуверенных
+            local, parsed_data, missing = plan_extraction(extracted_text)
+            complete = True
+            if missing:
+                analysis = await deepseek.analyze_text(extracted_text, missing)
+                analysis_result, parsed_data = merge_llm_result(local, parsed_data, missing, analysis)
+                complete = not llm_failed(analysis)
+            else:
+                analysis_result = FieldExtractor.to_analysis_text(parsed_data)
+
+            # Кэшируем только успешный анализ: если DeepSeek не ответил, повторная
+            # отправка фото должна снова его спросить
+            if complete and any(value != NOT_FOUND for value in parsed_data.values()):
+                await asyncio.to_thread(
+                    ocr_cache.put,
+                    {'extracted_text': extracted_text, 'analysis_result': analysis_result},
+                    file_unique_id,
+                    content_hash,
+                    session_id
+                )
+
+            await asyncio.to_thread(photo_jobs.save, job['id'], {
+                'stage': 'analyzed', 'analysis_result': analysis_result, 'parsed_data': parsed_data
+            })
+
+            started_at = time.monotonic()
+            await archive
+            if ocr.direct_upload:
+                logging.info(f"⏱️ Direct OCR: archival finished {time.monotonic() - started_at:.2f}s after OCR")
+
+        await supabase.update_session(session_id, {
+            'parsed_data': parsed_data,
+            'status': 'pending_verification'
+        })
+
+        # Статусы должны прийти раньше результата
+        await asyncio.gather(*background, return_exceptions=True)
+
+        formatted_data = format_data_for_display(parsed_data)
+        await asyncio.to_thread(
+            status.finish,
+            f"{formatted_data}\n\n<b>Проверьте данные:</b>",
+            telegram.create_verification_buttons(session_id)
+        )
+
+        await asyncio.to_thread(photo_jobs.save, job['id'], {'stage': 'done'})
+        logging.info(f"✅ Photo processed for chat {chat_id}, session {session_id}")
+        return True
+
+
+def run_photo_pipeline(chat_id, photos) -> bool:
+    """Синхронная точка входа для пула воркеров"""
+    try:
+        with tracer.span('photo.async_pipeline'):
+            return asyncio.run(process_photo(chat_id, photos))
+    finally:
+        audit_log.flush()
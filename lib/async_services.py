@@ -0,0 +1,159 @@
+import time
+import asyncio
+import json
+import logging
+import httpx
+from lib.http_client import get_http_client
+from lib.telegram import telegram_service
+from lib.ocr import ocr_service
+from lib.deepseek import deepseek_service
+from lib.cache import analysis_cache
+from lib.supabase_client import supabase_client
+from lib.tracing import tracer
+
+
+async def _start_span(request: httpx.Request):
+    request.extensions['trace_started_at'] = time.monotonic()
+
+
+async def _finish_span(response: httpx.Response):
+    started_at = response.request.extensions.get('trace_started_at')
+    if started_at is not None:
+        tracer.record(f"http.{response.request.url.host}", time.monotonic() - started_at)
+
+
+def create_async_client() -> httpx.AsyncClient:
+    """HTTP-клиент для одного запуска асинхронного конвейера"""
+    http = get_http_client()
+    return httpx.AsyncClient(
+        limits=httpx.Limits(
+            max_connections=http.pool_maxsize,
+            max_keepalive_connections=http.pool_maxsize
+        ),
+        timeout=http.default_timeout,
+        event_hooks={'request': [_start_span], 'response': [_finish_span]}
+    )
+
+
+class AsyncTelegramService:
+    """Асинхронные загрузки файлов поверх общего TelegramService.
+
+    Остальные (синхронные) методы берутся у сервиса, поэтому прокси не
+    перекрывает их корутинами.
+    """
+
+    def __init__(self, client: httpx.AsyncClient, service=None):
+        self.client = client
+        self.service = service or telegram_service
+
+    def __getattr__(self, name):
+        return getattr(self.service, name)
+
+    async def get_file_url(self, file_id: str):
+        """Возвращает (URL файла на серверах Telegram, путь файла)"""
+        try:
+            url = f"{self.service.api_url}/getFile"
+            response = await self.client.post(url, data={"file_id": file_id}, timeout=self.service.http.timeout_for(url))
+            file_info = response.json()
+
+            if not file_info.get('ok'):
+                logging.error(f"❌ File info error: {file_info}")
+                return None, None
+
+            file_path = file_info['result']['file_path']
+            return f"{self.service.api_base}/file/bot{self.service.token}/{file_path}", file_path
+
+        except Exception as e:
+            logging.error(f"❌ Error getting file info: {e}")
+            return None, None
+
+    async def download(self, telegram_file_url: str):
+        try:
+            response = await self.client.get(telegram_file_url, timeout=self.service.http.timeout_for(telegram_file_url))
+            if response.status_code != 200:
+                logging.error(f"❌ File download error: {response.status_code}")
+                return None
+            return response.content
+        except Exception as e:
+            logging.error(f"❌ Error downloading file: {e}")
+            return None
+
+
+class AsyncOCRService:
+    """OCR для асинхронного конвейера: тот же OCRService с бэкендами,
+    хеджированием и предохранителями, в пуле потоков"""
+
+    def __init__(self, service=None):
+        self.service = service or ocr_service
+
+    @property
+    def direct_upload(self) -> bool:
+        return self.service.direct_upload
+
+    async def extract_text_from_url(self, image_url: str, session_id: str = None, log_url: str = None):
+        return await asyncio.to_thread(self.service.extract_text_from_url, image_url, session_id, log_url)
+
+    async def extract_text_from_bytes(self, file_content: bytes, file_name: str, session_id: str = None, file_url: str = None):
+        return await asyncio.to_thread(self.service.extract_text_from_bytes, file_content, file_name, session_id, file_url)
+
+
+class AsyncDeepSeekService:
+    """Запрос к DeepSeek через асинхронный клиент; промпт, заголовки и
+    ключ кэша - у общего DeepSeekService"""
+
+    def __init__(self, client: httpx.AsyncClient, service=None):
+        self.client = client
+        self.service = service or deepseek_service
+
+    async def analyze_text(self, extracted_text: str, fields: list = None) -> str:
+        try:
+            if not extracted_text:
+                return "Текст не распознан"
+
+            cache_key_text = self.service._cache_key(extracted_text, fields)
+            cached = analysis_cache.get(cache_key_text)
+            if cached:
+                logging.info("⚡ DeepSeek анализ взят из кэша")
+                return cached
+
+            response = await self.client.post(
+                self.service.api_url,
+                json=self.service._build_payload(extracted_text, fields),
+                headers=self.service._headers(),
+                timeout=self.service.http.timeout_for(self.service.api_url)
+            )
+
+            if response.status_code == 200:
+                analysis = json.loads(response.content)['choices'][0]['message']['content']
+                logging.info("✅ DeepSeek анализ завершен")
+                analysis_cache.put(cache_key_text, analysis)
+                return analysis
+            else:
+                logging.error(f"❌ Ошибка DeepSeek API: {response.status_code} - {response.text}")
+                return f"Ошибка анализа: {response.status_code}"
+
+        except Exception as e:
+            logging.error(f"❌ Ошибка DeepSeek: {e}")
+            return f"Ошибка: {str(e)}"
+
+
+class AsyncSupabaseService:
+    """Асинхронная обертка над SupabaseService: синхронный клиент в пуле потоков"""
+
+    def __init__(self, service=None):
+        self.service = service or supabase_client
+
+    async def create_session(self, chat_id: int, extracted_data: str = None):
+        return await asyncio.to_thread(self.service.create_session, chat_id, extracted_data)
+
+    async def get_session(self, session_id: str):
+        return await asyncio.to_thread(self.service.get_session, session_id)
+
+    async def update_session(self, session_id: str, updates: dict):
+        return await asyncio.to_thread(self.service.update_session, session_id, updates)
+
+    async def upload_file(self, file_content: bytes, file_path: str, bucket: str = 'documents'):
+        return await asyncio.to_thread(self.service.upload_file, file_content, file_path, bucket)
+
+    async def get_file_url(self, file_path: str, bucket: str = 'documents'):
+        return await asyncio.to_thread(self.service.get_file_url, file_path, bucket)
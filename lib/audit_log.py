@@ -0,0 +1,121 @@
+import os
+import time
+import atexit
+import logging
+import threading
+from lib.supabase_client import supabase_client
+from lib.tracing import tracer
+
+
+class AuditLogWriter:
+    """Буфер строк для журнальных таблиц (bitrix_logs, processed_documents).
+
+    Строки пишутся пачками: при накоплении AUDIT_BATCH_SIZE строк, раз в
+    AUDIT_FLUSH_INTERVAL секунд и явным flush() в конце обработки.
+    При переполнении буфера AUDIT_OVERFLOW_POLICY решает, что делать:
+    drop_oldest, drop_newest или spill (синхронная запись буфера).
+    """
+
+    def __init__(self):
+        self.batch_size = int(os.getenv('AUDIT_BATCH_SIZE', '20'))
+        self.flush_interval = float(os.getenv('AUDIT_FLUSH_INTERVAL', '5'))
+        self.buffer_limit = int(os.getenv('AUDIT_BUFFER_LIMIT', '500'))
+        self.overflow_policy = os.getenv('AUDIT_OVERFLOW_POLICY', 'spill')
+
+        self._buffer = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._flusher = None
+
+        self.written = 0
+        self.dropped = 0
+        self.spilled = 0
+        self.flushes = 0
+        self.failures = 0
+
+    def add(self, table: str, row: dict):
+        with self._lock:
+            if len(self._buffer) >= self.buffer_limit:
+                if self.overflow_policy == 'drop_newest':
+                    self.dropped += 1
+                    logging.warning(f"⚠️ Audit buffer full, dropped {table} row")
+                    return
+                if self.overflow_policy == 'drop_oldest':
+                    self._buffer.pop(0)
+                    self.dropped += 1
+                    logging.warning("⚠️ Audit buffer full, dropped oldest row")
+                else:
+                    self.spilled += 1
+
+            self._buffer.append((table, row))
+            should_flush = len(self._buffer) >= self.batch_size or len(self._buffer) > self.buffer_limit
+            self._ensure_flusher()
+
+        if should_flush:
+            self.flush()
+
+    def amend(self, table: str, key: str, value, updates: dict) -> bool:
+        """Дополняет еще не записанную строку; False, если такой в буфере нет"""
+        with self._lock:
+            for row_table, row in self._buffer:
+                if row_table == table and row.get(key) == value:
+                    row.update(updates)
+                    return True
+        return False
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                batch, self._buffer = self._buffer, []
+            if not batch:
+                return
+
+            # PostgREST принимает пачку только с одинаковыми ключами строк, а
+            # дополненные amend строки отличаются: одна вставка на набор ключей.
+            # Добивать строки None нельзя - None перекрыл бы default колонки.
+            by_shape = {}
+            for table, row in batch:
+                by_shape.setdefault((table, tuple(sorted(row))), []).append(row)
+
+            for (table, _), rows in by_shape.items():
+                try:
+                    with tracer.span(f"supabase.insert.{table}"):
+                        supabase_client.supabase.table(table).insert(rows).execute()
+                    self.written += len(rows)
+                except Exception as e:
+                    self.failures += 1
+                    self.dropped += len(rows)
+                    logging.error(f"❌ Error writing {len(rows)} rows to {table}: {e}")
+
+            self.flushes += 1
+
+    def _ensure_flusher(self):
+        if self._flusher is None or not self._flusher.is_alive():
+            self._flusher = threading.Thread(target=self._flush_periodically, name='audit-log', daemon=True)
+            self._flusher.start()
+
+    def _flush_periodically(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception as e:
+                logging.error(f"❌ Error flushing audit log: {e}")
+
+    def stats(self) -> dict:
+        with self._lock:
+            buffered = len(self._buffer)
+        return {
+            'buffered': buffered,
+            'buffer_limit': self.buffer_limit,
+            'written': self.written,
+            'dropped': self.dropped,
+            'spilled': self.spilled,
+            'flushes': self.flushes,
+            'failures': self.failures
+        }
+
+
+audit_log = AuditLogWriter()
+
+atexit.register(audit_log.flush)
@@ -1,38 +1,44 @@
-import requests
 import logging
 import json
 import os
-from lib.supabase_client import supabase_client
+import time
+import threading
+from urllib.parse import urlencode
+from lib.http_client import get_http_client
+from lib.audit_log import audit_log
+from lib.lazy import LazyService
+from utils.fields import FIELDS, NOT_FOUND
 
 class BitrixService:
     def __init__(self):
         self.webhook_url = os.getenv('BITRIX24_WEBHOOK_URL')
         self.entity_type_id = os.getenv('BITRIX24_ENTITY_TYPE_ID', '1086')
+        self.http = get_http_client()
         
         if not self.webhook_url:
             logging.error("❌ Bitrix24 webhook URL not set")
             raise ValueError("Bitrix24 webhook URL not set")
         
+        # Вебхук указывает на метод crm.item.add, batch лежит рядом
+        self.batch_url = os.getenv('BITRIX24_BATCH_URL') or f"{self.webhook_url.rsplit('/', 1)[0]}/batch.json"
+        
         logging.info("✅ Bitrix service initialized")
     
+    def build_item(self, parsed_data: dict) -> dict:
+        return {
+            "entityTypeId": int(self.entity_type_id),
+            "fields": {field.bitrix_key: parsed_data.get(field.name, NOT_FOUND) for field in FIELDS}
+        }
+    
     def send_data(self, parsed_data: dict, chat_id: int, username: str = "unknown"):
         try:
-            bitrix_data = {
-                "entityTypeId": int(self.entity_type_id),
-                "fields": {
-                    "ufCrm28_1737543613": parsed_data.get('Номер чертежа', 'не указано'),
-                    "ufCrm28_1753194216": parsed_data.get('Участок', 'не указано'),
-                    "ufCrm28_1753194194": parsed_data.get('Изделие', 'не указано'),
-                    "ufCrm28_1736772873": parsed_data.get('Номер изделия', 'не указано')
-                }
-            }
+            bitrix_data = self.build_item(parsed_data)
             
             logging.info(f"🔄 Sending to Bitrix24: {json.dumps(bitrix_data, ensure_ascii=False)}")
             
-            response = requests.post(
+            response = self.http.post(
                 self.webhook_url,
                 json=bitrix_data,
-                timeout=30,
                 headers={'Content-Type': 'application/json'}
             )
             
@@ -40,11 +46,11 @@ class BitrixService:
             
             result_data = response.json()
             
-            supabase_client.supabase.table('bitrix_logs').insert({
+            audit_log.add('bitrix_logs', {
                 'request_data': bitrix_data,
                 'response_data': result_data,
                 'status': 'success' if response.status_code == 200 else 'error'
-            }).execute()
+            })
             
             if response.status_code == 200:
                 if 'result' in result_data:
@@ -60,16 +66,75 @@ class BitrixService:
         except Exception as e:
             logging.error(f"❌ Error sending to Bitrix24: {e}")
             
+            audit_log.add('bitrix_logs', {
+                'request_data': {'error': str(e)},
+                'response_data': {},
+                'status': 'exception'
+            })
+            
+            return False
+    
+    def send_batch(self, items: list) -> list:
+        """Отправляет до 50 crm.item.add одним вызовом batch.
+        
+        Возвращает результаты в порядке items (False для неудачных).
+        """
+        commands = {
+            f"item{index}": f"crm.item.add?{self._to_query(item)}"
+            for index, item in enumerate(items)
+        }
+        
+        for attempt in range(3):
             try:
-                supabase_client.supabase.table('bitrix_logs').insert({
-                    'request_data': {'error': str(e)},
+                logging.info(f"🔄 Sending batch of {len(items)} items to Bitrix24")
+                response = self.http.post(
+                    self.batch_url,
+                    json={'halt': 0, 'cmd': commands},
+                    headers={'Content-Type': 'application/json'}
+                )
+                result_data = response.json()
+                
+                # Превышен лимит запросов - ждем и повторяем
+                if result_data.get('error') == 'QUERY_LIMIT_EXCEEDED':
+                    logging.warning("⚠️ Bitrix24 rate limit, retrying batch")
+                    time.sleep(2 ** attempt)
+                    continue
+                
+                batch_result = result_data.get('result', {})
+                results = batch_result.get('result', {}) or {}
+                errors = batch_result.get('result_error', {}) or {}
+                
+                output = []
+                for index, item in enumerate(items):
+                    key = f"item{index}"
+                    item_result = results.get(key) if isinstance(results, dict) else None
+                    audit_log.add('bitrix_logs', {
+                        'request_data': item,
+                        'response_data': item_result or errors.get(key, {}),
+                        'status': 'success' if item_result else 'error'
+                    })
+                    if not item_result:
+                        logging.error(f"❌ Bitrix24 batch error for {key}: {errors.get(key)}")
+                    output.append(item_result or False)
+                return output
+                
+            except Exception as e:
+                logging.error(f"❌ Error sending batch to Bitrix24: {e}")
+                audit_log.add('bitrix_logs', {
+                    'request_data': {'error': str(e), 'batch_size': len(items)},
                     'response_data': {},
                     'status': 'exception'
-                }).execute()
-            except:
-                pass
-            
-            return False
+                })
+                return [False] * len(items)
+        
+        return [False] * len(items)
+    
+    @staticmethod
+    def _to_query(item: dict) -> str:
+        params = {'entityTypeId': item['entityTypeId']}
+        for name, value in item['fields'].items():
+            params[f"fields[{name}]"] = value
+        return urlencode(params)
     
     def extract_bitrix_id(self, item_id):
         try:
@@ -87,3 +152,88 @@ class BitrixService:
         except Exception as e:
             logging.error(f"❌ Ошибка извлечения ID из ответа Битрикс24: {e}")
             return None
+
+
+class BitrixBatchQueue:
+    """Очередь подтвержденных карт: копит элементы и отправляет их через batch.
+    
+    Пачка уходит, когда набралось 50 элементов или прошло BITRIX_BATCH_WINDOW
+    секунд с первого; между вызовами выдерживается BITRIX_MIN_INTERVAL.
+    """
+    
+    MAX_COMMANDS = 50
+    
+    def __init__(self):
+        self.window = float(os.getenv('BITRIX_BATCH_WINDOW', '2'))
+        self.min_interval = float(os.getenv('BITRIX_MIN_INTERVAL', '0.5'))
+        self._items = []
+        self._first_added_at = None
+        self._last_call = 0.0
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._send_lock = threading.Lock()
+        self._worker = None
+    
+    def submit(self, parsed_data: dict, on_result):
+        """on_result(item_result) вызывается после отправки; False при ошибке"""
+        with self._lock:
+            if not self._items:
+                self._first_added_at = time.monotonic()
+            self._items.append((parsed_data, on_result))
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._run, name='bitrix-batch', daemon=True)
+                self._worker.start()
+            self._wakeup.notify()
+    
+    def pending(self) -> int:
+        with self._lock:
+            return len(self._items)
+    
+    def flush(self):
+        """Отправляет все накопленное сразу"""
+        while True:
+            batch = self._take_batch()
+            if not batch:
+                return
+            self._send(batch)
+    
+    def _run(self):
+        while True:
+            with self._lock:
+                while not self._items:
+                    self._wakeup.wait()
+                while self._items and len(self._items) < self.MAX_COMMANDS:
+                    remaining = self._first_added_at + self.window - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._wakeup.wait(remaining)
+            self.flush()
+    
+    def _take_batch(self) -> list:
+        with self._lock:
+            batch = self._items[:self.MAX_COMMANDS]
+            self._items = self._items[self.MAX_COMMANDS:]
+            self._first_added_at = time.monotonic() if self._items else None
+            return batch
+    
+    def _send(self, batch: list):
+        with self._send_lock:
+            wait = self._last_call + self.min_interval - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            try:
+                results = bitrix_service.send_batch([bitrix_service.build_item(data) for data, _ in batch])
+            except Exception as e:
+                logging.error(f"❌ Error sending Bitrix24 batch: {e}")
+                results = [False] * len(batch)
+            self._last_call = time.monotonic()
+        
+        for (_, on_result), result in zip(batch, results):
+            try:
+                on_result(result)
+            except Exception as e:
+                logging.error(f"❌ Error handling Bitrix24 batch result: {e}")
+
+
+bitrix_service = LazyService('bitrix', BitrixService)
+bitrix_queue = BitrixBatchQueue()
@@ -0,0 +1,302 @@
+import os
+import re
+import time
+import logging
+import hashlib
+import threading
+from collections import OrderedDict
+from difflib import SequenceMatcher
+from datetime import datetime, timedelta, timezone
+from lib.supabase_client import supabase_client
+from lib.audit_log import audit_log
+from lib.extractor import FieldExtractor
+from utils.fields import NOT_FOUND
+
+
+class LRUCache:
+    """Потокобезопасный LRU-кэш с TTL и счётчиками попаданий"""
+
+    def __init__(self, maxsize: int = 256, ttl: float = 86400):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._data[key]
+                self.misses += 1
+                return None
+
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def values(self):
+        """Актуальные значения, от самых свежих к старым"""
+        now = time.monotonic()
+        with self._lock:
+            return [value for expires_at, value in reversed(self._data.values()) if expires_at >= now]
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self) -> dict:
+        return {
+            'size': len(self._data),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions
+        }
+
+
+class OCRResultCache:
+    """Двухуровневый кэш результатов OCR + анализа: память и processed_documents.
+
+    Ключи - file_unique_id фото из Telegram и sha256 содержимого файла.
+    """
+
+    def __init__(self):
+        self.ttl = float(os.getenv('OCR_CACHE_TTL', '604800'))
+        self.memory = LRUCache(
+            maxsize=int(os.getenv('OCR_CACHE_SIZE', '256')),
+            ttl=self.ttl
+        )
+        self.persistent_hits = 0
+        self.persistent_misses = 0
+
+    @staticmethod
+    def hash_content(file_content: bytes) -> str:
+        return hashlib.sha256(file_content).hexdigest()
+
+    def get(self, file_unique_id: str = None, content_hash: str = None):
+        keys = [('file_unique_id', file_unique_id), ('content_hash', content_hash)]
+        keys = [(column, value) for column, value in keys if value]
+
+        for column, value in keys:
+            result = self.memory.get(f"{column}:{value}")
+            if result:
+                logging.info(f"⚡ OCR cache hit (memory, {column})")
+                return result
+
+        for column, value in keys:
+            result = self._get_persistent(column, value)
+            if result:
+                self.persistent_hits += 1
+                logging.info(f"⚡ OCR cache hit (supabase, {column})")
+                self._remember(result, file_unique_id, content_hash)
+                return result
+
+        if keys:
+            self.persistent_misses += 1
+        return None
+
+    def put(self, result: dict, file_unique_id: str = None, content_hash: str = None, session_id: str = None):
+        """Запоминает результат; строка processed_documents сессии дополняется ключами"""
+        self._remember(result, file_unique_id, content_hash)
+
+        if not session_id:
+            return
+        updates = {
+            'file_unique_id': file_unique_id,
+            'content_hash': content_hash,
+            'analysis_result': result['analysis_result']
+        }
+        # Строка OCR могла еще не уйти из буфера журнала
+        if audit_log.amend('processed_documents', 'session_id', session_id, updates):
+            return
+        try:
+            supabase_client.supabase.table('processed_documents').update(updates).eq('session_id', session_id).execute()
+        except Exception as e:
+            logging.error(f"❌ Error saving OCR cache entry: {e}")
+
+    def _remember(self, result: dict, file_unique_id: str = None, content_hash: str = None):
+        if file_unique_id:
+            self.memory.set(f"file_unique_id:{file_unique_id}", result)
+        if content_hash:
+            self.memory.set(f"content_hash:{content_hash}", result)
+
+    def _get_persistent(self, column: str, value: str):
+        try:
+            cutoff = datetime.now(timezone.utc) - timedelta(seconds=self.ttl)
+            rows = supabase_client.supabase.table('processed_documents')\
+                .select('extracted_text, analysis_result')\
+                .eq(column, value)\
+                .gte('created_at', cutoff.isoformat())\
+                .order('created_at', desc=True)\
+                .limit(1)\
+                .execute()
+
+            if rows.data and rows.data[0].get('analysis_result'):
+                return {
+                    'extracted_text': rows.data[0]['extracted_text'],
+                    'analysis_result': rows.data[0]['analysis_result']
+                }
+            return None
+        except Exception as e:
+            logging.error(f"❌ Error reading OCR cache: {e}")
+            return None
+
+    def stats(self) -> dict:
+        stats = self.memory.stats()
+        stats['persistent_hits'] = self.persistent_hits
+        stats['persistent_misses'] = self.persistent_misses
+        return stats
+
+
+# Шаги нормализации текста OCR, применяются в порядке из ANALYSIS_CACHE_NORMALIZE
+NORMALIZERS = {
+    'punctuation': lambda text: re.sub(r'[^\w\s]', ' ', text),
+    'case': lambda text: text.casefold(),
+    'whitespace': lambda text: re.sub(r'\s+', ' ', text).strip(),
+}
+
+
+class AnalysisCache:
+    """Мемоизация анализа DeepSeek по нормализованному тексту OCR.
+
+    При ANALYSIS_CACHE_FUZZY > 0 переиспользуется анализ похожего текста,
+    если коэффициент сходства не ниже порога. Карты одного шаблона похожи
+    почти целиком и различаются номерами, поэтому похожий текст засчитывается,
+    только если локальный экстрактор нашел в нем те же номер чертежа и
+    номер изделия.
+    """
+
+    # Поля, по которым похожие тексты - один и тот же документ
+    IDENTITY_FIELDS = ('Номер чертежа', 'Номер изделия')
+
+    def __init__(self):
+        steps = os.getenv('ANALYSIS_CACHE_NORMALIZE', 'case,whitespace')
+        self.normalizers = [NORMALIZERS[step.strip()] for step in steps.split(',') if step.strip() in NORMALIZERS]
+        self.fuzzy_threshold = float(os.getenv('ANALYSIS_CACHE_FUZZY', '0'))
+        self.persist = os.getenv('ANALYSIS_CACHE_PERSIST', 'false').lower() == 'true'
+        self.ttl = float(os.getenv('ANALYSIS_CACHE_TTL', '604800'))
+        self.memory = LRUCache(
+            maxsize=int(os.getenv('ANALYSIS_CACHE_SIZE', '512')),
+            ttl=self.ttl
+        )
+        self.fuzzy_hits = 0
+        self.fuzzy_rejects = 0
+        self.extractor = FieldExtractor() if self.fuzzy_threshold > 0 else None
+
+    def normalize(self, text: str) -> str:
+        for normalizer in self.normalizers:
+            text = normalizer(text)
+        return text
+
+    @staticmethod
+    def text_hash(normalized_text: str) -> str:
+        return hashlib.sha256(normalized_text.encode('utf-8')).hexdigest()
+
+    def identity(self, text: str):
+        """Номера документа из текста OCR (без нормализации: шаблоны
+        экстрактора различают регистр); None, если номер чертежа не найден"""
+        if not self.extractor:
+            return None
+        extracted = self.extractor.extract(text)
+        numbers = tuple(extracted[field]['value'] for field in self.IDENTITY_FIELDS)
+        return numbers if numbers[0] != NOT_FOUND else None
+
+    def get(self, text: str):
+        normalized = self.normalize(text)
+        key = self.text_hash(normalized)
+
+        entry = self.memory.get(key)
+        if entry:
+            return entry['analysis']
+
+        if self.persist:
+            analysis = self._get_persistent(key)
+            if analysis:
+                self.memory.set(key, self._entry(text, normalized, analysis))
+                return analysis
+
+        if self.fuzzy_threshold > 0:
+            return self._get_fuzzy(normalized, self.identity(text))
+        return None
+
+    def put(self, text: str, analysis: str):
+        normalized = self.normalize(text)
+        key = self.text_hash(normalized)
+        self.memory.set(key, self._entry(text, normalized, analysis))
+
+        if not self.persist:
+            return
+        try:
+            # created_at обновляется, иначе запись старше TTL не находилась бы и после нового анализа
+            supabase_client.supabase.table('analysis_cache').upsert({
+                'text_hash': key,
+                'analysis_result': analysis,
+                'created_at': 'now()'
+            }).execute()
+        except Exception as e:
+            logging.error(f"❌ Error saving analysis cache entry: {e}")
+
+    def _entry(self, text: str, normalized: str, analysis: str) -> dict:
+        return {'normalized': normalized, 'analysis': analysis, 'identity': self.identity(text)}
+
+    def _get_fuzzy(self, normalized: str, identity):
+        if identity is None:
+            return None
+
+        best_ratio, best_analysis = 0.0, None
+        for entry in self.memory.values():
+            matcher = SequenceMatcher(None, normalized, entry['normalized'], autojunk=False)
+            if matcher.real_quick_ratio() < self.fuzzy_threshold or matcher.quick_ratio() < self.fuzzy_threshold:
+                continue
+            ratio = matcher.ratio()
+            if ratio < self.fuzzy_threshold or ratio <= best_ratio:
+                continue
+            if entry.get('identity') != identity:
+                # Похожая карта того же шаблона, но другой документ
+                self.fuzzy_rejects += 1
+                continue
+            best_ratio, best_analysis = ratio, entry['analysis']
+
+        if best_analysis:
+            self.fuzzy_hits += 1
+            logging.info(f"⚡ Analysis cache fuzzy hit: {best_ratio:.2f}")
+        return best_analysis
+
+    def _get_persistent(self, key: str):
+        try:
+            cutoff = datetime.now(timezone.utc) - timedelta(seconds=self.ttl)
+            rows = supabase_client.supabase.table('analysis_cache')\
+                .select('analysis_result')\
+                .eq('text_hash', key)\
+                .gte('created_at', cutoff.isoformat())\
+                .limit(1)\
+                .execute()
+            return rows.data[0]['analysis_result'] if rows.data else None
+        except Exception as e:
+            logging.error(f"❌ Error reading analysis cache: {e}")
+            return None
+
+    def stats(self) -> dict:
+        stats = self.memory.stats()
+        stats['fuzzy_hits'] = self.fuzzy_hits
+        stats['fuzzy_rejects'] = self.fuzzy_rejects
+        return stats
+
+
+ocr_cache = OCRResultCache()
+analysis_cache = AnalysisCache()
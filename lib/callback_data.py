@@ -0,0 +1,96 @@
+import re
+import uuid
+import base64
+import binascii
+from typing import NamedTuple, Optional
+from utils.fields import FIELD_NAMES
+
+# Коды действий уходят в callback_data кнопок, уже отправленных в чаты:
+# новые действия только дописываются в конец
+ACTIONS = ('verify_ok', 'verify_edit', 'edit_field', 'edit_done', 'edit_ok')
+ACTION_CODES = {action: code for code, action in enumerate(ACTIONS, 1)}
+
+TEXT_SESSION = 0x80  # session_id не UUID и лежит в payload как текст
+NO_FIELD = 0xFF
+MAX_LENGTH = 64      # ограничение Telegram на callback_data, байт
+
+FIELD_INDEX = {name: index for index, name in enumerate(FIELD_NAMES)}
+
+# Кнопки старого формата "edit_field_<session_id>_<поле>" - пока живы их сессии
+LEGACY_PATTERN = re.compile(rf"^({'|'.join(ACTIONS)})_([^_]+)(?:_(.+))?$")
+
+
+class Callback(NamedTuple):
+    action: str
+    session_id: str
+    field: Optional[str] = None
+
+
+def encode_callback(action: str, session_id: str, field: str = None) -> str:
+    """[код действия][индекс поля][16 байт UUID] в base64url без '=' - 24 символа"""
+    code = ACTION_CODES[action]
+    try:
+        session = uuid.UUID(session_id).bytes
+    except ValueError:
+        session = session_id.encode('utf-8')
+        code |= TEXT_SESSION
+
+    payload = bytes((code, FIELD_INDEX[field] if field else NO_FIELD)) + session
+    data = base64.urlsafe_b64encode(payload).rstrip(b'=').decode('ascii')
+    if len(data) > MAX_LENGTH:
+        raise ValueError(f"callback_data longer than {MAX_LENGTH} bytes for session {session_id}")
+    return data
+
+
+def decode_callback(data: str) -> Optional[Callback]:
+    """Callback из callback_data кнопки или None, если данные не разобрать.
+
+    Сначала - компактный формат: старые данные начинаются с "verify_" или
+    "edit_", и их первый байт в base64 никогда не дает допустимый код
+    действия. Регулярное выражение - только для старых кнопок.
+    """
+    callback = _decode_compact(data)
+    if callback:
+        return callback
+
+    legacy = LEGACY_PATTERN.match(data)
+    if legacy:
+        action, session_id, field = legacy.groups()
+        if field is not None and field not in FIELD_INDEX:
+            return None
+        return Callback(action, session_id, field)
+    return None
+
+
+def _decode_compact(data: str) -> Optional[Callback]:
+    # a2b_base64 с заменой алфавита быстрее urlsafe_b64decode
+    if len(data) % 4:
+        data += '=' * (-len(data) % 4)
+    try:
+        payload = binascii.a2b_base64(data.replace('-', '+').replace('_', '/'))
+    except (binascii.Error, ValueError):
+        return None
+    if len(payload) < 3:
+        return None
+
+    code, field_index = payload[0], payload[1]
+    if not 0 < code & ~TEXT_SESSION <= len(ACTIONS):
+        return None
+    if field_index != NO_FIELD and field_index >= len(FIELD_NAMES):
+        return None
+
+    session = payload[2:]
+    if code & TEXT_SESSION:
+        try:
+            session_id = session.decode('utf-8')
+        except UnicodeDecodeError:
+            return None
+    elif len(session) == 16:
+        # То же, что str(uuid.UUID(bytes=session)), но без объекта UUID
+        hex_id = session.hex()
+        session_id = '-'.join((hex_id[:8], hex_id[8:12], hex_id[12:16], hex_id[16:20], hex_id[20:]))
+    else:
+        return None
+
+    field = FIELD_NAMES[field_index] if field_index != NO_FIELD else None
+    return Callback(ACTIONS[(code & ~TEXT_SESSION) - 1], session_id, field)
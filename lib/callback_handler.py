@@ -1,8 +1,56 @@
+import os
+import atexit
 import logging
-from lib.telegram import TelegramService
-from lib.bitrix import BitrixService
+from datetime import datetime, timedelta, timezone
+from functools import wraps
+from lib.telegram import telegram_service
+from lib.bitrix import bitrix_service, bitrix_queue
 from lib.supabase_client import supabase_client
-from utils.formatters import format_data_for_edit, format_data_for_display
+from lib.audit_log import audit_log
+from lib.dedup import session_locks
+from lib.workers import callback_executor
+from lib.tracing import tracer
+from lib.callback_data import decode_callback
+from utils.formatters import format_data_for_edit, format_data_for_display, format_final_data
+from utils.fields import NOT_FOUND
+
+# Подтвержденные карты копятся и уходят в Битрикс24 пачками через batch
+BITRIX_BATCH_MODE = os.getenv('BITRIX_BATCH_MODE', 'false').lower() == 'true'
+
+# Кнопка подтверждается сразу, обработка идет в фоновом пуле
+CALLBACK_ASYNC = os.getenv('CALLBACK_ASYNC', 'true').lower() == 'true'
+
+atexit.register(bitrix_queue.flush)
+
+def timed(handler):
+    """Спан callback.<обработчик>; он и вложенные спаны supabase.*/http.*
+    привязаны к session_id из аргументов"""
+    @wraps(handler)
+    def wrapper(chat_id, session_id, *args, **kwargs):
+        with tracer.bind(session_id), tracer.span(f"callback.{handler.__name__}"):
+            return handler(chat_id, session_id, *args, **kwargs)
+    return wrapper
+
+# Действие кнопки -> (обработчик, что передать после session_id)
+CALLBACK_HANDLERS = {}
+
+def on_callback(action, *params):
+    """Регистрирует обработчик действия из lib/callback_data.ACTIONS.
+    
+    params - дополнительные аргументы после chat_id и session_id:
+    'username' (кто нажал) и 'field' (поле кнопки редактирования).
+    """
+    def register(handler):
+        CALLBACK_HANDLERS[action] = (handler, params)
+        return handler
+    return register
+
+def dispatch_callback_query(callback_query):
+    """Отвечает на нажатие кнопки сразу и ставит обработку в фоновый пул"""
+    telegram_service.answer_callback_query(callback_query['id'])
+    
+    if not CALLBACK_ASYNC or not callback_executor.submit(handle_callback_query, callback_query):
+        handle_callback_query(callback_query)
 
 def handle_callback_query(callback_query):
     try:
@@ -11,68 +59,58 @@ def handle_callback_query(callback_query):
         username = callback_query['from'].get('username', 'unknown')
         
         logging.info(f"🔄 Handling callback: {callback_data}")
-        
-        if callback_data.startswith('verify_ok_'):
-            session_id = callback_data.replace('verify_ok_', '')
-            handle_verification_ok(chat_id, session_id, username)
-            
-        elif callback_data.startswith('verify_edit_'):
-            session_id = callback_data.replace('verify_edit_', '')
-            handle_verification_edit(chat_id, session_id)
-            
-        elif callback_data.startswith('edit_field_'):
-            parts = callback_data.split('_')
-            session_id = parts[2]
-            field_name = '_'.join(parts[3:])
-            handle_edit_field(chat_id, session_id, field_name)
-            
-        elif callback_data.startswith('edit_done_'):
-            session_id = callback_data.replace('edit_done_', '')
-            handle_edit_done(chat_id, session_id)
-            
-        elif callback_data.startswith('edit_ok_'):
-            session_id = callback_data.replace('edit_ok_', '')
-            handle_edit_ok(chat_id, session_id, username)
+        route_callback(chat_id, callback_data, username)
             
     except Exception as e:
         logging.error(f"❌ Error handling callback: {e}")
+    finally:
+        audit_log.flush()
+
+def route_callback(chat_id, callback_data, username, handlers=CALLBACK_HANDLERS):
+    """Декодирует callback_data и вызывает зарегистрированный обработчик"""
+    callback = decode_callback(callback_data)
+    entry = handlers.get(callback.action) if callback else None
+    if not entry or ('field' in entry[1] and callback.field is None):
+        logging.warning(f"⚠️ Unknown callback: {callback_data}")
+        return
+    
+    handler, params = entry
+    context = {'username': username, 'field': callback.field}
+    handler(chat_id, callback.session_id, *[context[name] for name in params])
 
+@on_callback('verify_ok', 'username')
+@timed
 def handle_verification_ok(chat_id, session_id, username):
     session = supabase_client.get_session(session_id)
     if not session:
-        TelegramService().send_message(chat_id, "❌ Сессия не найдена")
+        telegram_service.send_message(chat_id, "❌ Сессия не найдена")
         return
     
-    bitrix_service = BitrixService()
+    # В Битрикс24 уходит строка из захвата, а не из кэша инстанса:
+    # правку могли сохранить на другом инстансе
+    claimed = session_locks.acquire(session_id)
+    if not claimed:
+        logging.info(f"⏭️ Session {session_id} is already being submitted")
+        return
     
-    item_id = bitrix_service.send_data(
-        session['parsed_data'], 
-        chat_id, 
-        username
+    submit_to_bitrix(
+        chat_id,
+        session_id,
+        claimed['parsed_data'],
+        username,
+        "✅ Супер! Данные переданы",
+        "📤 Данные подтверждены"
     )
-    
-    bitrix_id = bitrix_service.extract_bitrix_id(item_id)
-    
-    final_data = format_final_data(session['parsed_data'])
-    
-    telegram = TelegramService()
-    if bitrix_id:
-        message = f"✅ Супер! Данные переданы, ID заявки: {bitrix_id}\n\n{final_data}"
-    else:
-        message = f"⚠️ Данные обработаны, но возникла ошибка при отправке в Битрикс24\n\n{final_data}"
-    
-    telegram.send_message(chat_id, message)
-    logging.info(f"📤 Данные подтверждены: {session['parsed_data']}")
-    
-    supabase_client.delete_session(session_id)
 
+@on_callback('verify_edit')
+@timed
 def handle_verification_edit(chat_id, session_id):
     session = supabase_client.get_session(session_id)
     if not session:
-        TelegramService().send_message(chat_id, "❌ Сессия не найдена")
+        telegram_service.send_message(chat_id, "❌ Сессия не найдена")
         return
     
-    telegram = TelegramService()
+    telegram = telegram_service
     telegram.send_message(
         chat_id, 
         format_data_for_edit(session['parsed_data']), 
@@ -81,10 +119,12 @@ def handle_verification_edit(chat_id, session_id):
     
     supabase_client.update_session(session_id, {'status': 'editing'})
 
+@on_callback('edit_field', 'field')
+@timed
 def handle_edit_field(chat_id, session_id, field_name):
     session = supabase_client.get_session(session_id)
     if not session:
-        TelegramService().send_message(chat_id, "❌ Сессия не найдена")
+        telegram_service.send_message(chat_id, "❌ Сессия не найдена")
         return
     
     supabase_client.update_session(session_id, {
@@ -92,8 +132,8 @@ def handle_edit_field(chat_id, session_id, field_name):
         'status': 'awaiting_edit'
     })
     
-    current_value = session['parsed_data'].get(field_name, 'не указано')
-    telegram = TelegramService()
+    current_value = session['parsed_data'].get(field_name, NOT_FOUND)
+    telegram = telegram_service
     telegram.send_message(
         chat_id, 
         f"✏️ Введите новое значение для <b>{field_name}</b>:\n\n"
@@ -101,54 +141,123 @@ def handle_edit_field(chat_id, session_id, field_name):
         f"Просто напишите новое значение сообщением:"
     )
 
+@on_callback('edit_done')
+@timed
 def handle_edit_done(chat_id, session_id):
     session = supabase_client.get_session(session_id)
     if not session:
-        TelegramService().send_message(chat_id, "❌ Сессия не найдена")
+        telegram_service.send_message(chat_id, "❌ Сессия не найдена")
         return
     
     corrected_data = format_final_data(session['parsed_data'])
     
-    telegram = TelegramService()
+    telegram = telegram_service
     telegram.send_message(
         chat_id, 
         f"✅ Редактирование завершено!\n\n{corrected_data}\n\nВсё верно?", 
         telegram.create_ok_button(session_id)
     )
 
+@on_callback('edit_ok', 'username')
+@timed
 def handle_edit_ok(chat_id, session_id, username):
     session = supabase_client.get_session(session_id)
     if not session:
-        TelegramService().send_message(chat_id, "❌ Сессия не найдена")
+        telegram_service.send_message(chat_id, "❌ Сессия не найдена")
         return
     
-    bitrix_service = BitrixService()
+    # В Битрикс24 уходит строка из захвата, а не из кэша инстанса:
+    # правку могли сохранить на другом инстансе
+    claimed = session_locks.acquire(session_id)
+    if not claimed:
+        logging.info(f"⏭️ Session {session_id} is already being submitted")
+        return
     
-    item_id = bitrix_service.send_data(
-        session['parsed_data'], 
-        chat_id, 
-        username
+    submit_to_bitrix(
+        chat_id,
+        session_id,
+        claimed['parsed_data'],
+        username,
+        "✅ Данные переданы",
+        "📤 Исправленные данные отправлены"
     )
+
+def _submission_finisher(chat_id, session_id, parsed_data, success_text, log_text):
+    """Итог отправки: сообщение в чат, удаление сессии, снятие захвата"""
+    def finish(item_id):
+        try:
+            bitrix_id = bitrix_service.extract_bitrix_id(item_id) if item_id else None
+            final_data = format_final_data(parsed_data)
+            
+            if bitrix_id:
+                message = f"{success_text}, ID заявки: {bitrix_id}\n\n{final_data}"
+            else:
+                message = f"⚠️ Данные обработаны, но возникла ошибка при отправке в Битрикс24\n\n{final_data}"
+            
+            telegram_service.send_message(chat_id, message)
+            logging.info(f"{log_text}: {parsed_data}")
+            
+            supabase_client.delete_session(session_id)
+        finally:
+            session_locks.release(session_id)
+    return finish
+
+def submit_to_bitrix(chat_id, session_id, parsed_data, username, success_text, log_text):
+    """Отправка в Битрикс24 с итоговым сообщением; в пакетном режиме - через очередь.
     
-    bitrix_id = bitrix_service.extract_bitrix_id(item_id)
+    До итогового сообщения сессия остается в статусе submitting: если инстанс
+    выгрузят раньше, карту дошлет retry_stuck_submissions.
+    """
+    finish = _submission_finisher(chat_id, session_id, parsed_data, success_text, log_text)
     
-    final_data = format_final_data(session['parsed_data'])
+    if BITRIX_BATCH_MODE:
+        bitrix_queue.submit(parsed_data, finish)
+        telegram_service.send_message(
+            chat_id, "⏳ Данные приняты, ID заявки в Битрикс24 придет отдельным сообщением"
+        )
+        return
     
-    telegram = TelegramService()
-    if bitrix_id:
-        message = f"✅ Данные переданы, ID заявки: {bitrix_id}\n\n{final_data}"
-    else:
-        message = f"⚠️ Данные обработаны, но возникла ошибка при отправке в Битрикс24\n\n{final_data}"
+    try:
+        item_id = bitrix_service.send_data(parsed_data, chat_id, username)
+    except Exception:
+        session_locks.release(session_id)
+        raise
+    finish(item_id)
+
+def retry_stuck_submissions(limit: int = None) -> int:
+    """Досылает карты, зависшие в статусе submitting дольше BITRIX_SUBMIT_TIMEOUT;
+    вызывается по расписанию вместе с доработкой задач"""
+    timeout = float(os.getenv('BITRIX_SUBMIT_TIMEOUT', '300'))
+    limit = min(limit or int(os.getenv('BITRIX_RETRY_LIMIT', '50')), bitrix_queue.MAX_COMMANDS)
+    cutoff = (datetime.now(timezone.utc) - timedelta(seconds=timeout)).strftime('%Y-%m-%dT%H:%M:%SZ')
     
-    telegram.send_message(chat_id, message)
-    logging.info(f"📤 Исправленные данные отправлены: {session['parsed_data']}")
+    sessions = []
+    for session in supabase_client.find_stuck_submissions(cutoff, limit):
+        claimed = supabase_client.reclaim_session(session)
+        if claimed:
+            sessions.append(claimed)
+    if not sessions:
+        return 0
     
-    supabase_client.delete_session(session_id)
-
-def format_final_data(parsed_data):
-    return (
-        f"Участок: <b>{parsed_data['Участок']}</b>\n"
-        f"Изделие: <b>{parsed_data['Изделие']}</b>\n"
-        f"Номер чертежа: <b>{parsed_data['Номер чертежа']}</b>\n"
-        f"Номер изделия: <b>{parsed_data['Номер изделия']}</b>"
-    )
+    logging.warning(f"⚠️ Retrying {len(sessions)} stuck Bitrix24 submissions")
+    try:
+        results = bitrix_service.send_batch([bitrix_service.build_item(s['parsed_data']) for s in sessions])
+    except Exception as e:
+        logging.error(f"❌ Error retrying Bitrix24 submissions: {e}")
+        results = [False] * len(sessions)
+    
+    for session, item_id in zip(sessions, results):
+        finish = _submission_finisher(
+            session['chat_id'],
+            session['id'],
+            session['parsed_data'],
+            "✅ Данные переданы",
+            "📤 Зависшая отправка повторена"
+        )
+        try:
+            finish(item_id)
+        except Exception as e:
+            logging.error(f"❌ Error finishing retried submission {session['id']}: {e}")
+    
+    audit_log.flush()
+    return len(sessions)
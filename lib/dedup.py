@@ -0,0 +1,128 @@
+import os
+import time
+import logging
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from lib.supabase_client import supabase_client
+
+
+class UpdateDeduplicator:
+    """Отсекает повторную доставку одного и того же update_id от Telegram.
+
+    Быстрая проверка - окно последних update_id в памяти; общая для всех
+    инстансов - таблица processed_updates (update_id - первичный ключ),
+    где вставка строки и есть захват апдейта.
+    """
+
+    def __init__(self):
+        self.ttl = float(os.getenv('DEDUP_TTL', '86400'))
+        self.window_size = int(os.getenv('DEDUP_WINDOW', '10000'))
+        self.persist = os.getenv('DEDUP_PERSIST', 'true').lower() == 'true'
+        self._seen = OrderedDict()
+        self._lock = threading.Lock()
+        self.duplicates = 0
+
+    def is_duplicate(self, update_id) -> bool:
+        if update_id is None:
+            return False
+
+        now = time.monotonic()
+        with self._lock:
+            expires_at = self._seen.get(update_id)
+            if expires_at and expires_at > now:
+                self.duplicates += 1
+                return True
+            self._seen[update_id] = now + self.ttl
+            self._seen.move_to_end(update_id)
+            while len(self._seen) > self.window_size:
+                self._seen.popitem(last=False)
+
+        if self.persist and not self._claim(update_id):
+            with self._lock:
+                self.duplicates += 1
+            return True
+        return False
+
+    def release(self, update_id):
+        """Снимает захват апдейта, обработка которого упала: повторная доставка
+        от Telegram должна быть обработана, а не отброшена как дубликат"""
+        if update_id is None:
+            return
+        with self._lock:
+            self._seen.pop(update_id, None)
+        if not self.persist:
+            return
+        try:
+            supabase_client.supabase.table('processed_updates').delete().eq('update_id', update_id).execute()
+        except Exception as e:
+            logging.error(f"❌ Error releasing update_id {update_id}: {e}")
+
+    def purge_expired(self) -> int:
+        """Удаляет из processed_updates записи старше DEDUP_TTL; вызывается по расписанию"""
+        if not self.persist:
+            return 0
+        try:
+            cutoff = (datetime.now(timezone.utc) - timedelta(seconds=self.ttl)).strftime('%Y-%m-%dT%H:%M:%SZ')
+            result = supabase_client.supabase.table('processed_updates')\
+                .delete()\
+                .lt('created_at', cutoff)\
+                .execute()
+            return len(result.data or [])
+        except Exception as e:
+            logging.error(f"❌ Error purging processed updates: {e}")
+            return 0
+
+    def _claim(self, update_id) -> bool:
+        """True, если апдейт захвачен этим вызовом"""
+        try:
+            supabase_client.supabase.table('processed_updates').insert({'update_id': update_id}).execute()
+            return True
+        except Exception as e:
+            if 'duplicate' not in str(e) and '23505' not in str(e):
+                # Хранилище недоступно - не теряем апдейт
+                logging.error(f"❌ Error saving update_id {update_id}: {e}")
+                return True
+
+        # Апдейт уже видели; старую запись за пределами TTL перезахватываем
+        try:
+            cutoff = (datetime.now(timezone.utc) - timedelta(seconds=self.ttl)).strftime('%Y-%m-%dT%H:%M:%SZ')
+            result = supabase_client.supabase.table('processed_updates')\
+                .update({'created_at': 'now()'})\
+                .eq('update_id', update_id)\
+                .lt('created_at', cutoff)\
+                .execute()
+            return bool(result.data)
+        except Exception as e:
+            logging.error(f"❌ Error checking update_id {update_id}: {e}")
+            return False
+
+
+class SessionLocks:
+    """Не дает обработать одну сессию дважды (двойное нажатие кнопки)"""
+
+    def __init__(self):
+        self._active = set()
+        self._lock = threading.Lock()
+
+    def acquire(self, session_id: str):
+        """Захваченная строка сессии прямо из базы или None, если сессию уже отправляют"""
+        with self._lock:
+            if session_id in self._active:
+                return None
+            self._active.add(session_id)
+
+        # Между инстансами сессию захватывает условное обновление статуса
+        session = supabase_client.claim_session(session_id)
+        if not session:
+            self.release(session_id)
+            return None
+        return session
+
+    def release(self, session_id: str):
+        with self._lock:
+            self._active.discard(session_id)
+
+
+update_deduplicator = UpdateDeduplicator()
+session_locks = SessionLocks()
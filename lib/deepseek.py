@@ -1,6 +1,13 @@
-import requests
 import os
+import json
 import logging
+from lib.http_client import get_http_client
+from lib.cache import analysis_cache
+from utils.formatters import parse_extracted_data
+from lib.lazy import LazyService
+from lib.preprocess import image_preprocessor
+from utils.fields import FIELD_NAMES, FIELDS_BY_NAME, NOT_FOUND
+
 
 class DeepSeekService:
     def __init__(self):
@@ -9,34 +16,29 @@ class DeepSeekService:
             logging.error("❌ DeepSeek API key not set")
             raise ValueError("DeepSeek API key not set")
         
-        self.api_url = "https://api.deepseek.com/v1/chat/completions"
+        self.api_url = os.getenv('DEEPSEEK_API_URL', 'https://api.deepseek.com/v1/chat/completions')
+        self.http = get_http_client()
         logging.info("✅ DeepSeek service initialized")
     
-    def analyze_text(self, extracted_text: str) -> str:
+    def analyze_text(self, extracted_text: str, fields: list = None) -> str:
         try:
             if not extracted_text:
                 return "Текст не распознан"
             
-            headers = {
-                "Authorization": f"Bearer {self.api_key}",
-                "Content-Type": "application/json"
-            }
-            
-            prompt = self._build_prompt(extracted_text)
+            cache_key_text = self._cache_key(extracted_text, fields)
+            cached = analysis_cache.get(cache_key_text)
+            if cached:
+                logging.info("⚡ DeepSeek анализ взят из кэша")
+                return cached
             
-            payload = {
-                "model": "deepseek-chat",
-                "messages": [{"role": "user", "content": prompt}],
-                "max_tokens": 800,
-                "temperature": 0.1
-            }
-            
-            response = requests.post(self.api_url, json=payload, headers=headers, timeout=30)
+            payload = self._build_payload(extracted_text, fields)
+            response = self.http.post(self.api_url, json=payload, headers=self._headers())
             
             if response.status_code == 200:
                 result = response.json()
                 analysis = result['choices'][0]['message']['content']
                 logging.info("✅ DeepSeek анализ завершен")
+                analysis_cache.put(cache_key_text, analysis)
                 return analysis
             else:
                 logging.error(f"❌ Ошибка DeepSeek API: {response.status_code} - {response.text}")
@@ -46,24 +48,113 @@ class DeepSeekService:
             logging.error(f"❌ Ошибка DeepSeek: {e}")
             return f"Ошибка: {str(e)}"
     
-    def _build_prompt(self, extracted_text: str) -> str:
+    def analyze_text_stream(self, extracted_text: str, fields: list = None, on_update=None) -> str:
+        """Потоковый анализ через SSE.
+        
+        on_update(parsed_data) вызывается каждый раз, когда в ответе
+        появляется новое заполненное поле.
+        """
+        try:
+            if not extracted_text:
+                return "Текст не распознан"
+            
+            cache_key_text = self._cache_key(extracted_text, fields)
+            cached = analysis_cache.get(cache_key_text)
+            if cached:
+                logging.info("⚡ DeepSeek анализ взят из кэша")
+                if on_update:
+                    on_update(parse_extracted_data(cached))
+                return cached
+            
+            payload = self._build_payload(extracted_text, fields)
+            payload['stream'] = True
+            response = self.http.post(self.api_url, json=payload, headers=self._headers(), stream=True)
+            
+            if response.status_code != 200:
+                logging.error(f"❌ Ошибка DeepSeek API: {response.status_code} - {response.text}")
+                return f"Ошибка анализа: {response.status_code}"
+            
+            analysis = ''
+            found_fields = set()
+            try:
+                for raw_line in response.iter_lines():
+                    line = raw_line.decode('utf-8').strip()
+                    if not line.startswith('data:'):
+                        continue
+                    
+                    data = line[5:].strip()
+                    if data == '[DONE]':
+                        break
+                    
+                    delta = json.loads(data)['choices'][0].get('delta', {}).get('content')
+                    if not delta:
+                        continue
+                    
+                    analysis += delta
+                    if on_update and '\n' in delta:
+                        # Разбираем только завершенные строки
+                        parsed = parse_extracted_data(analysis[:analysis.rfind('\n')])
+                        new_fields = {f for f, v in parsed.items() if v != NOT_FOUND} - found_fields
+                        if new_fields:
+                            found_fields |= new_fields
+                            on_update(parsed)
+            finally:
+                response.close()
+            
+            if on_update:
+                on_update(parse_extracted_data(analysis))
+            
+            logging.info("✅ DeepSeek потоковый анализ завершен")
+            analysis_cache.put(cache_key_text, analysis)
+            return analysis
+            
+        except Exception as e:
+            logging.error(f"❌ Ошибка DeepSeek: {e}")
+            return f"Ошибка: {str(e)}"
+    
+    def _cache_key(self, extracted_text: str, fields: list = None) -> str:
+        # В модель уходят только первые 3000 символов - по ним и кэшируем
+        cache_key_text = extracted_text[:3000]
+        if fields:
+            cache_key_text = f"{','.join(fields)}\n{cache_key_text}"
+        return cache_key_text
+    
+    def _headers(self) -> dict:
+        return {
+            "Authorization": f"Bearer {self.api_key}",
+            "Content-Type": "application/json"
+        }
+    
+    def _build_payload(self, extracted_text: str, fields: list = None) -> dict:
+        return {
+            "model": "deepseek-chat",
+            "messages": [{"role": "user", "content": self._build_prompt(extracted_text, fields)}],
+            "max_tokens": 800,
+            "temperature": 0.1
+        }
+    
+    def _build_prompt(self, extracted_text: str, fields: list = None) -> str:
+        fields = fields or FIELD_NAMES
+        items = "\n".join(
+            f"{number}. {FIELDS_BY_NAME[field].prompt}" for number, field in enumerate(fields, 1)
+        )
+        answer_format = "\n".join(f"{field}: {FIELDS_BY_NAME[field].answer_hint}" for field in fields)
+        # Фото обрезается до шапки еще перед OCR - тогда весь текст и есть верхняя часть
+        scope = "(это уже только шапка документа)" if image_preprocessor.crops_header else "(первые 30% текста)"
         return f"""
-ПРОАНАЛИЗИРУЙ этот текст технического документа и извлеки ТОЛЬКО ключевую информацию из ВЕРХНЕЙ ЧАСТИ документа (первые 30% текста).
+ПРОАНАЛИЗИРУЙ этот текст технического документа и извлеки ТОЛЬКО ключевую информацию из ВЕРХНЕЙ ЧАСТИ документа {scope}.
 
 ТЕКСТ:
 {extracted_text[:3000]}
 
 ИЗВЛЕКИ ТОЛЬКО:
-1. Участок/цех (только ПЕРВЫЙ указанный участок, обычно в шапке)
-2. Наименование изделия (общее название)
-3. Номер чертежа (формат типа ТМГ.1000.2234 или ТМГ 2X2K2.250.01.00.00)
-4. Номер изделия
+{items}
 
 ФОРМАТ ОТВЕТА (строго):
-Участок: [первый участок из шапки]
-Изделие: [наименование изделия]
-Номер чертежа: [номер чертежа]
-Номер изделия: [номер изделия]
+{answer_format}
 
-Если что-то не найдено - пиши "не указано"
+Если что-то не найдено - пиши "{NOT_FOUND}"
 """
+
+
+deepseek_service = LazyService('deepseek', DeepSeekService)
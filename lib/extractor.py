@@ -0,0 +1,117 @@
+import os
+import re
+import logging
+
+from lib.preprocess import image_preprocessor
+from utils.fields import FIELD_NAMES as FIELDS, NOT_FOUND
+
+# (поле, шаблон, уверенность) - для каждого поля берется первое совпадение
+# с наибольшей уверенностью. Пробелы - только [ \t]: значение не должно
+# переходить на следующую строку
+PATTERNS = [
+    ('Номер чертежа', re.compile(r'\bТМГ[. ]?[0-9A-ZА-Я]+(?:\.[0-9A-ZА-Я]+){1,5}\b'), 0.95),
+    ('Номер чертежа', re.compile(r'\b[А-ЯA-Z]{2,4}\.\d{3,4}\.\d{2,4}(?:\.\d{2,3})*\b'), 0.7),
+    ('Участок', re.compile(r'(?im)^[ \t]*(?:участок|цех)[ \t]*(?:(?:№|N)[ \t]*[:.\-]?|[:.\-]|(?=\d))[ \t]*(\S.{0,60}?)[ \t]*$'), 0.9),
+    ('Изделие', re.compile(r'(?im)^[ \t]*(?:наименование[ \t]+изделия|наименование|изделие)[ \t]*[:.\-][ \t]*(\S.{0,80}?)[ \t]*$'), 0.85),
+    ('Номер изделия', re.compile(r'(?im)(?:номер[ \t]+изделия|№[ \t]*изделия|зав(?:одской)?\.?[ \t]*№)[ \t]*[:.\-]?[ \t]*((?=[\w\-/.]*\d)[\w\-/.]{1,30})'), 0.85),
+]
+
+
+class FieldExtractor:
+    """Быстрое извлечение полей из текста OCR без обращения к LLM"""
+
+    def __init__(self):
+        self.threshold = float(os.getenv('EXTRACTOR_CONFIDENCE', '0.8'))
+        # Как и в промпте DeepSeek, смотрим только на шапку документа; если
+        # фото обрезано до шапки еще перед OCR, весь текст и есть шапка
+        default_ratio = '1' if image_preprocessor.crops_header else '0.3'
+        self.head_ratio = float(os.getenv('EXTRACTOR_HEAD_RATIO', default_ratio))
+
+    def extract(self, text: str) -> dict:
+        """Возвращает {поле: {'value': ..., 'confidence': ...}}"""
+        result = {field: {'value': NOT_FOUND, 'confidence': 0.0} for field in FIELDS}
+        if not text:
+            return result
+
+        head = text[:max(int(len(text) * self.head_ratio), 500)]
+
+        for field, pattern, confidence in PATTERNS:
+            if result[field]['confidence'] >= confidence:
+                continue
+            match = pattern.search(head)
+            if not match:
+                continue
+            value = (match.group(1) if pattern.groups else match.group(0)).strip()
+            if value:
+                result[field] = {'value': value, 'confidence': confidence}
+
+        return result
+
+    def uncertain_fields(self, extracted: dict) -> list:
+        return [field for field in FIELDS if extracted[field]['confidence'] < self.threshold]
+
+    @staticmethod
+    def to_parsed_data(extracted: dict) -> dict:
+        return {field: extracted[field]['value'] for field in FIELDS}
+
+    @staticmethod
+    def to_analysis_text(parsed_data: dict) -> str:
+        """Текст в формате ответа DeepSeek, понятный parse_extracted_data"""
+        return '\n'.join(f"{field}: {parsed_data.get(field, NOT_FOUND)}" for field in FIELDS)
+
+
+def plan_extraction(extracted_text: str, extractor: FieldExtractor = None):
+    """Локальное извлечение: (результат с уверенностью, parsed_data, поля для DeepSeek)"""
+    extractor = extractor or FieldExtractor()
+    local = extractor.extract(extracted_text)
+    return local, extractor.to_parsed_data(local), extractor.uncertain_fields(local)
+
+
+def merge_llm_result(local: dict, parsed_data: dict, missing: list, analysis: str):
+    """Дополняет локальный результат ответом DeepSeek, возвращает (analysis_result, parsed_data)"""
+    from utils.formatters import parse_extracted_fields
+
+    llm_data = parse_extracted_fields(analysis)
+    for field in missing:
+        if llm_data[field]['confidence'] > 0 or local[field]['confidence'] == 0:
+            parsed_data[field] = llm_data[field]['value']
+
+    guessed = [field for field in missing if 0 < llm_data[field]['confidence'] < 1]
+    if guessed:
+        logging.info(f"🔎 Поля из ответа DeepSeek в нестрогом формате: {', '.join(guessed)}")
+
+    return FieldExtractor.to_analysis_text(parsed_data), parsed_data
+
+
+def llm_failed(analysis: str) -> bool:
+    """DeepSeekService при ошибке возвращает текст ошибки вместо ответа"""
+    return not analysis or analysis.startswith(('Ошибка', 'Текст не распознан'))
+
+
+def extract_with_fallback(extracted_text: str, deepseek, extractor: FieldExtractor = None, on_update=None):
+    """Извлекает поля локально и добирает неуверенные через DeepSeek.
+
+    Если передан on_update, DeepSeek вызывается в потоковом режиме и
+    on_update(parsed_data) получает промежуточные результаты.
+    Возвращает (analysis_result, parsed_data, complete); complete=False -
+    DeepSeek был нужен, но не ответил, и результат нельзя кэшировать.
+    """
+    local, parsed_data, missing = plan_extraction(extracted_text, extractor)
+
+    if not missing:
+        logging.info("⚡ Все поля извлечены локально, DeepSeek не нужен")
+        return FieldExtractor.to_analysis_text(parsed_data), parsed_data, True
+
+    logging.info(f"🤖 DeepSeek нужен для полей: {', '.join(missing)}")
+    if on_update:
+        def merge_update(partial):
+            on_update({
+                field: partial[field] if field in missing and partial[field] != NOT_FOUND else value
+                for field, value in parsed_data.items()
+            })
+        analysis = deepseek.analyze_text_stream(extracted_text, missing, merge_update)
+    else:
+        analysis = deepseek.analyze_text(extracted_text, missing)
+
+    analysis_result, parsed_data = merge_llm_result(local, parsed_data, missing, analysis)
+    return analysis_result, parsed_data, not llm_failed(analysis)
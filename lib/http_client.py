@@ -0,0 +1,109 @@
+import os
+import logging
+import threading
+from urllib.parse import urlsplit
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from lib.tracing import tracer
+
+# Таймауты по умолчанию для внешних сервисов (секунды)
+DEFAULT_TIMEOUTS = {
+    'api.telegram.org': 10,
+    'api.ocr.space': 30,
+    'api.deepseek.com': 30,
+}
+DEFAULT_TIMEOUT = 30
+
+# Повторы только на уровне соединения: запрос ещё не ушёл на сервер,
+# поэтому повтор безопасен и для POST
+DEFAULT_RETRIES = {
+    'api.telegram.org': 2,
+    'api.ocr.space': 1,
+    'api.deepseek.com': 1,
+}
+
+
+def _parse_host_map(value: str, cast):
+    """Разбирает строку вида 'host=value,host=value' из переменной окружения"""
+    result = {}
+    if not value:
+        return result
+    for item in value.split(','):
+        if '=' not in item:
+            continue
+        host, raw = item.split('=', 1)
+        try:
+            result[host.strip()] = cast(raw.strip())
+        except ValueError:
+            logging.warning(f"⚠️ Invalid HTTP setting ignored: {item}")
+    return result
+
+
+class HTTPClient:
+    """Общий для процесса транспорт с keep-alive пулами соединений по хостам"""
+
+    def __init__(self):
+        self.pool_connections = int(os.getenv('HTTP_POOL_CONNECTIONS', '10'))
+        self.pool_maxsize = int(os.getenv('HTTP_POOL_MAXSIZE', '10'))
+        self.backoff_factor = float(os.getenv('HTTP_BACKOFF_FACTOR', '0.3'))
+
+        self.timeouts = dict(DEFAULT_TIMEOUTS)
+        self.timeouts.update(_parse_host_map(os.getenv('HTTP_TIMEOUTS', ''), float))
+        self.default_timeout = float(os.getenv('HTTP_DEFAULT_TIMEOUT', str(DEFAULT_TIMEOUT)))
+
+        self.retries = dict(DEFAULT_RETRIES)
+        self.retries.update(_parse_host_map(os.getenv('HTTP_RETRIES', ''), int))
+
+        self.session = requests.Session()
+        self.session.mount('https://', self._build_adapter(0))
+        self.session.mount('http://', self._build_adapter(0))
+        for host, retries in self.retries.items():
+            self.session.mount(f"https://{host}/", self._build_adapter(retries))
+
+        logging.info("✅ HTTP client initialized")
+
+    def _build_adapter(self, retries: int) -> HTTPAdapter:
+        retry = Retry(
+            total=retries,
+            connect=retries,
+            read=0,
+            status=0,
+            backoff_factor=self.backoff_factor,
+            raise_on_status=False
+        )
+        return HTTPAdapter(
+            pool_connections=self.pool_connections,
+            pool_maxsize=self.pool_maxsize,
+            max_retries=retry
+        )
+
+    def timeout_for(self, url: str) -> float:
+        host = urlsplit(url).hostname or ''
+        return self.timeouts.get(host, self.default_timeout)
+
+    def request(self, method: str, url: str, **kwargs):
+        kwargs.setdefault('timeout', self.timeout_for(url))
+        # Для stream=True спан заканчивается на заголовках ответа
+        with tracer.span(f"http.{urlsplit(url).hostname}"):
+            return self.session.request(method, url, **kwargs)
+
+    def get(self, url: str, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url: str, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+
+_http_client = None
+_http_client_lock = threading.Lock()
+
+
+def get_http_client() -> HTTPClient:
+    """Возвращает общий HTTP-клиент, переживающий тёплые вызовы функции"""
+    global _http_client
+    if _http_client is None:
+        with _http_client_lock:
+            if _http_client is None:
+                _http_client = HTTPClient()
+    return _http_client
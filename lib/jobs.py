@@ -0,0 +1,382 @@
+import os
+import time
+import uuid
+import logging
+from datetime import datetime, timedelta, timezone
+from lib.supabase_client import supabase_client
+from lib.telegram import telegram_service, ProgressMessage
+from lib.ocr import ocr_service
+from lib.deepseek import deepseek_service
+from lib.cache import ocr_cache
+from lib.extractor import extract_with_fallback
+from lib.preprocess import image_preprocessor
+from lib.workers import archive_executor
+from lib.audit_log import audit_log
+from lib.tracing import tracer
+from utils.formatters import parse_extracted_data, format_data_for_display
+from utils.fields import NOT_FOUND
+
+# Этапы обработки фото; каждый следующий этап продолжает с последнего завершенного
+STAGES = ['queued', 'downloaded', 'ocr_done', 'analyzed', 'done']
+FINAL_STAGES = ('done', 'failed')
+
+
+def _timestamp(delta_seconds: float = 0) -> str:
+    moment = datetime.now(timezone.utc) + timedelta(seconds=delta_seconds)
+    return moment.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def _lease_free_filters(now: str) -> tuple:
+    """Фильтры "аренды нет" и "аренда истекла" - по одному запросу на каждый"""
+    return (
+        lambda query: query.is_('leased_until', 'null'),
+        lambda query: query.lt('leased_until', now),
+    )
+
+
+class PhotoJobQueue:
+    """Очередь задач обработки фото в таблице photo_jobs с арендой задач"""
+
+    def __init__(self):
+        self.table = 'photo_jobs'
+        self.visibility_timeout = int(os.getenv('JOB_VISIBILITY_TIMEOUT', '120'))
+        self.max_attempts = int(os.getenv('JOB_MAX_ATTEMPTS', '3'))
+        self.worker_id = uuid.uuid4().hex
+
+    def enqueue(self, session_id: str, chat_id: int, photo: dict, fallback_photo: dict = None):
+        """Создает задачу, уже арендованную этим воркером.
+
+        Аренда ставится при вставке: иначе /jobs/drain может захватить только
+        что созданную задачу раньше, чем её начнет создавший воркер. При
+        недоступной таблице возвращает задачу без id - её выполняют без аренды.
+        """
+        job = {
+            'session_id': session_id,
+            'chat_id': chat_id,
+            'file_id': photo['file_id'],
+            'file_unique_id': photo.get('file_unique_id'),
+            'fallback_file_id': (fallback_photo or photo)['file_id'],
+            'stage': 'queued',
+            'attempts': 0,
+            'lease_owner': self.worker_id,
+            'leased_until': _timestamp(self.visibility_timeout)
+        }
+        try:
+            result = supabase_client.supabase.table(self.table).insert(job).execute()
+            if result.data:
+                logging.info(f"✅ Photo job created: {result.data[0]['id']}")
+                return result.data[0]
+        except Exception as e:
+            logging.error(f"❌ Error creating photo job: {e}")
+
+        job['id'] = None
+        return job
+
+    def lease(self, job_id: str):
+        """Атомарно захватывает задачу, если она не арендована другим воркером.
+
+        Условие "аренды нет или она истекла" - два условных UPDATE: фильтра
+        or_ в клиенте supabase 1.x нет. Каждый UPDATE атомарен, поэтому из
+        нескольких воркеров задачу получает только один.
+        """
+        if not job_id:
+            return None
+        lease = {
+            'lease_owner': self.worker_id,
+            'leased_until': _timestamp(self.visibility_timeout)
+        }
+        now = _timestamp()
+        try:
+            for free in _lease_free_filters(now):
+                query = supabase_client.supabase.table(self.table)\
+                    .update(lease)\
+                    .eq('id', job_id)\
+                    .not_.in_('stage', list(FINAL_STAGES))
+                result = free(query).execute()
+                if result.data:
+                    return result.data[0]
+            return None
+        except Exception as e:
+            logging.error(f"❌ Error leasing photo job: {e}")
+            return None
+
+    def lease_batch(self, limit: int) -> list:
+        """Захватывает до limit незавершенных задач без аренды или с истекшей арендой"""
+        now = _timestamp()
+        rows = []
+        try:
+            for free in _lease_free_filters(now):
+                query = supabase_client.supabase.table(self.table)\
+                    .select('id, created_at')\
+                    .not_.in_('stage', list(FINAL_STAGES))
+                result = free(query).order('created_at').limit(limit).execute()
+                rows.extend(result.data or [])
+        except Exception as e:
+            logging.error(f"❌ Error listing photo jobs: {e}")
+            if not rows:
+                return []
+
+        jobs = []
+        for row in sorted(rows, key=lambda row: row.get('created_at') or '')[:limit]:
+            job = self.lease(row['id'])
+            if job:
+                jobs.append(job)
+        return jobs
+
+    def save(self, job_id: str, updates: dict):
+        """Сохраняет результат этапа и продлевает аренду"""
+        if not job_id:
+            return
+        updates = dict(updates)
+        updates['leased_until'] = _timestamp(self.visibility_timeout)
+        updates['updated_at'] = 'now()'
+        try:
+            supabase_client.supabase.table(self.table)\
+                .update(updates)\
+                .eq('id', job_id)\
+                .eq('lease_owner', self.worker_id)\
+                .execute()
+        except Exception as e:
+            logging.error(f"❌ Error saving photo job {job_id}: {e}")
+
+    def release(self, job_id: str, attempts: int, error: str):
+        """Снимает аренду после сбоя, чтобы задачу подхватил следующий запуск"""
+        self._finish_attempt(job_id, {'attempts': attempts, 'error': error, 'leased_until': None})
+
+    def fail(self, job_id: str, error: str):
+        self._finish_attempt(job_id, {'stage': 'failed', 'error': error, 'leased_until': None})
+
+    def _finish_attempt(self, job_id: str, updates: dict):
+        if not job_id:
+            return
+        updates['updated_at'] = 'now()'
+        try:
+            supabase_client.supabase.table(self.table).update(updates).eq('id', job_id).execute()
+        except Exception as e:
+            logging.error(f"❌ Error updating photo job {job_id}: {e}")
+
+
+photo_jobs = PhotoJobQueue()
+
+
+class PhotoJobRunner:
+    """Выполняет этапы задачи, начиная с последнего сохраненного"""
+
+    def __init__(self, queue: PhotoJobQueue = None):
+        self.queue = queue or photo_jobs
+        self.telegram = telegram_service
+        self.ocr = ocr_service
+        self.deepseek = deepseek_service
+        self.streaming = os.getenv('DEEPSEEK_STREAMING', 'false').lower() == 'true'
+        self.steps = {
+            'queued': self._download,
+            'downloaded': self._recognize,
+            'ocr_done': self._analyze,
+            'analyzed': self._finish,
+        }
+
+    def run(self, job: dict, status: ProgressMessage = None) -> bool:
+        """status - сообщение о ходе обработки, которое этапы редактируют на месте"""
+        job['_status'] = status or ProgressMessage(self.telegram, job['chat_id'])
+        with tracer.bind(job.get('session_id')), tracer.span('photo.total'):
+            return self._run(job)
+
+    def _run(self, job: dict) -> bool:
+        job_id = job.get('id')
+        try:
+            while job['stage'] not in FINAL_STAGES:
+                stage = job['stage']
+                with tracer.span(f"photo.{stage}"):
+                    updates = self.steps[stage](job)
+                if updates is None:
+                    self.queue.fail(job_id, f"stage {stage} failed")
+                    return False
+                job.update(updates)
+                self.queue.save(job_id, updates)
+                logging.info(f"✅ Photo job {job_id}: {stage} -> {job['stage']}")
+            return True
+
+        except Exception as e:
+            attempts = job.get('attempts', 0) + 1
+            logging.error(f"❌ Photo job {job_id} failed at {job['stage']} (attempt {attempts}): {e}")
+            if job_id and attempts < self.queue.max_attempts:
+                self.queue.release(job_id, attempts, str(e))
+            else:
+                self.queue.fail(job_id, str(e))
+                job['_status'].finish("❌ Произошла ошибка при обработке фото")
+            return False
+        finally:
+            audit_log.flush()
+
+    def _download(self, job: dict):
+        # Повторно присланный документ берем из кэша
+        cached = ocr_cache.get(file_unique_id=job.get('file_unique_id'))
+        content_hash = None
+
+        if not cached:
+            file_content, file_path = self.telegram.download_file(job['file_id'])
+            if not file_content:
+                job['_status'].finish("❌ Ошибка загрузки файла")
+                return None
+
+            content_hash = ocr_cache.hash_content(file_content)
+            cached = ocr_cache.get(content_hash=content_hash)
+
+        if cached:
+            return {
+                'stage': 'analyzed',
+                'content_hash': content_hash,
+                'extracted_text': cached['extracted_text'],
+                'analysis_result': cached['analysis_result'],
+                'parsed_data': parse_extracted_data(cached['analysis_result'])
+            }
+
+        if self.ocr.direct_upload:
+            # Файл уйдет в OCR напрямую, а в Storage - позже, вне критического пути
+            job['_file'] = (file_content, file_path)
+            storage_path = self.telegram.storage_path(file_path, job['session_id'])
+            file_url = supabase_client.get_file_url(storage_path)
+            return {'stage': 'downloaded', 'file_url': file_url, 'content_hash': content_hash}
+
+        # Документ сессии - оригинал; OCR.space получает по ссылке подготовленную копию
+        session_id = job['session_id']
+        ocr_content = image_preprocessor.process(file_content)
+        if ocr_content is file_content:
+            file_url = ocr_url = self.telegram.store_file(file_content, file_path, session_id)
+        else:
+            if not archive_executor.submit(self._archive, file_content, file_path, session_id):
+                self._archive(file_content, file_path, session_id)
+            file_url = supabase_client.get_file_url(self.telegram.storage_path(file_path, session_id))
+            ocr_url = self.telegram.store_file(ocr_content, 'ocr.jpg', session_id, name='ocr')
+        if not ocr_url:
+            job['_status'].finish("❌ Ошибка загрузки файла")
+            return None
+
+        return {'stage': 'downloaded', 'file_url': file_url, 'ocr_url': ocr_url, 'content_hash': content_hash}
+
+    def _recognize(self, job: dict):
+        job['_status'].update("🔍 Распознаю текст...")
+
+        # Извлекаем текст через OCR
+        if self.ocr.direct_upload:
+            extracted_text = self._recognize_bytes(job)
+        else:
+            extracted_text = self.ocr.extract_text_from_url(
+                job.get('ocr_url') or job['file_url'], job['session_id'], log_url=job['file_url']
+            )
+        
+        if image_preprocessor.is_low_confidence(extracted_text):
+            extracted_text = self._recognize_full_size(job, extracted_text)
+        
+        if not extracted_text:
+            job['_status'].finish("❌ Не удалось распознать текст. Попробуйте другое фото.")
+            return None
+
+        return {'stage': 'ocr_done', 'extracted_text': extracted_text}
+
+    def _recognize_bytes(self, job: dict):
+        # После перезапуска задачи байтов в памяти нет - скачиваем заново
+        file_content, file_path = job.get('_file') or self.telegram.download_file(job['file_id'])
+        if not file_content:
+            return None
+
+        if not archive_executor.submit(self._archive, file_content, file_path, job['session_id']):
+            self._archive(file_content, file_path, job['session_id'])
+
+        return self.ocr.extract_text_from_bytes(
+            image_preprocessor.process(file_content),
+            file_path.split('/')[-1],
+            job['session_id'],
+            job['file_url']
+        )
+
+    def _recognize_full_size(self, job: dict, extracted_text: str):
+        """Повтор OCR по самому большому фото без обрезки"""
+        fallback_file_id = job.get('fallback_file_id')
+        if not fallback_file_id or fallback_file_id == job['file_id']:
+            return extracted_text
+
+        logging.info("🔁 Low OCR confidence, retrying with full-size photo")
+        file_content, file_path = self.telegram.download_file(fallback_file_id)
+        if not file_content:
+            return extracted_text
+
+        retry_text = self.ocr.extract_text_from_bytes(
+            image_preprocessor.process(file_content, crop=False),
+            file_path.split('/')[-1],
+            job['session_id'],
+            job['file_url']
+        )
+        if retry_text and len(retry_text) > len(extracted_text or ''):
+            return retry_text
+        return extracted_text
+
+    def _archive(self, file_content: bytes, file_path: str, session_id: str):
+        """Отложенная загрузка оригинала в Supabase Storage"""
+        started_at = time.monotonic()
+        if self.telegram.store_file(file_content, file_path, session_id):
+            # Раньше это время OCR ждал загрузки в Storage
+            logging.info(f"⏱️ Archiving off the OCR path saved {time.monotonic() - started_at:.2f}s on session {session_id}")
+
+    def _analyze(self, job: dict):
+        extracted_text = job['extracted_text']
+        status = job['_status']
+        status.update("🤖 Анализирую документ...")
+
+        # В потоковом режиме поля показываются в том же статусе по мере появления
+        on_update = None
+        if self.streaming:
+            on_update = lambda partial: status.update(
+                f"🤖 Анализирую документ...\n\n{format_data_for_display(partial)}"
+            )
+
+        # Извлекаем поля локально, DeepSeek - только для неуверенных
+        analysis_result, parsed_data, complete = extract_with_fallback(
+            extracted_text, self.deepseek, on_update=on_update
+        )
+
+        # Кэшируем только успешный анализ: если DeepSeek не ответил, повторная
+        # отправка фото должна снова его спросить
+        if complete and any(value != NOT_FOUND for value in parsed_data.values()):
+            ocr_cache.put(
+                {'extracted_text': extracted_text, 'analysis_result': analysis_result},
+                file_unique_id=job.get('file_unique_id'),
+                content_hash=job.get('content_hash'),
+                session_id=job['session_id']
+            )
+
+        return {'stage': 'analyzed', 'analysis_result': analysis_result, 'parsed_data': parsed_data}
+
+    def _finish(self, job: dict):
+        session_id = job['session_id']
+        parsed_data = job['parsed_data']
+
+        supabase_client.update_session(session_id, {
+            'parsed_data': parsed_data,
+            'status': 'pending_verification'
+        })
+
+        # Показываем результаты
+        formatted_data = format_data_for_display(parsed_data)
+        job['_status'].finish(
+            f"{formatted_data}\n\n<b>Проверьте данные:</b>",
+            self.telegram.create_verification_buttons(session_id)
+        )
+
+        logging.info(f"✅ Photo processed for chat {job['chat_id']}, session {session_id}")
+        return {'stage': 'done'}
+
+
+def drain_jobs(limit: int = None) -> int:
+    """Доделывает зависшие задачи; вызывается по расписанию"""
+    limit = limit or int(os.getenv('JOB_DRAIN_LIMIT', '5'))
+    jobs = photo_jobs.lease_batch(limit)
+    if not jobs:
+        return 0
+
+    runner = PhotoJobRunner()
+    for job in jobs:
+        runner.run(job)
+
+    logging.info(f"✅ Drained {len(jobs)} photo jobs")
+    return len(jobs)
@@ -0,0 +1,59 @@
+import time
+import logging
+import importlib
+import threading
+from lib.tracing import tracer
+
+
+class LazyService:
+    """Сервис, создаваемый при первом обращении и живущий до конца процесса.
+
+    Прокси отдает атрибуты настоящего экземпляра, поэтому вызовы вида
+    supabase_client.get_session(...) не меняются. Время создания пишется
+    в спан init.<имя>; ошибка конструктора не кэшируется.
+    """
+
+    def __init__(self, name: str, factory):
+        self._name = name
+        self._factory = factory
+        self._instance = None
+        self._lock = threading.Lock()
+
+    def _get(self):
+        if self._instance is None:
+            with self._lock:
+                if self._instance is None:
+                    started_at = time.monotonic()
+                    self._instance = self._factory()
+                    tracer.record(f"init.{self._name}", time.monotonic() - started_at)
+        return self._instance
+
+    @property
+    def initialized(self) -> bool:
+        return self._instance is not None
+
+    def __getattr__(self, name):
+        return getattr(self._get(), name)
+
+
+_imported = set()
+_imported_lock = threading.Lock()
+
+
+def timed_import(module_name: str):
+    """Отложенный импорт модуля; время первого импорта пишется в спан import.<модуль>.
+
+    import_module берет блокировку модуля, поэтому второй поток дождется
+    конца импорта, а не получит недогруженный модуль из sys.modules.
+    """
+    started_at = time.monotonic()
+    module = importlib.import_module(module_name)
+    with _imported_lock:
+        if module_name in _imported:
+            return module
+        _imported.add(module_name)
+
+    duration = time.monotonic() - started_at
+    tracer.record(f"import.{module_name}", duration)
+    logging.info(f"📦 Imported {module_name} in {duration:.3f}s")
+    return module
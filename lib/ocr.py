@@ -1,8 +1,31 @@
-import requests
 import os
 import logging
 import time
-from lib.supabase_client import supabase_client
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from lib.http_client import get_http_client
+from lib.ocr_backends import build_backends
+from lib.audit_log import audit_log
+from lib.lazy import LazyService
+
+# Бэкенды и их статистика живут весь процесс, а не один запрос
+_backends = None
+_backends_lock = threading.Lock()
+_hedge_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix='ocr-hedge')
+
+
+def get_backends(api_key: str) -> list:
+    global _backends
+    if _backends is None:
+        with _backends_lock:
+            if _backends is None:
+                _backends = build_backends(
+                    os.getenv('OCR_BACKENDS', 'ocrspace:2,ocrspace:1'),
+                    api_key,
+                    get_http_client()
+                )
+    return _backends
+
 
 class OCRService:
     def __init__(self):
@@ -12,44 +35,41 @@ class OCRService:
             raise ValueError("OCR Space API key not set")
         
         self.max_retries = 3
+        # Отправлять в OCR сами байты, а не ссылку на Supabase Storage
+        self.direct_upload = os.getenv('OCR_DIRECT_UPLOAD', 'false').lower() == 'true'
+        # Запасной бэкенд запускается, если основной не ответил за этот перцентиль задержки
+        self.hedge_enabled = os.getenv('OCR_HEDGE', 'true').lower() == 'true'
+        self.hedge_percentile = float(os.getenv('OCR_HEDGE_PERCENTILE', '0.9'))
+        self.hedge_delay = float(os.getenv('OCR_HEDGE_DELAY', '8'))
+        self.backends = get_backends(self.api_key)
         logging.info("✅ OCR service initialized")
     
-    def extract_text_from_url(self, image_url: str, session_id: str = None):
+    def extract_text_from_url(self, image_url: str, session_id: str = None, log_url: str = None):
+        """log_url - ссылка на документ для журнала, если OCR получает копию"""
+        logging.info(f"🔄 OCR for URL: {image_url[:100]}...")
+        return self._extract_with_retries({'image_url': image_url}, session_id, log_url or image_url)
+    
+    def extract_text_from_bytes(self, file_content: bytes, file_name: str, session_id: str = None, file_url: str = None):
+        """OCR по уже скачанному файлу, без повторной загрузки по ссылке"""
+        logging.info(f"🔄 OCR for file: {file_name} ({len(file_content)} bytes)")
+        return self._extract_with_retries(
+            {'file_content': file_content, 'file_name': file_name},
+            session_id,
+            file_url
+        )
+    
+    def _extract_with_retries(self, request: dict, session_id: str = None, file_url: str = None):
         for attempt in range(self.max_retries):
             try:
-                logging.info(f"🔄 OCR attempt {attempt + 1} for URL: {image_url[:100]}...")
+                logging.info(f"🔄 OCR attempt {attempt + 1}")
                 
-                response = requests.post(
-                    'https://api.ocr.space/parse/image',
-                    data={
-                        'apikey': self.api_key,
-                        'url': image_url,
-                        'language': 'rus',
-                        'isOverlayRequired': False,
-                        'OCREngine': 2,
-                    },
-                    timeout=30
-                )
+                text = self._recognize_hedged(request)
+                if text is not None:
+                    logging.info("✅ OCR text extracted successfully")
+                    self._log_document(session_id, file_url, text)
+                    return text.strip()
                 
-                if response.status_code == 200:
-                    result = response.json()
-                    if not result.get('IsErroredOnProcessing', True):
-                        parsed_results = result.get('ParsedResults', [])
-                        if parsed_results:
-                            text = parsed_results[0].get('ParsedText', '')
-                            logging.info("✅ OCR text extracted successfully")
-                            
-                            if session_id:
-                                supabase_client.supabase.table('processed_documents').insert({
-                                    'session_id': session_id,
-                                    'supabase_file_url': image_url,
-                                    'extracted_text': text[:1000]
-                                }).execute()
-                            
-                            return text.strip()
-                
-                error_msg = result.get('ErrorMessage', 'Unknown error')
-                logging.warning(f"⚠️ OCR attempt {attempt + 1} failed: {error_msg}")
+                logging.warning(f"⚠️ OCR attempt {attempt + 1} failed")
                 
                 if attempt < self.max_retries - 1:
                     wait_time = 2 ** attempt
@@ -63,3 +83,75 @@ class OCRService:
         
         logging.error(f"❌ All {self.max_retries} OCR attempts failed")
         return None
+    
+    def _recognize_hedged(self, request: dict):
+        """Основной бэкенд, а при задержке или ошибке - следующий; берется первый успешный ответ.
+        
+        Предохранитель спрашивается только перед запуском бэкенда: allow() в
+        half-open занимает пробный запрос, и незапущенный бэкенд его бы не вернул.
+        """
+        if not self.hedge_enabled:
+            started = False
+            for backend in self.backends:
+                if not backend.breaker.allow():
+                    continue
+                started = True
+                text = backend.timed_recognize(**request)
+                if text is not None:
+                    return text
+            if not started:
+                logging.error("❌ All OCR backends are unavailable (circuit open)")
+            return None
+        
+        remaining = iter(self.backends)
+        pending = set()
+        backend = self._start_next(remaining, pending, request)
+        if backend is None:
+            logging.error("❌ All OCR backends are unavailable (circuit open)")
+            return None
+        
+        while backend is not None:
+            # Ждем запущенный бэкенд не дольше его обычной задержки
+            delay = backend.latency_percentile(self.hedge_percentile, self.hedge_delay)
+            deadline = time.monotonic() + delay
+            while pending:
+                done, _ = wait(pending, timeout=max(deadline - time.monotonic(), 0), return_when=FIRST_COMPLETED)
+                pending -= done
+                for future in done:
+                    if future.result() is not None:
+                        return future.result()
+                if not done:
+                    break
+            
+            backend = self._start_next(remaining, pending, request)
+            if backend is not None:
+                logging.info(f"🔀 OCR hedge: starting {backend.name}")
+        
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            pending -= done
+            for future in done:
+                if future.result() is not None:
+                    return future.result()
+        return None
+    
+    @staticmethod
+    def _start_next(remaining, pending: set, request: dict):
+        """Запускает следующий бэкенд, который пропускает предохранитель"""
+        for backend in remaining:
+            if backend.breaker.allow():
+                pending.add(_hedge_executor.submit(backend.timed_recognize, **request))
+                return backend
+        return None
+    
+    @staticmethod
+    def _log_document(session_id: str, image_url: str, text: str):
+        if session_id:
+            audit_log.add('processed_documents', {
+                'session_id': session_id,
+                'supabase_file_url': image_url,
+                'extracted_text': text[:1000]
+            })
+
+
+ocr_service = LazyService('ocr', OCRService)
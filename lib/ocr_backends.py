@@ -0,0 +1,191 @@
+import io
+import os
+import time
+import logging
+import threading
+from collections import deque
+from lib.tracing import tracer
+
+try:
+    import pytesseract
+    from PIL import Image
+except ImportError:
+    pytesseract = None
+
+
+class CircuitBreaker:
+    """Перестает отправлять запросы в бэкенд после серии ошибок.
+
+    closed -> open после failure_threshold ошибок подряд; через reset_timeout
+    пропускается один пробный запрос (half-open).
+    """
+
+    def __init__(self, failure_threshold: int = 3, reset_timeout: float = 60):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return 'closed'
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return 'half_open'
+        return 'open'
+
+    def allow(self) -> bool:
+        with self._lock:
+            state = self.state
+            if state == 'closed':
+                return True
+            if state == 'half_open' and not self._probe_in_flight:
+                self._probe_in_flight = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._probe_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._probe_in_flight = False
+            if self.failures >= self.failure_threshold or self.opened_at is not None:
+                self.opened_at = time.monotonic()
+
+
+class OCRBackend:
+    """Базовый класс бэкенда OCR: recognize возвращает текст или None"""
+
+    name = 'base'
+
+    def __init__(self):
+        self.breaker = CircuitBreaker(
+            failure_threshold=int(os.getenv('OCR_BREAKER_FAILURES', '3')),
+            reset_timeout=float(os.getenv('OCR_BREAKER_RESET', '60'))
+        )
+        self.latencies = deque(maxlen=100)
+        self._lock = threading.Lock()
+
+    def recognize(self, image_url: str = None, file_content: bytes = None, file_name: str = None):
+        raise NotImplementedError
+
+    def timed_recognize(self, **request):
+        """recognize с учетом задержки и состояния предохранителя"""
+        started_at = time.monotonic()
+        try:
+            text = self.recognize(**request)
+        except Exception as e:
+            logging.error(f"❌ OCR backend {self.name} error: {e}")
+            text = None
+
+        duration = time.monotonic() - started_at
+        with self._lock:
+            self.latencies.append(duration)
+        tracer.record(f"ocr.{self.name}", duration, failed=text is None)
+        if text is None:
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_success()
+        return text
+
+    def latency_percentile(self, percentile: float, default: float) -> float:
+        with self._lock:
+            samples = sorted(self.latencies)
+        if len(samples) < 10:
+            return default
+        return samples[min(int(len(samples) * percentile), len(samples) - 1)]
+
+
+class OCRSpaceBackend(OCRBackend):
+    def __init__(self, api_key: str, http, engine: int = 2):
+        super().__init__()
+        self.name = f"ocrspace:{engine}"
+        self.api_key = api_key
+        self.http = http
+        self.engine = engine
+        self.api_url = os.getenv('OCR_SPACE_API_URL', 'https://api.ocr.space/parse/image')
+
+    def request_data(self, image_url: str = None) -> dict:
+        data = {
+            'apikey': self.api_key,
+            'language': 'rus',
+            'isOverlayRequired': False,
+            'OCREngine': self.engine,
+        }
+        if image_url:
+            data['url'] = image_url
+        return data
+
+    def recognize(self, image_url: str = None, file_content: bytes = None, file_name: str = None):
+        if file_content is not None:
+            response = self.http.post(
+                self.api_url,
+                data=self.request_data(),
+                files={'file': (file_name or 'document.jpg', file_content)}
+            )
+        else:
+            response = self.http.post(self.api_url, data=self.request_data(image_url))
+
+        result = response.json() if response.status_code == 200 else {}
+        text = self.parse_result(result)
+        if text is None:
+            error_msg = result.get('ErrorMessage', f"HTTP {response.status_code}")
+            logging.warning(f"⚠️ OCR backend {self.name} failed: {error_msg}")
+        return text
+
+    @staticmethod
+    def parse_result(result: dict):
+        """Текст из ответа OCR.space или None, если распознавание не удалось"""
+        if result.get('IsErroredOnProcessing', True):
+            return None
+        parsed_results = result.get('ParsedResults', [])
+        if not parsed_results:
+            return None
+        return parsed_results[0].get('ParsedText', '')
+
+
+class TesseractBackend(OCRBackend):
+    """Локальный Tesseract; нужен бинарник tesseract и пакет pytesseract"""
+
+    name = 'tesseract'
+
+    def __init__(self, http):
+        super().__init__()
+        if pytesseract is None:
+            raise ValueError("pytesseract is not installed")
+        self.http = http
+
+    def recognize(self, image_url: str = None, file_content: bytes = None, file_name: str = None):
+        if file_content is None:
+            response = self.http.get(image_url)
+            if response.status_code != 200:
+                return None
+            file_content = response.content
+
+        text = pytesseract.image_to_string(Image.open(io.BytesIO(file_content)), lang='rus')
+        return text if text.strip() else None
+
+
+def build_backends(spec: str, api_key: str, http) -> list:
+    """Бэкенды из строки вида 'ocrspace:2,ocrspace:1,tesseract'"""
+    backends = []
+    for item in spec.split(','):
+        item = item.strip()
+        try:
+            if item.startswith('ocrspace'):
+                engine = int(item.split(':')[1]) if ':' in item else 2
+                backends.append(OCRSpaceBackend(api_key, http, engine))
+            elif item == 'tesseract':
+                backends.append(TesseractBackend(http))
+            elif item:
+                logging.warning(f"⚠️ Unknown OCR backend: {item}")
+        except ValueError as e:
+            logging.warning(f"⚠️ OCR backend {item} disabled: {e}")
+    return backends
@@ -0,0 +1,91 @@
+import io
+import os
+import logging
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+    ImageOps = None
+
+
+class ImagePreprocessor:
+    """Подготовка фото к OCR: выбор размера, обрезка шапки, оттенки серого,
+    выравнивание наклона и сжатие. Без Pillow фото уходит в OCR как есть."""
+
+    def __init__(self):
+        self.enabled = Image is not None and os.getenv('OCR_PREPROCESS', 'true').lower() == 'true'
+        self.target_pixels = int(os.getenv('OCR_TARGET_PIXELS', '1000000'))
+        # Доля высоты сверху, где находятся нужные поля (0 - не обрезать)
+        self.crop_ratio = float(os.getenv('OCR_CROP_TOP', '0.35'))
+        self.max_side = int(os.getenv('OCR_MAX_SIDE', '2000'))
+        self.jpeg_quality = int(os.getenv('OCR_JPEG_QUALITY', '80'))
+        self.deskew_max_angle = float(os.getenv('OCR_DESKEW_MAX_ANGLE', '3'))
+        self.min_text_length = int(os.getenv('OCR_MIN_TEXT_LENGTH', '40'))
+
+    @property
+    def crops_header(self) -> bool:
+        """В OCR уходит только шапка фото - текст уже не нужно обрезать"""
+        return self.enabled and 0 < self.crop_ratio < 1
+
+    def select_photo(self, photos: list):
+        """Самый маленький PhotoSize с нужным числом пикселей и самый большой для повтора"""
+        by_size = sorted(photos, key=lambda p: p.get('width', 0) * p.get('height', 0))
+        largest = by_size[-1]
+        for photo in by_size:
+            if photo.get('width', 0) * photo.get('height', 0) >= self.target_pixels:
+                return photo, largest
+        return largest, largest
+
+    def process(self, file_content: bytes, crop: bool = True) -> bytes:
+        if not self.enabled:
+            return file_content
+        try:
+            image = ImageOps.exif_transpose(Image.open(io.BytesIO(file_content))).convert('L')
+            image = self._deskew(image)
+
+            if crop and 0 < self.crop_ratio < 1:
+                image = image.crop((0, 0, image.width, int(image.height * self.crop_ratio)))
+
+            image.thumbnail((self.max_side, self.max_side))
+
+            output = io.BytesIO()
+            image.save(output, format='JPEG', quality=self.jpeg_quality, optimize=True)
+            processed = output.getvalue()
+            logging.info(f"🖼️ Image preprocessed: {len(file_content)} -> {len(processed)} bytes")
+            return processed
+
+        except Exception as e:
+            logging.error(f"❌ Error preprocessing image: {e}")
+            return file_content
+
+    def _deskew(self, image):
+        """Угол наклона по дисперсии профиля строк: у ровного текста она максимальна"""
+        if self.deskew_max_angle <= 0:
+            return image
+
+        thumb = image.copy()
+        thumb.thumbnail((400, 400))
+        steps = int(self.deskew_max_angle * 2)
+        best_angle, best_score = 0.0, -1.0
+
+        for step in range(-steps, steps + 1):
+            angle = step / 2
+            rotated = thumb.rotate(angle, fillcolor=255)
+            profile = list(rotated.resize((1, rotated.height), Image.BOX).getdata())
+            mean = sum(profile) / len(profile)
+            score = sum((value - mean) ** 2 for value in profile)
+            if score > best_score:
+                best_angle, best_score = angle, score
+
+        if best_angle == 0:
+            return image
+        logging.info(f"🖼️ Deskew by {best_angle}°")
+        return image.rotate(best_angle, expand=True, fillcolor=255)
+
+    def is_low_confidence(self, text: str) -> bool:
+        """Слишком мало текста - вероятно, фото слишком мелкое или обрезано неудачно"""
+        return not text or len(text.strip()) < self.min_text_length
+
+
+image_preprocessor = ImagePreprocessor()
@@ -0,0 +1,125 @@
+import os
+import time
+import threading
+
+
+class TokenBucket:
+    """rate токенов в секунду, не больше capacity подряд; blocked_until - пауза после 429"""
+
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated_at', 'blocked_until')
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self.blocked_until = 0.0
+
+    def refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def wait_time(self, now: float) -> float:
+        """Сколько ждать до следующего токена (refill уже сделан)"""
+        wait = (1 - self.tokens) / self.rate if self.tokens < 1 else 0.0
+        return max(wait, self.blocked_until - now)
+
+    def idle(self, now: float) -> bool:
+        return self.tokens >= self.capacity and self.blocked_until <= now
+
+
+class TelegramRateLimiter:
+    """Ограничение исходящих сообщений Telegram: на чат и на весь бот.
+
+    acquire() блокирует вызывающий поток, пока в обоих ведрах нет токена,
+    поэтому сообщения не теряются, а ждут своей очереди. После 429
+    penalize() ставит чат (или весь бот) на паузу на retry_after секунд.
+    Ограничение действует в пределах инстанса.
+    """
+
+    def __init__(self):
+        self.chat_rate = float(os.getenv('TELEGRAM_CHAT_RATE', '1'))
+        self.chat_burst = float(os.getenv('TELEGRAM_CHAT_BURST', '3'))
+        self.global_rate = float(os.getenv('TELEGRAM_GLOBAL_RATE', '30'))
+        self.global_burst = float(os.getenv('TELEGRAM_GLOBAL_BURST', '30'))
+        self.max_chats = int(os.getenv('TELEGRAM_LIMITER_CHATS', '1000'))
+
+        self._global = TokenBucket(self.global_rate, self.global_burst)
+        self._chats = {}
+        self._lock = threading.Lock()
+        self._waiting = {}
+
+        self.sent = 0
+        self.throttled = 0
+        self.wait_total = 0.0
+        self.rate_limited = 0
+
+    def acquire(self, chat_id=None) -> float:
+        """Ждет разрешения на отправку, возвращает время ожидания"""
+        started_at = time.monotonic()
+        queued = False
+        try:
+            while True:
+                with self._lock:
+                    now = time.monotonic()
+                    chat = self._chat_bucket(chat_id, now) if chat_id is not None else None
+                    self._global.refill(now)
+                    wait = self._global.wait_time(now)
+                    if chat:
+                        chat.refill(now)
+                        wait = max(wait, chat.wait_time(now))
+
+                    if wait <= 0:
+                        self._global.tokens -= 1
+                        if chat:
+                            chat.tokens -= 1
+                        self.sent += 1
+                        waited = now - started_at
+                        if queued:
+                            self.throttled += 1
+                            self.wait_total += waited
+                        return waited
+
+                    if not queued:
+                        queued = True
+                        self._waiting[chat_id] = self._waiting.get(chat_id, 0) + 1
+                time.sleep(wait)
+        finally:
+            if queued:
+                with self._lock:
+                    self._waiting[chat_id] -= 1
+                    if not self._waiting[chat_id]:
+                        del self._waiting[chat_id]
+
+    def penalize(self, chat_id, retry_after: float):
+        """429 от Telegram: пауза для чата, а без chat_id - для всего бота"""
+        with self._lock:
+            self.rate_limited += 1
+            now = time.monotonic()
+            bucket = self._chat_bucket(chat_id, now) if chat_id is not None else self._global
+            bucket.blocked_until = max(bucket.blocked_until, now + retry_after)
+
+    def _chat_bucket(self, chat_id, now: float) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) >= self.max_chats:
+                # Полные ведра без пауз ничего не помнят - их можно выбросить
+                for key in [key for key, value in self._chats.items() if value.idle(now)]:
+                    del self._chats[key]
+            bucket = self._chats[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'queue_depth': sum(self._waiting.values()),
+                'waiting_chats': len(self._waiting),
+                'tracked_chats': len(self._chats),
+                'sent': self.sent,
+                'throttled': self.throttled,
+                'wait_total': round(self.wait_total, 3),
+                'rate_limited': self.rate_limited
+            }
+
+
+telegram_limiter = TelegramRateLimiter()
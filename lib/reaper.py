@@ -0,0 +1,48 @@
+import os
+import logging
+from datetime import datetime, timedelta, timezone
+from lib.supabase_client import supabase_client
+from lib.dedup import update_deduplicator
+
+
+def reap_sessions(limit: int = None) -> dict:
+    """Удаляет сессии, не менявшиеся дольше SESSION_TTL, вместе с их файлами и задачами.
+
+    Заодно чистит processed_updates от записей старше DEDUP_TTL и завершенные
+    задачи photo_jobs старше SESSION_TTL.
+
+    Сначала удаляются файлы: пока строка сессии жива, следующий запуск
+    найдет ее и дочистит Storage, а наоборот файлы остались бы навсегда.
+    """
+    ttl = float(os.getenv('SESSION_TTL', '86400'))
+    limit = limit or int(os.getenv('SESSION_REAP_LIMIT', '200'))
+    cutoff = (datetime.now(timezone.utc) - timedelta(seconds=ttl)).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+    updates = update_deduplicator.purge_expired()
+    if updates:
+        logging.info(f"🧹 Purged {updates} expired update ids")
+
+    # Завершенные задачи, чьи сессии удалены раньше, чем delete_session стал удалять задачи
+    try:
+        supabase_client.supabase.table('photo_jobs')\
+            .delete()\
+            .in_('stage', ['done', 'failed'])\
+            .lt('updated_at', cutoff)\
+            .execute()
+    except Exception as e:
+        logging.error(f"❌ Error deleting finished photo jobs: {e}")
+
+    session_ids = supabase_client.find_stale_sessions(cutoff, limit)
+    if not session_ids:
+        return {'sessions': 0, 'files': 0, 'updates': updates}
+
+    files = supabase_client.delete_session_files(session_ids)
+
+    try:
+        supabase_client.supabase.table('photo_jobs').delete().in_('session_id', session_ids).execute()
+    except Exception as e:
+        logging.error(f"❌ Error deleting photo jobs of stale sessions: {e}")
+
+    sessions = supabase_client.delete_sessions(session_ids)
+    logging.info(f"🧹 Reaped {sessions} stale sessions, {files} files")
+    return {'sessions': sessions, 'files': files, 'updates': updates}
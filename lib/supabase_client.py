@@ -1,6 +1,11 @@
 import os
-from supabase_py import create_client, Client
+import copy
+import time
+import threading
 import logging
+from lib.tracing import tracer
+from lib.lazy import LazyService
+from utils.fields import empty_data
 
 class SupabaseService:
     def __init__(self):
@@ -10,26 +15,60 @@ class SupabaseService:
             logging.error("❌ Supabase credentials not set")
             raise ValueError("Supabase credentials not set")
         
-        self.supabase: Client = create_client(self.url, self.key)
+        # supabase_py тяжелый, импортируется только при первом обращении
+        from supabase_py import create_client
+        self.supabase = create_client(self.url, self.key)
+        
+        # Write-through кэш сессий: session_id -> (истекает, строка). Версия
+        # строки - её updated_at, по нему обновление проверяет устаревание.
+        self.session_cache_ttl = float(os.getenv('SESSION_CACHE_TTL', '300'))
+        self.update_attempts = int(os.getenv('SESSION_UPDATE_ATTEMPTS', '3'))
+        self._sessions = {}
+        self._awaiting_edit = {}
+        self._cache_lock = threading.Lock()
         logging.info("✅ Supabase client initialized")
     
+    def _cache_session(self, session: dict):
+        if self.session_cache_ttl <= 0 or not session:
+            return
+        with self._cache_lock:
+            self._sessions[session['id']] = (time.monotonic() + self.session_cache_ttl, copy.deepcopy(session))
+            if session.get('status') == 'awaiting_edit':
+                self._awaiting_edit[session['chat_id']] = session['id']
+            elif self._awaiting_edit.get(session['chat_id']) == session['id']:
+                del self._awaiting_edit[session['chat_id']]
+    
+    def _cached_session(self, session_id: str):
+        with self._cache_lock:
+            entry = self._sessions.get(session_id)
+            if not entry:
+                return None
+            expires_at, session = entry
+            if expires_at < time.monotonic():
+                del self._sessions[session_id]
+                return None
+            return copy.deepcopy(session)
+    
+    def _forget_session(self, session_id: str):
+        with self._cache_lock:
+            entry = self._sessions.pop(session_id, None)
+            if entry and self._awaiting_edit.get(entry[1]['chat_id']) == session_id:
+                del self._awaiting_edit[entry[1]['chat_id']]
+    
+    @tracer.traced('supabase.create_session')
     def create_session(self, chat_id: int, extracted_data: str = None):
         try:
             data = {
                 'chat_id': chat_id,
                 'extracted_data': extracted_data,
-                'parsed_data': {
-                    'Участок': 'не указано',
-                    'Изделие': 'не указано',
-                    'Номер чертежа': 'не указано', 
-                    'Номер изделия': 'не указано'
-                },
+                'parsed_data': empty_data(),
                 'status': 'pending_verification'
             }
             
             result = self.supabase.table('sessions').insert(data).execute()
             if result.data:
                 logging.info(f"✅ Session created: {result.data[0]['id']}")
+                self._cache_session(result.data[0])
                 return result.data[0]
             return None
             
@@ -37,35 +76,219 @@ class SupabaseService:
             logging.error(f"❌ Error creating session: {e}")
             return None
     
+    @tracer.traced('supabase.get_session')
     def get_session(self, session_id: str):
+        cached = self._cached_session(session_id)
+        if cached:
+            return cached
         try:
-            result = self.supabase.table('sessions').select('*').eq('id', session_id).execute()
-            return result.data[0] if result.data else None
+            return self._load_session(session_id)
         except Exception as e:
             logging.error(f"❌ Error getting session: {e}")
             return None
     
-    def update_session(self, session_id: str, updates: dict):
+    def _load_session(self, session_id: str):
+        """Строка сессии из базы в обход кэша"""
+        result = self.supabase.table('sessions').select('*').eq('id', session_id).execute()
+        session = result.data[0] if result.data else None
+        if session:
+            self._cache_session(session)
+        else:
+            self._forget_session(session_id)
+        return session
+    
+    @tracer.traced('supabase.get_awaiting_edit_session')
+    def get_awaiting_edit_session(self, chat_id: int):
+        """Сессия чата, ожидающая новое значение поля"""
+        with self._cache_lock:
+            session_id = self._awaiting_edit.get(chat_id)
+        if session_id:
+            session = self._cached_session(session_id)
+            if session and session.get('status') == 'awaiting_edit':
+                return session
         try:
-            updates['updated_at'] = 'now()'
-            result = self.supabase.table('sessions').update(updates).eq('id', session_id).execute()
-            if result.data:
-                logging.info(f"✅ Session updated: {session_id}")
-                return result.data[0]
+            # Запрос опирается на индекс sessions (chat_id, status)
+            result = self.supabase.table('sessions')\
+                .select('*')\
+                .eq('chat_id', chat_id)\
+                .eq('status', 'awaiting_edit')\
+                .order('updated_at', desc=True)\
+                .limit(1)\
+                .execute()
+            session = result.data[0] if result.data else None
+            self._cache_session(session)
+            return session
+        except Exception as e:
+            logging.error(f"❌ Error finding awaiting edit session: {e}")
+            return None
+    
+    @tracer.traced('supabase.update_session')
+    def update_session(self, session_id: str, updates):
+        """Обновляет сессию; при известной версии строки отправляет только изменившиеся поля.
+        
+        updates - словарь или функция от текущей строки, возвращающая словарь.
+        Функция нужна, когда новые значения вычисляются из строки (правка
+        parsed_data): если кэш устарел, она применяется заново к свежей
+        строке, а не перетирает запись другого инстанса.
+        """
+        try:
+            session = self._cached_session(session_id)
+            for _ in range(self.update_attempts):
+                if callable(updates) and session is None:
+                    session = self._load_session(session_id)
+                    if session is None:
+                        return None
+                values = dict(updates(session) if callable(updates) else updates, updated_at='now()')
+                
+                if session is None or not session.get('updated_at'):
+                    # Версия строки неизвестна, а значения от нее не зависят
+                    result = self.supabase.table('sessions').update(values).eq('id', session_id).execute()
+                else:
+                    # Обновляем только ту версию, что лежит в кэше
+                    changed = {key: value for key, value in values.items() if session.get(key) != value}
+                    result = self.supabase.table('sessions')\
+                        .update(changed)\
+                        .eq('id', session_id)\
+                        .eq('updated_at', session['updated_at'])\
+                        .execute()
+                
+                if result.data:
+                    logging.info(f"✅ Session updated: {session_id}")
+                    self._cache_session(result.data[0])
+                    return result.data[0]
+                
+                logging.warning(f"⚠️ Cached session {session_id} is stale, reloading")
+                session = self._load_session(session_id)
+                if session is None:
+                    return None
+            
+            logging.error(f"❌ Session {session_id} keeps changing, update dropped")
             return None
         except Exception as e:
             logging.error(f"❌ Error updating session: {e}")
             return None
     
+    @tracer.traced('supabase.claim_session')
+    def claim_session(self, session_id: str):
+        """Переводит сессию в статус submitting; None, если её уже отправляют"""
+        try:
+            result = self.supabase.table('sessions')\
+                .update({'status': 'submitting', 'updated_at': 'now()'})\
+                .eq('id', session_id)\
+                .neq('status', 'submitting')\
+                .execute()
+            if result.data:
+                self._cache_session(result.data[0])
+                return result.data[0]
+            self._forget_session(session_id)
+            return None
+        except Exception as e:
+            logging.error(f"❌ Error claiming session: {e}")
+            return None
+
+    @tracer.traced('supabase.find_stuck_submissions')
+    def find_stuck_submissions(self, cutoff: str, limit: int) -> list:
+        """Сессии в статусе submitting, не менявшиеся с cutoff (ISO-время):
+        их захватил инстанс, который замерз или был выгружен до отправки"""
+        try:
+            result = self.supabase.table('sessions')\
+                .select('*')\
+                .eq('status', 'submitting')\
+                .lt('updated_at', cutoff)\
+                .order('updated_at')\
+                .limit(limit)\
+                .execute()
+            return result.data or []
+        except Exception as e:
+            logging.error(f"❌ Error finding stuck submissions: {e}")
+            return []
+
+    @tracer.traced('supabase.reclaim_session')
+    def reclaim_session(self, session: dict):
+        """Перезахватывает зависшую отправку; None, если её уже подхватили.
+
+        Условие на прежний updated_at пропускает только один из
+        параллельных запусков доработки.
+        """
+        try:
+            result = self.supabase.table('sessions')\
+                .update({'updated_at': 'now()'})\
+                .eq('id', session['id'])\
+                .eq('status', 'submitting')\
+                .eq('updated_at', session['updated_at'])\
+                .execute()
+            if result.data:
+                self._cache_session(result.data[0])
+                return result.data[0]
+            return None
+        except Exception as e:
+            logging.error(f"❌ Error reclaiming session: {e}")
+            return None
+
+    @tracer.traced('supabase.delete_session')
     def delete_session(self, session_id: str):
+        """Удаляет сессию вместе с её задачами photo_jobs (текст OCR и анализ)"""
         try:
+            self.supabase.table('photo_jobs').delete().eq('session_id', session_id).execute()
             result = self.supabase.table('sessions').delete().eq('id', session_id).execute()
+            self._forget_session(session_id)
             logging.info(f"✅ Session deleted: {session_id}")
             return True
         except Exception as e:
             logging.error(f"❌ Error deleting session: {e}")
             return False
     
+    @tracer.traced('supabase.find_stale_sessions')
+    def find_stale_sessions(self, cutoff: str, limit: int) -> list:
+        """id сессий, не менявшихся с cutoff (ISO-время)"""
+        try:
+            result = self.supabase.table('sessions')\
+                .select('id')\
+                .lt('updated_at', cutoff)\
+                .order('updated_at')\
+                .limit(limit)\
+                .execute()
+            return [row['id'] for row in result.data or []]
+        except Exception as e:
+            logging.error(f"❌ Error finding stale sessions: {e}")
+            return []
+    
+    @tracer.traced('supabase.delete_sessions')
+    def delete_sessions(self, session_ids: list) -> int:
+        """Удаляет сессии одним запросом, возвращает число удаленных"""
+        if not session_ids:
+            return 0
+        try:
+            result = self.supabase.table('sessions').delete().in_('id', session_ids).execute()
+            for session_id in session_ids:
+                self._forget_session(session_id)
+            return len(result.data or [])
+        except Exception as e:
+            logging.error(f"❌ Error deleting sessions: {e}")
+            return 0
+    
+    @tracer.traced('supabase.delete_session_files')
+    def delete_session_files(self, session_ids: list, bucket: str = 'documents') -> int:
+        """Удаляет файлы sessions/{id}/ из Storage, возвращает число удаленных"""
+        storage = self.supabase.storage.from_(bucket)
+        paths = []
+        for session_id in session_ids:
+            try:
+                folder = f"sessions/{session_id}"
+                paths.extend(f"{folder}/{item['name']}" for item in storage.list(folder) or [])
+            except Exception as e:
+                logging.error(f"❌ Error listing files of session {session_id}: {e}")
+        
+        if not paths:
+            return 0
+        try:
+            storage.remove(paths)
+            return len(paths)
+        except Exception as e:
+            logging.error(f"❌ Error removing session files: {e}")
+            return 0
+    
+    @tracer.traced('supabase.upload_file')
     def upload_file(self, file_content: bytes, file_path: str, bucket: str = 'documents'):
         try:
             result = self.supabase.storage.from_(bucket).upload(file_path, file_content)
@@ -82,4 +305,4 @@ class SupabaseService:
             logging.error(f"❌ Error getting file URL: {e}")
             return None
 
-supabase_client = SupabaseService()
+supabase_client = LazyService('supabase', SupabaseService)
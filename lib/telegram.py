@@ -1,7 +1,13 @@
-import requests
 import os
+import time
 import logging
+import threading
+from lib.http_client import get_http_client
 from lib.supabase_client import supabase_client
+from lib.lazy import LazyService
+from lib.rate_limiter import telegram_limiter
+from lib.callback_data import encode_callback
+from utils.fields import EDIT_BUTTON_ROWS
 
 class TelegramService:
     def __init__(self):
@@ -10,30 +16,60 @@ class TelegramService:
             logging.error("❌ Telegram token not set")
             raise ValueError("Telegram token not set")
         
-        self.api_url = f"https://api.telegram.org/bot{self.token}"
+        self.api_base = os.getenv('TELEGRAM_API_BASE', 'https://api.telegram.org')
+        self.api_url = f"{self.api_base}/bot{self.token}"
+        self.http = get_http_client()
+        self.limiter = telegram_limiter
+        # Сколько раз повторять отправку после 429 Too Many Requests
+        self.max_retries = int(os.getenv('TELEGRAM_MAX_RETRIES', '5'))
         logging.info("✅ Telegram service initialized")
     
-    def download_and_store_file(self, file_id: str, session_id: str):
+    def _call(self, method: str, payload: dict, chat_id=None):
+        """Запрос к Bot API через ограничитель; на 429 ждет retry_after и повторяет"""
+        url = f"{self.api_url}/{method}"
+        for attempt in range(self.max_retries + 1):
+            self.limiter.acquire(chat_id)
+            response = self.http.post(url, json=payload)
+            if response.status_code != 429:
+                return response
+            
+            try:
+                retry_after = float(response.json().get('parameters', {}).get('retry_after', 1))
+            except ValueError:
+                retry_after = 1.0
+            logging.warning(f"⚠️ Telegram 429 on {method} for chat {chat_id}, retry after {retry_after}s")
+            self.limiter.penalize(chat_id, retry_after)
+        return response
+    
+    def download_file(self, file_id: str):
+        """Скачивает файл из Telegram, возвращает (содержимое, путь файла)"""
         try:
             file_info_url = f"{self.api_url}/getFile"
-            response = requests.post(file_info_url, data={"file_id": file_id})
+            response = self.http.post(file_info_url, data={"file_id": file_id})
             file_info = response.json()
             
             if not file_info.get('ok'):
                 logging.error(f"❌ File info error: {file_info}")
-                return None
+                return None, None
             
             file_path = file_info['result']['file_path']
-            telegram_file_url = f"https://api.telegram.org/file/bot{self.token}/{file_path}"
+            telegram_file_url = f"{self.api_base}/file/bot{self.token}/{file_path}"
             
-            file_response = requests.get(telegram_file_url)
+            file_response = self.http.get(telegram_file_url)
             if file_response.status_code != 200:
                 logging.error(f"❌ File download error: {file_response.status_code}")
-                return None
+                return None, None
+            
+            return file_response.content, file_path
             
-            file_content = file_response.content
-            file_extension = file_path.split('.')[-1] if '.' in file_path else 'jpg'
-            supabase_file_path = f"sessions/{session_id}/document.{file_extension}"
+        except Exception as e:
+            logging.error(f"❌ Error downloading file: {e}")
+            return None, None
+    
+    def store_file(self, file_content: bytes, file_path: str, session_id: str, name: str = 'document'):
+        """Сохраняет файл в Supabase Storage, возвращает публичный URL"""
+        try:
+            supabase_file_path = self.storage_path(file_path, session_id, name)
             
             upload_result = supabase_client.upload_file(file_content, supabase_file_path)
             
@@ -46,12 +82,23 @@ class TelegramService:
                 return None
             
         except Exception as e:
-            logging.error(f"❌ Error downloading and storing file: {e}")
+            logging.error(f"❌ Error storing file: {e}")
             return None
     
-    def send_message(self, chat_id, text, reply_markup=None):
+    @staticmethod
+    def storage_path(file_path: str, session_id: str, name: str = 'document') -> str:
+        """Путь файла сессии в Supabase Storage"""
+        file_extension = file_path.split('.')[-1] if '.' in file_path else 'jpg'
+        return f"sessions/{session_id}/{name}.{file_extension}"
+    
+    def download_and_store_file(self, file_id: str, session_id: str):
+        file_content, file_path = self.download_file(file_id)
+        if not file_content:
+            return None
+        return self.store_file(file_content, file_path, session_id)
+    
+    def send_message(self, chat_id, text, reply_markup=None, return_message_id=False):
         try:
-            url = f"{self.api_url}/sendMessage"
             payload = {
                 'chat_id': chat_id, 
                 'text': text,
@@ -62,16 +109,56 @@ class TelegramService:
             if reply_markup:
                 payload['reply_markup'] = reply_markup
                 
-            response = requests.post(url, json=payload, timeout=10)
+            response = self._call('sendMessage', payload, chat_id)
             success = response.status_code == 200
             
             if not success:
                 logging.error(f"❌ Telegram API error: {response.text}")
             
+            if return_message_id:
+                return response.json()['result']['message_id'] if success else None
             return success
             
         except Exception as e:
             logging.error(f"❌ Error sending message: {e}")
+            return None if return_message_id else False
+    
+    def edit_message_text(self, chat_id, message_id, text, reply_markup=None):
+        try:
+            payload = {
+                'chat_id': chat_id,
+                'message_id': message_id,
+                'text': text,
+                'parse_mode': 'HTML',
+                'disable_web_page_preview': True
+            }
+            
+            if reply_markup:
+                payload['reply_markup'] = reply_markup
+            
+            response = self._call('editMessageText', payload, chat_id)
+            success = response.status_code == 200
+            
+            # Telegram отвечает 400, если текст не изменился - это не ошибка
+            if not success and 'message is not modified' not in response.text:
+                logging.error(f"❌ Telegram API error: {response.text}")
+            
+            return success
+            
+        except Exception as e:
+            logging.error(f"❌ Error editing message: {e}")
+            return False
+    
+    def answer_callback_query(self, callback_query_id, text=None):
+        """Убирает индикатор загрузки на нажатой кнопке"""
+        try:
+            payload = {'callback_query_id': callback_query_id}
+            if text:
+                payload['text'] = text
+            response = self.http.post(f"{self.api_url}/answerCallbackQuery", json=payload)
+            return response.status_code == 200
+        except Exception as e:
+            logging.error(f"❌ Error answering callback query: {e}")
             return False
     
     def send_edit_view(self, chat_id, session_id, parsed_data):
@@ -86,32 +173,93 @@ class TelegramService:
         return {
             "inline_keyboard": [
                 [
-                    {"text": "✏️ Скорректировать", "callback_data": f"verify_edit_{session_id}"},
-                    {"text": "✅ Всё верно", "callback_data": f"verify_ok_{session_id}"}
+                    {"text": "✏️ Скорректировать", "callback_data": encode_callback('verify_edit', session_id)},
+                    {"text": "✅ Всё верно", "callback_data": encode_callback('verify_ok', session_id)}
                 ]
             ]
         }
     
     def create_edit_buttons(self, session_id):
-        return {
-            "inline_keyboard": [
-                [
-                    {"text": "🏭 Участок", "callback_data": f"edit_field_{session_id}_Участок"},
-                    {"text": "🔧 Изделие", "callback_data": f"edit_field_{session_id}_Изделие"}
-                ],
-                [
-                    {"text": "📐 Номер чертежа", "callback_data": f"edit_field_{session_id}_Номер чертежа"},
-                    {"text": "🔢 Номер изделия", "callback_data": f"edit_field_{session_id}_Номер изделия"}
-                ],
-                [
-                    {"text": "✅ Завершить", "callback_data": f"edit_done_{session_id}"}
-                ]
-            ]
-        }
+        rows = [
+            [{"text": text, "callback_data": encode_callback('edit_field', session_id, name)} for text, name in row]
+            for row in EDIT_BUTTON_ROWS
+        ]
+        rows.append([{"text": "✅ Завершить", "callback_data": encode_callback('edit_done', session_id)}])
+        return {"inline_keyboard": rows}
     
     def create_ok_button(self, session_id):
         return {
             "inline_keyboard": [
-                [{"text": "✅ ОК", "callback_data": f"edit_ok_{session_id}"}]
+                [{"text": "✅ ОК", "callback_data": encode_callback('edit_ok', session_id)}]
             ]
         }
+
+
+class ProgressMessage:
+    """Одно сообщение о ходе обработки, которое редактируется на месте.
+    
+    Первый update отправляет сообщение, следующие редактируют его не чаще
+    min_interval: промежуточные тексты схлопываются в последний, отложенный
+    текст досылается таймером. finish() заменяет статус итоговым текстом
+    (с кнопками), так что вместо нескольких сообщений в чат уходит одно.
+    """
+    
+    def __init__(self, telegram: TelegramService, chat_id, message_id=None, min_interval: float = None):
+        self.telegram = telegram
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.min_interval = min_interval if min_interval is not None else float(
+            os.getenv('TELEGRAM_EDIT_INTERVAL', '1.0')
+        )
+        self._last_edit = 0.0
+        self._last_text = None
+        self._pending_text = None
+        self._timer = None
+        self._finished = False
+        self._lock = threading.Lock()
+    
+    def update(self, text: str):
+        with self._lock:
+            if self._finished:
+                return
+            remaining = self._last_edit + self.min_interval - time.monotonic()
+            if remaining > 0:
+                self._pending_text = text
+                if self._timer is None:
+                    self._timer = threading.Timer(remaining, self.flush)
+                    self._timer.daemon = True
+                    self._timer.start()
+                return
+            self._edit(text)
+    
+    def flush(self):
+        with self._lock:
+            self._timer = None
+            if self._pending_text is not None and not self._finished:
+                self._edit(self._pending_text)
+    
+    def finish(self, text: str, reply_markup=None):
+        """Итоговый текст вместо статуса; если редактировать нечего - новым сообщением"""
+        with self._lock:
+            self._finished = True
+            self._pending_text = None
+            if self._timer:
+                self._timer.cancel()
+                self._timer = None
+            if self.message_id and self.telegram.edit_message_text(self.chat_id, self.message_id, text, reply_markup):
+                return True
+            return self.telegram.send_message(self.chat_id, text, reply_markup)
+    
+    def _edit(self, text: str):
+        self._pending_text = None
+        if text == self._last_text:
+            return
+        if self.message_id:
+            self.telegram.edit_message_text(self.chat_id, self.message_id, text)
+        else:
+            self.message_id = self.telegram.send_message(self.chat_id, text, return_message_id=True)
+        self._last_edit = time.monotonic()
+        self._last_text = text
+
+
+telegram_service = LazyService('telegram', TelegramService)
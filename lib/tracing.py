@@ -0,0 +1,108 @@
+import os
+import time
+import logging
+import threading
+import contextvars
+from collections import deque, OrderedDict
+from contextlib import contextmanager
+from functools import wraps
+
+# session_id текущей обработки, чтобы спаны внутри lib/* к ней привязывались
+current_session = contextvars.ContextVar('current_session', default=None)
+
+
+class Tracer:
+    """Спаны вокруг внешних вызовов и этапов обработки с перцентилями задержек.
+
+    Хранит последние TRACE_WINDOW длительностей на каждое имя спана и
+    последние спаны по session_id; всё в памяти инстанса.
+    """
+
+    def __init__(self):
+        self.window = int(os.getenv('TRACE_WINDOW', '1000'))
+        self.slow_threshold = float(os.getenv('TRACE_SLOW_THRESHOLD', '5'))
+        self.max_sessions = int(os.getenv('TRACE_SESSIONS', '100'))
+        self._durations = {}
+        self._errors = {}
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def bind(self, session_id):
+        """Привязывает вложенные спаны к session_id"""
+        token = current_session.set(session_id)
+        try:
+            yield
+        finally:
+            current_session.reset(token)
+
+    @contextmanager
+    def span(self, name: str, session_id=None):
+        session_id = session_id or current_session.get()
+        started_at = time.monotonic()
+        failed = False
+        try:
+            yield
+        except Exception:
+            failed = True
+            raise
+        finally:
+            self.record(name, time.monotonic() - started_at, session_id, failed)
+
+    def traced(self, name: str):
+        def decorator(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.span(name):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def record(self, name: str, duration: float, session_id=None, failed: bool = False):
+        with self._lock:
+            durations = self._durations.get(name)
+            if durations is None:
+                durations = self._durations[name] = deque(maxlen=self.window)
+            durations.append(duration)
+            if failed:
+                self._errors[name] = self._errors.get(name, 0) + 1
+
+            if session_id:
+                spans = self._sessions.setdefault(session_id, [])
+                spans.append((name, round(duration, 3)))
+                self._sessions.move_to_end(session_id)
+                while len(self._sessions) > self.max_sessions:
+                    self._sessions.popitem(last=False)
+
+        if duration >= self.slow_threshold:
+            logging.warning(f"🐢 Slow {name}: {duration:.2f}s (session {session_id})")
+
+    def session_trace(self, session_id) -> list:
+        with self._lock:
+            return list(self._sessions.get(session_id, []))
+
+    def stats(self) -> dict:
+        with self._lock:
+            snapshot = {name: sorted(durations) for name, durations in self._durations.items()}
+            errors = dict(self._errors)
+
+        result = {}
+        for name, samples in sorted(snapshot.items()):
+            if not samples:
+                continue
+            result[name] = {
+                'count': len(samples),
+                'errors': errors.get(name, 0),
+                'p50': _percentile(samples, 0.50),
+                'p95': _percentile(samples, 0.95),
+                'p99': _percentile(samples, 0.99),
+                'max': round(samples[-1], 3)
+            }
+        return result
+
+
+def _percentile(samples: list, percentile: float) -> float:
+    return round(samples[min(int(len(samples) * percentile), len(samples) - 1)], 3)
+
+
+tracer = Tracer()
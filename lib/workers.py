@@ -0,0 +1,140 @@
+import os
+import time
+import atexit
+import logging
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from lib.tracing import tracer
+
+
+class BoundedExecutor:
+    """Пул потоков с ограниченной очередью и метриками ожидания/обработки"""
+
+    def __init__(self, name: str, max_workers: int, max_queue: int):
+        self.name = name
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self._pending = 0
+        self._running = 0
+
+        self.submitted = 0
+        self.rejected = 0
+        self.completed = 0
+        self.failed = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.process_total = 0.0
+        self.process_max = 0.0
+
+    def submit(self, fn, *args, **kwargs) -> bool:
+        """Ставит задачу в очередь; False, если очередь переполнена"""
+        with self._lock:
+            if self._pending >= self.max_queue:
+                self.rejected += 1
+                logging.warning(f"⚠️ {self.name}: queue is full ({self._pending}), task rejected")
+                return False
+            self._pending += 1
+            self.submitted += 1
+
+        enqueued_at = time.monotonic()
+        # Каждая задача получает свою копию контекста: привязка трейса
+        # к session_id не переходит на следующую задачу того же потока
+        context = contextvars.copy_context()
+        self._executor.submit(context.run, self._run, enqueued_at, fn, args, kwargs)
+        return True
+
+    def _run(self, enqueued_at, fn, args, kwargs):
+        started_at = time.monotonic()
+        wait = started_at - enqueued_at
+        with self._lock:
+            self._pending -= 1
+            self._running += 1
+            self.wait_total += wait
+            self.wait_max = max(self.wait_max, wait)
+        tracer.record(f"queue.{self.name}", wait)
+
+        failed = False
+        try:
+            fn(*args, **kwargs)
+        except Exception as e:
+            failed = True
+            logging.error(f"❌ {self.name}: task failed: {e}")
+        finally:
+            duration = time.monotonic() - started_at
+            with self._lock:
+                self._running -= 1
+                self.completed += 1
+                self.failed += int(failed)
+                self.process_total += duration
+                self.process_max = max(self.process_max, duration)
+                self._idle.notify_all()
+            logging.info(f"⏱️ {self.name}: waited {wait:.2f}s, processed {duration:.2f}s")
+
+    def drain(self, timeout: float = None) -> bool:
+        """Ждет завершения всех задач; False, если не уложились в таймаут"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._lock:
+            while self._pending or self._running:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    logging.warning(f"⚠️ {self.name}: drain timed out")
+                    return False
+                self._idle.wait(remaining)
+        return True
+
+    def shutdown(self, timeout: float = None):
+        self.drain(timeout)
+        self._executor.shutdown(wait=False)
+
+    def stats(self) -> dict:
+        with self._lock:
+            done = self.completed or 1
+            return {
+                'max_workers': self.max_workers,
+                'max_queue': self.max_queue,
+                'pending': self._pending,
+                'running': self._running,
+                'submitted': self.submitted,
+                'rejected': self.rejected,
+                'completed': self.completed,
+                'failed': self.failed,
+                'wait_avg': self.wait_total / done,
+                'wait_max': self.wait_max,
+                'process_avg': self.process_total / done,
+                'process_max': self.process_max
+            }
+
+
+photo_executor = BoundedExecutor(
+    'photo',
+    max_workers=int(os.getenv('PHOTO_WORKERS', '4')),
+    max_queue=int(os.getenv('PHOTO_QUEUE_LIMIT', '20'))
+)
+
+archive_executor = BoundedExecutor(
+    'archive',
+    max_workers=int(os.getenv('ARCHIVE_WORKERS', '2')),
+    max_queue=int(os.getenv('ARCHIVE_QUEUE_LIMIT', '50'))
+)
+
+callback_executor = BoundedExecutor(
+    'callback',
+    max_workers=int(os.getenv('CALLBACK_WORKERS', '4')),
+    max_queue=int(os.getenv('CALLBACK_QUEUE_LIMIT', '50'))
+)
+
+
+def shutdown_executors():
+    """Дожидается фоновых задач при завершении процесса; фото - первыми,
+    так как они ставят задачи архивирования"""
+    timeout = float(os.getenv('PHOTO_DRAIN_TIMEOUT', '25'))
+    callback_executor.shutdown(timeout)
+    photo_executor.shutdown(timeout)
+    archive_executor.shutdown(timeout)
+
+
+atexit.register(shutdown_executors)
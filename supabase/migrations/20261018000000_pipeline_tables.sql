@@ -0,0 +1,64 @@
+-- Таблицы и колонки, которые использует конвейер обработки фото.
+-- Миграция идемпотентна: ее можно применить к существующей базе повторно.
+-- Таблицы sessions, processed_documents и bitrix_logs уже есть в базе бота.
+
+-- Сессии: версия строки для условных обновлений, поиск ожидающей правки
+-- сессии чата и очистка устаревших сессий (/sessions/reap)
+alter table sessions add column if not exists updated_at timestamptz not null default now();
+create index if not exists sessions_chat_id_status_idx on sessions (chat_id, status);
+create index if not exists sessions_updated_at_idx on sessions (updated_at);
+-- Зависшие отправки в Битрикс24 (status = 'submitting'), которые дошлет /jobs/drain
+create index if not exists sessions_submitting_idx on sessions (updated_at) where status = 'submitting';
+
+-- Кэш результатов OCR и анализа: ключи документа в журнале распознавания.
+-- Без этих колонок дополненные строки ломают всю пачку вставки журнала.
+alter table processed_documents add column if not exists created_at timestamptz not null default now();
+alter table processed_documents add column if not exists file_unique_id text;
+alter table processed_documents add column if not exists content_hash text;
+alter table processed_documents add column if not exists analysis_result text;
+create index if not exists processed_documents_file_unique_id_idx
+    on processed_documents (file_unique_id, created_at desc);
+create index if not exists processed_documents_content_hash_idx
+    on processed_documents (content_hash, created_at desc);
+create index if not exists processed_documents_session_id_idx on processed_documents (session_id);
+
+-- Кэш анализа DeepSeek по хэшу нормализованного текста (ANALYSIS_CACHE_PERSIST)
+create table if not exists analysis_cache (
+    text_hash text primary key,
+    analysis_result text not null,
+    created_at timestamptz not null default now()
+);
+
+-- Очередь задач обработки фото с арендой (lib/jobs.py, /jobs/drain)
+create table if not exists photo_jobs (
+    id uuid primary key default gen_random_uuid(),
+    session_id uuid not null,
+    chat_id bigint not null,
+    file_id text not null,
+    file_unique_id text,
+    fallback_file_id text,
+    stage text not null default 'queued',
+    attempts integer not null default 0,
+    error text,
+    lease_owner text,
+    leased_until timestamptz,
+    file_url text,
+    ocr_url text,
+    content_hash text,
+    extracted_text text,
+    analysis_result text,
+    parsed_data jsonb,
+    created_at timestamptz not null default now(),
+    updated_at timestamptz not null default now()
+);
+create index if not exists photo_jobs_pending_idx
+    on photo_jobs (created_at) where stage not in ('done', 'failed');
+create index if not exists photo_jobs_session_id_idx on photo_jobs (session_id);
+
+-- Захват update_id от Telegram: вставка строки и есть захват (DEDUP_PERSIST)
+create table if not exists processed_updates (
+    update_id bigint primary key,
+    created_at timestamptz not null default now()
+);
+-- Очистка записей старше DEDUP_TTL (/sessions/reap)
+create index if not exists processed_updates_created_at_idx on processed_updates (created_at);
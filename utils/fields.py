@@ -0,0 +1,61 @@
+from typing import NamedTuple
+
+NOT_FOUND = 'не указано'
+
+
+class Field(NamedTuple):
+    """Поле маршрутной карты: всё, что о нем нужно парсеру, шаблонам,
+    клавиатурам, промпту DeepSeek и Битрикс24"""
+    name: str          # ключ в parsed_data и в ответе DeepSeek
+    icon: str          # иконка кнопки редактирования
+    bitrix_key: str    # поле смарт-процесса Битрикс24
+    prompt: str        # что извлекать - для промпта DeepSeek
+    answer_hint: str   # подсказка формата ответа DeepSeek
+    aliases: tuple = ()  # другие названия поля в ответах DeepSeek
+
+
+# Порядок полей - порядок вывода, кнопок и строк ответа DeepSeek
+FIELDS = (
+    Field('Участок', '🏭', 'ufCrm28_1753194216',
+          'Участок/цех (только ПЕРВЫЙ указанный участок, обычно в шапке)', '[первый участок из шапки]',
+          ('Цех', 'Участок/цех', 'Подразделение')),
+    Field('Изделие', '🔧', 'ufCrm28_1753194194',
+          'Наименование изделия (общее название)', '[наименование изделия]',
+          ('Наименование изделия', 'Наименование', 'Название изделия')),
+    Field('Номер чертежа', '📐', 'ufCrm28_1737543613',
+          'Номер чертежа (формат типа ТМГ.1000.2234 или ТМГ 2X2K2.250.01.00.00)', '[номер чертежа]',
+          ('Чертеж', '№ чертежа', 'Обозначение', 'Обозначение чертежа', 'Децимальный номер')),
+    Field('Номер изделия', '🔢', 'ufCrm28_1736772873',
+          'Номер изделия', '[номер изделия]',
+          ('№ изделия', 'Заводской номер', 'Зав. №', 'Серийный номер')),
+)
+
+FIELD_NAMES = tuple(field.name for field in FIELDS)
+FIELDS_BY_NAME = {field.name: field for field in FIELDS}
+
+
+def empty_data() -> dict:
+    return dict.fromkeys(FIELD_NAMES, NOT_FOUND)
+
+
+def values(data: dict) -> tuple:
+    """Значения полей в порядке FIELDS; отсутствующие - NOT_FOUND"""
+    return tuple(data.get(name, NOT_FOUND) for name in FIELD_NAMES)
+
+
+def _compile(header: str, footer: str = '') -> str:
+    """Шаблон str.format с позиционными местами под значения полей"""
+    lines = "\n".join(f"{field.name}: <b>{{{index}}}</b>" for index, field in enumerate(FIELDS))
+    return f"{header}{lines}{footer}"
+
+
+# Шаблоны собираются один раз на схему, при выводе только подставляются значения
+DISPLAY_TEMPLATE = _compile("<b>Распознанные данные:</b>\n\n")
+EDIT_TEMPLATE = _compile("<b>Текущие данные:</b>\n\n", "\n\n<i>Нажмите на поле которое хотите исправить:</i>")
+FINAL_TEMPLATE = _compile("")
+
+# Кнопки редактирования: (текст, имя поля), по две в ряд
+EDIT_BUTTON_ROWS = tuple(
+    tuple((f"{field.icon} {field.name}", field.name) for field in FIELDS[start:start + 2])
+    for start in range(0, len(FIELDS), 2)
+)
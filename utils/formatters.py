@@ -1,43 +1,83 @@
+import re
+from utils.fields import FIELDS, NOT_FOUND, DISPLAY_TEMPLATE, EDIT_TEMPLATE, FINAL_TEMPLATE, values
+
+# Уверенность разбора строки ответа DeepSeek
+EXACT_CONFIDENCE = 1.0      # "Участок: ..." как в формате ответа
+DECORATED_CONFIDENCE = 0.9  # то же имя, но markdown, маркер списка или другой регистр
+ALIAS_CONFIDENCE = 0.75     # синоним: "Цех: ...", "Обозначение: ..."
+
+
+def _key(name: str) -> str:
+    return ' '.join(name.lower().replace('ё', 'е').split())
+
+
+# Нормализованное название -> (поле, уверенность)
+FIELD_ALIASES = {}
+for _field in FIELDS:
+    for _alias in _field.aliases:
+        FIELD_ALIASES.setdefault(_key(_alias), (_field.name, ALIAS_CONFIDENCE))
+for _field in FIELDS:
+    FIELD_ALIASES[_key(_field.name)] = (_field.name, DECORATED_CONFIDENCE)
+
+# Одно регулярное выражение на все поля: маркеры списка и markdown вокруг
+# названия, двоеточие (или тире через пробелы) и значение до конца строки.
+# Название проверяется по FIELD_ALIASES, а не перебором в самом шаблоне
+LINE_PATTERN = re.compile(
+    r'^[ \t]*(?P<prefix>(?:(?:[-*+•·>#]+|\d{1,2}[.)])[ \t]*)*[*_`]*)'
+    r'(?P<name>(?:[^\W\d_]|№)[^\n:：*_`]{0,40}?)'
+    r'(?P<separator>[ \t*_`]*(?::|：|[ \t]+[-–—][ \t]+)[ \t*_`]*)'
+    r'(?P<value>[^\n]*)$',
+    re.MULTILINE
+)
+
+VALUE_STRIP = ' \t*_`"\'«»'
+
+# Значения, которые означают "не найдено", включая эхо подсказок из промпта
+EMPTY_VALUES = frozenset(
+    {'', '-', '—', '–', 'не указано', 'не указан', 'не указана', 'не найдено', 'нет', 'отсутствует', 'n/a'}
+    | {_field.answer_hint.lower() for _field in FIELDS}
+)
+
+
 def format_data_for_display(data):
-    return (
-        f"<b>Распознанные данные:</b>\n\n"
-        f"Участок: <b>{data['Участок']}</b>\n"
-        f"Изделие: <b>{data['Изделие']}</b>\n"
-        f"Номер чертежа: <b>{data['Номер чертежа']}</b>\n"
-        f"Номер изделия: <b>{data['Номер изделия']}</b>"
-    )
+    return DISPLAY_TEMPLATE.format(*values(data))
 
 def format_data_for_edit(data):
-    return (
-        f"<b>Текущие данные:</b>\n\n"
-        f"Участок: <b>{data['Участок']}</b>\n"
-        f"Изделие: <b>{data['Изделие']}</b>\n"
-        f"Номер чертежа: <b>{data['Номер чертежа']}</b>\n"
-        f"Номер изделия: <b>{data['Номер изделия']}</b>\n\n"
-        f"<i>Нажмите на поле которое хотите исправить:</i>"
-    )
+    return EDIT_TEMPLATE.format(*values(data))
 
-def parse_extracted_data(text):
-    data = {
-        'Участок': 'не указано',
-        'Изделие': 'не указано', 
-        'Номер чертежа': 'не указано',
-        'Номер изделия': 'не указано'
-    }
+def format_final_data(data):
+    return FINAL_TEMPLATE.format(*values(data))
+
+def parse_extracted_fields(text):
+    """Разбор ответа DeepSeek за один проход: {поле: {'value': ..., 'confidence': ...}}.
+    
+    Понимает **Участок:**, маркеры списка, регистр и синонимы из utils/fields.py.
+    Если поле встречается несколько раз, побеждает строка с большей уверенностью.
+    """
+    result = {field.name: {'value': NOT_FOUND, 'confidence': 0.0} for field in FIELDS}
     
     try:
-        lines = text.split('\n')
-        for line in lines:
-            line = line.strip()
-            if line.startswith('Участок:'):
-                data['Участок'] = line.replace('Участок:', '').strip()
-            elif line.startswith('Изделие:'):
-                data['Изделие'] = line.replace('Изделие:', '').strip()
-            elif line.startswith('Номер чертежа:'):
-                data['Номер чертежа'] = line.replace('Номер чертежа:', '').strip()
-            elif line.startswith('Номер изделия:'):
-                data['Номер изделия'] = line.replace('Номер изделия:', '').strip()
+        for match in LINE_PATTERN.finditer(text or ''):
+            name = match.group('name')
+            alias = FIELD_ALIASES.get(_key(name))
+            if not alias:
+                continue
+            
+            value = match.group('value').strip(VALUE_STRIP)
+            if value.lower().rstrip('.') in EMPTY_VALUES:
+                continue
+            
+            field, confidence = alias
+            if (confidence == DECORATED_CONFIDENCE and name == field and not match.group('prefix')
+                    and match.group('separator').strip() == ':'):
+                confidence = EXACT_CONFIDENCE
+            
+            if confidence > result[field]['confidence']:
+                result[field] = {'value': value, 'confidence': confidence}
     except Exception as e:
         print(f"❌ Ошибка парсинга данных: {e}")
     
-    return data
+    return result
+
+def parse_extracted_data(text):
+    return {field: parsed['value'] for field, parsed in parse_extracted_fields(text).items()}